@@ -2,15 +2,40 @@ from flask import Flask, render_template, request, jsonify, redirect, url_for, f
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
-from models import db, User, Film, Series, Season, Episode, Transaction, AccessToken, TokenPurchase
-from config import config
+from models import db, User, Film, Series, Season, Episode, Transaction, AccessToken, TokenPurchase, MediaJob, UploadSession, TransactionRollup, ProvisioningJob
+from config import config, normalize_database_url
+from streaming import serve_video
+from hls import hls_directory, is_packaged, package_hls, PLAYLIST_NAME
+from transcoding import build_renditions, remove_renditions, renditions_folder
+from jobs import enqueue_conversion, faststart_content, get_pool, needs_conversion, schedule_media_processing
+from probing import reprobe_missing
+from uploads import UploadError, create_upload, write_chunk, claim_upload, consume_upload, abort_upload, expire_uploads
+from media_store import media_path, place_stream, acquire_media, store_stream, release_media, discard_media
+from database import init_database, commit_with_retry, is_sqlite
+from entitlements import (EntitlementCache, can_watch_film, can_watch_episode,
+                          grant_purchase, rebuild_entitlements)
+from library import LibraryCache, library_stamp, load_library
+from deletion import purge_seasons, purge_series, delete_transactions
+from reclaim import schedule_reclaim, reclaim_tombstones
+from catalog import (CatalogSnapshotCache, bump_catalog_version, catalog_changes, current_catalog_version,
+                     films_catalog, series_catalog)
+from provisioning import (ProvisioningError, new_account, hash_passwords, provision_clients, read_accounts_csv,
+                          validate_accounts, schedule_import)
+from signed_urls import sign_stream_url, verify_stream_url
+from migrations import run_migrations, explain_hot_queries
+from postgres_copy import CopyError, copy_sqlite_to_postgres
+from stats import (record_transaction, record_status_change, transaction_totals, rebuild_transaction_stats,
+                   record_purchase, record_confirmation, expire_client_stats, rebuild_client_stats)
 import os
 import uuid
 from datetime import datetime, timedelta
-from functools import wraps
+from functools import wraps, partial
 import json
-import re
-from flask import Response, abort
+from flask import Response, abort, send_from_directory, session
+from markupsafe import Markup
+import click
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import joinedload
 
 def create_app():
     app = Flask(__name__)
@@ -18,6 +43,12 @@ def create_app():
     
     # Initialiser les extensions
     db.init_app(app)
+    init_database(app)
+    
+    # Schéma à jour avant de servir : un worker ne démarre pas sur une base non migrée
+    if app.config['AUTO_MIGRATE']:
+        with app.app_context():
+            run_migrations(echo=app.logger.info)
     
     # Initialiser le login manager
     login_manager = LoginManager()
@@ -78,21 +109,19 @@ def create_app():
     @app.route('/admin')
     @admin_required
     def admin_dashboard():
-        # Statistiques de base
-        total_films = Film.query.count()
-        total_series = Series.query.count()
-        total_seasons = Season.query.count()
-        total_episodes = Episode.query.count()
-        total_transactions = Transaction.query.count()
-        pending_transactions = Transaction.query.filter_by(status='pending').count()
-        confirmed_transactions = Transaction.query.filter_by(status='confirmed').count()
-        
-        # Calcul des revenus
-        total_revenue = db.session.query(db.func.sum(Transaction.amount)).filter_by(status='confirmed').scalar() or 0
-        monthly_revenue = db.session.query(db.func.sum(Transaction.amount)).filter(
-            Transaction.status == 'confirmed',
-            Transaction.transaction_date >= datetime.utcnow().replace(day=1)
-        ).scalar() or 0
+        # Statistiques de base (une seule requÃªte)
+        total_films, total_series, total_seasons, total_episodes = db.session.query(*[
+            db.select(db.func.count()).select_from(model).scalar_subquery()
+            for model in (Film, Series, Season, Episode)
+        ]).one()
+        
+        # Compteurs et revenus lus dans la table d'agrÃ©gats
+        totals = transaction_totals()
+        total_transactions = totals['total_transactions']
+        pending_transactions = totals['pending_transactions']
+        confirmed_transactions = totals['confirmed_transactions']
+        total_revenue = totals['total_revenue']
+        monthly_revenue = totals['monthly_revenue']
         
         # Transactions rÃ©centes ( derniÃ¨res)
         recent_transactions = Transaction.query.order_by(Transaction.transaction_date.desc()).limit(10).all()
@@ -117,6 +146,7 @@ def create_app():
     def admin_reset_transactions():
         try:
             num_deleted = db.session.query(Transaction).delete()
+            db.session.query(TransactionRollup).delete()
             db.session.commit()
             flash(f'{num_deleted} transactions ont été supprimées.', 'success')
         except Exception as e:
@@ -234,60 +264,25 @@ def create_app():
             flash('Accès réservé aux clients.', 'warning')
             return redirect(url_for('admin_dashboard'))
         
-        # Récupérer le token d'accès actif de l'utilisateur
-        active_token = AccessToken.query.filter_by(
-            user_id=current_user.id
-        ).filter(
-            (AccessToken.expiry_date == None) | 
-            (AccessToken.expiry_date >= datetime.utcnow())
-        ).first()
-        
-        if not active_token:
-            flash('Aucun accès actif trouvé.', 'warning')
-            return redirect(url_for('client_login'))
-        
-        # Récupérer les achats associés à ce token
-        purchases = TokenPurchase.query.filter_by(token_id=active_token.id).all()
-        
-        films = []
-        series_dict = {}
-        
-        for purchase in purchases:
-            if purchase.film_id:
-                film = Film.query.get(purchase.film_id)
-                if film and film not in films:
-                    films.append(film)
-            elif purchase.series_id and purchase.season_id:
-                series_obj = Series.query.get(purchase.series_id)
-                season = Season.query.get(purchase.season_id)
-                
-                if series_obj and season:
-                    if series_obj.id not in series_dict:
-                        series_dict[series_obj.id] = {
-                            'series': series_obj,
-                            'seasons': {}
-                        }
-                    
-                    # Ajouter la saison
-                    if season.id not in series_dict[series_obj.id]['seasons']:
-                        series_dict[series_obj.id]['seasons'][season.id] = {
-                            'season': season,
-                            'episodes': Episode.query.filter_by(season_id=season.id)
-                                                    .order_by(Episode.episode_number).all()
-                        }
-        
-        # Convertir le dictionnaire en liste pour le template
-        series_list = []
-        for series_data in series_dict.values():
-            series_list.append({
-                'series': series_data['series'],
-                'seasons': list(series_data['seasons'].values())
-            })
+        # Bibliothèque rendue en cache tant que son empreinte en base n'a pas
+        # changé ; sinon assemblée en un nombre fixe de requêtes
+        stamp = library_stamp(current_user.id)
+        library = library_cache.get(current_user.id, stamp)
+        if library is None:
+            loaded = load_library(current_user.id)
+            if loaded is None:
+                flash('Aucun accès actif trouvé.', 'warning')
+                return redirect(url_for('client_login'))
+            
+            films, series_list, expires_in = loaded
+            library = {
+                'html': Markup(render_template('client/_library.html', films=films, series=series_list)),
+                'films_count': len(films),
+                'series_count': len(series_list)
+            }
+            library_cache.set(current_user.id, library, stamp, expires_in)
         
-        return render_template('client/index_client.html', 
-                            films=films, 
-                            series=series_list,
-                            client=current_user)
+        return render_template('client/index_client.html', library=library, client=current_user)
     @app.route('/client/logout')
     @login_required
     def client_logout():
@@ -321,78 +316,14 @@ def create_app():
                 if not username or not client_id or not password:
                     return jsonify({'success': False, 'message': 'Tous les champs requis doivent être remplis'}), 400
                 
-                # Vérifier si l'utilisateur existe déjà avec cet ID client
-                existing_user = User.query.filter_by(username=client_id).first()
-                
-                if existing_user:
-                    return jsonify({'success': False, 'message': 'Un utilisateur avec cet ID client existe déjà'}), 400
-                
-                # Créer l'utilisateur avec l'ID client comme username
-                user = User(
-                    username=client_id,  # IMPORTANT: utiliser l'ID client comme username
-                    password_hash=generate_password_hash(password),
-                    is_admin=False,
-                    email=f"{client_id}@client.local"  # Email optionnel basé sur l'ID
-                )
-                db.session.add(user)
-                db.session.flush()
-                
-                # Créer le token d'accès
-                expiry_date = datetime.utcnow() + timedelta(days=token_duration)
-                access_token = AccessToken(
-                    user_id=user.id,
-                    expiry_date=expiry_date
-                )
-                db.session.add(access_token)
-                db.session.flush()
-                
-                # Associer les contenus achetés
-                total_price = 0
+                # Validation des contenus (une requête IN par type) et création groupée
+                account = hash_passwords([new_account(username, client_id, password,
+                                                      selected_films, selected_seasons, token_duration)])[0]
                 payment_method = request.form.get("payment_method", "admin_creation")
-                
-                # Films sélectionnés
-                for film_id in selected_films:
-                    if film_id:
-                        film = Film.query.get(int(film_id))
-                        if film:
-                            purchase = TokenPurchase(
-                                token_id=access_token.id,
-                                film_id=int(film_id)
-                            )
-                            db.session.add(purchase)
-                            total_price += film.price
-                
-                # Séries/saisons sélectionnées
-                for season_data in selected_seasons:
-                    if season_data and '-' in season_data:
-                        series_id, season_id = season_data.split('-')
-                        season = Season.query.get(int(season_id))
-                        if season:
-                            purchase = TokenPurchase(
-                                token_id=access_token.id,
-                                series_id=int(series_id),
-                                season_id=int(season_id)
-                            )
-                            db.session.add(purchase)
-                            total_price += season.price
-                
-                # Mettre à jour le montant total
-                access_token.total_amount = total_price
-                
-                # Créer une transaction
-                transaction = Transaction(
-                    user_id=user.id,
-                    amount=total_price,
-                    payment_method=payment_method,
-                    status='confirmed',
-                    transaction_date=datetime.utcnow(),
-                    confirmed_date=datetime.utcnow(),
-                    confirmed_by=current_user.id,
-                    description=f"Compte créé par admin pour {username} - {len(selected_films)} films, {len(selected_seasons)} saisons"
-                )
-                db.session.add(transaction)
-                
-                db.session.commit()
+                commit_with_retry(partial(provision_clients, [account], payment_method, current_user.id))
+                total_price = account['total_price']
+                entitlement_cache.invalidate_user(account['user_id'])
+                library_cache.invalidate_user(account['user_id'])
                 
                 return jsonify({
                     'success': True, 
@@ -405,6 +336,9 @@ def create_app():
                     'total_price': total_price
                 })
                 
+            except ProvisioningError as e:
+                db.session.rollback()
+                return jsonify({'success': False, 'message': e.message}), e.status
             except Exception as e:
                 db.session.rollback()
                 return jsonify({'success': False, 'message': f'Erreur: {str(e)}'}), 500
@@ -413,17 +347,76 @@ def create_app():
         films = Film.query.all()
         series_list = Series.query.all()
         
-        series_with_seasons = []
-        for series in series_list:
-            seasons = Season.query.filter_by(series_id=series.id).order_by(Season.season_number).all()
-            series_with_seasons.append({
-                'series': series,
-                'seasons': seasons
-            })
+        # Toutes les saisons en une requête, regroupées par série
+        seasons_by_series = {}
+        for season in Season.query.order_by(Season.series_id, Season.season_number):
+            seasons_by_series.setdefault(season.series_id, []).append(season)
+        series_with_seasons = [{
+            'series': series,
+            'seasons': seasons_by_series.get(series.id, [])
+        } for series in series_list]
         
         return render_template('admin/create_client.html', 
                             films=films, 
                             series_list=series_with_seasons)
+    
+    @app.route('/admin/create-client-accounts/import', methods=['POST'])
+    @admin_required
+    def import_client_accounts():
+        """
+        Création groupée de comptes clients à partir d'un fichier CSV.
+
+        Le fichier est validé ici ; les empreintes des mots de passe et la
+        création des comptes se font en arrière-plan (provisioning.run_import).
+        Les identifiants sont renvoyés tout de suite et valables une fois la
+        tâche terminée (import_client_accounts_status).
+        """
+        file = request.files.get('accounts_file')
+        if not file or not file.filename:
+            return jsonify({'success': False, 'message': 'Fichier CSV manquant'}), 400
+        
+        try:
+            accounts = validate_accounts(read_accounts_csv(file.stream, int(request.form.get('token_duration', 30)),
+                                                           app.config['MAX_PROVISION_ACCOUNTS']))
+            payment_method = request.form.get('payment_method', 'admin_creation')
+            job = schedule_import(app, accounts, payment_method, current_user.id)
+        except ProvisioningError as e:
+            db.session.rollback()
+            return jsonify({'success': False, 'message': e.message}), e.status
+        except Exception as e:
+            db.session.rollback()
+            return jsonify({'success': False, 'message': f'Erreur: {str(e)}'}), 500
+        
+        return jsonify({
+            'success': True,
+            'message': f'Création de {len(accounts)} compte(s) client en cours...',
+            'job_id': job.id,
+            'status_url': url_for('import_client_accounts_status', job_id=job.id),
+            'accounts': [{
+                'username': account['username'],
+                'client_id': account['client_id'],
+                'password': account['password'],
+                'total_price': account['total_price']
+            } for account in accounts]
+        }), 202
+
+    @app.route('/admin/create-client-accounts/import/<job_id>')
+    @admin_required
+    def import_client_accounts_status(job_id):
+        job = db.session.get(ProvisioningJob, job_id)
+        if job is None:
+            return jsonify({'success': False, 'message': 'Import introuvable'}), 404
+        
+        messages = {
+            'done': f'{job.total} compte(s) client créé(s) avec succès!',
+            'failed': f'Import échoué : {job.error}'
+        }
+        return jsonify({
+            'success': job.status != 'failed',
+            'status': job.status,
+            'total': job.total,
+            'message': messages.get(job.status, f'Création de {job.total} compte(s) client en cours...')
+        })
    # Nouvelle route pour les téléchargements
     @app.route('/client/download/<content_type>/<int:content_id>')
     @login_required
@@ -434,35 +427,17 @@ def create_app():
         
         # Vérifier que l'utilisateur a bien acheté ce contenu
         has_access = False
-        active_token = AccessToken.query.filter_by(
-            user_id=current_user.id
-        ).filter(
-            (AccessToken.expiry_date == None) | 
-            (AccessToken.expiry_date >= datetime.utcnow())
-        ).first()
-        
-        if active_token:
-            if content_type == 'film':
-                purchase = TokenPurchase.query.filter_by(
-                    token_id=active_token.id,
-                    film_id=content_id
-                ).first()
-                if purchase:
-                    has_access = True
-                    content = Film.query.get(content_id)
-                    file_path = os.path.join(app.config['UPLOAD_FOLDER'], 'films', content.chemin)
-            elif content_type == 'episode':
-                episode = Episode.query.get(content_id)
-                if episode:
-                    purchase = TokenPurchase.query.filter_by(
-                        token_id=active_token.id,
-                        series_id=episode.season.series_id,
-                        season_id=episode.season_id
-                    ).first()
-                    if purchase:
-                        has_access = True
-                        content = episode
-                        file_path = os.path.join(app.config['UPLOAD_FOLDER'], 'episodes', content.chemin)
+        file_path = None
+        if content_type == 'film':
+            content = Film.query.get(content_id)
+            if content and can_watch_film(current_user.id, content_id):
+                has_access = True
+                file_path = media_path(app.config['UPLOAD_FOLDER'], 'films', content.chemin)
+        elif content_type == 'episode':
+            content = Episode.query.get(content_id)
+            if content and can_watch_episode(current_user.id, content):
+                has_access = True
+                file_path = media_path(app.config['UPLOAD_FOLDER'], 'episodes', content.chemin)
         
         if not has_access or not os.path.exists(file_path):
             flash('Vous n\'avez pas accès à ce contenu.', 'danger')
@@ -471,6 +446,89 @@ def create_app():
         # Envoyer le fichier pour téléchargement
         return send_file(file_path, as_attachment=True, download_name=content.title + os.path.splitext(file_path)[1])
 
+    # Uploads vidéo reprenables par morceaux
+    def upload_status_response(upload, status=200):
+        response = jsonify({
+            'success': True,
+            'upload_id': upload.id,
+            'offset': upload.received,
+            'size': upload.size,
+            'status': upload.status,
+            'chunk_size': app.config['UPLOAD_CHUNK_SIZE']
+        })
+        response.status_code = status
+        response.headers['Upload-Offset'] = str(upload.received)
+        response.headers['Upload-Length'] = str(upload.size)
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    def get_upload_or_404(upload_id):
+        upload = UploadSession.query.get_or_404(upload_id)
+        if upload.user_id != current_user.id:
+            abort(404)
+        return upload
+
+    @app.route('/admin/uploads', methods=['POST'])
+    @admin_required
+    def create_upload_session():
+        data = request.get_json(silent=True) or {}
+        try:
+            upload = create_upload(
+                app.config['UPLOAD_FOLDER'],
+                current_user.id,
+                data.get('kind'),
+                data.get('filename') or '',
+                data.get('size'),
+                app.config['MAX_VIDEO_UPLOAD_SIZE'],
+                app.config['ALLOWED_VIDEO_EXTENSIONS']
+            )
+        except UploadError as e:
+            return jsonify({'success': False, 'message': e.message}), e.status
+        
+        return upload_status_response(upload, 201)
+
+    @app.route('/admin/uploads/<upload_id>', methods=['GET', 'HEAD'])
+    @admin_required
+    def upload_session_status(upload_id):
+        return upload_status_response(get_upload_or_404(upload_id))
+
+    @app.route('/admin/uploads/<upload_id>', methods=['PATCH'])
+    @admin_required
+    def upload_session_chunk(upload_id):
+        upload = get_upload_or_404(upload_id)
+        
+        offset = request.headers.get('Upload-Offset', type=int)
+        if offset is None:
+            return jsonify({'success': False, 'message': 'En-tête Upload-Offset manquant'}), 400
+        
+        try:
+            upload = write_chunk(
+                app.config['UPLOAD_FOLDER'],
+                upload,
+                offset,
+                request.stream,
+                request.content_length,
+                request.headers.get('Upload-Checksum')
+            )
+        except UploadError as e:
+            db.session.rollback()
+            response = jsonify({'success': False, 'message': e.message, 'offset': upload.received})
+            response.status_code = e.status
+            response.headers['Upload-Offset'] = str(upload.received)
+            return response
+        
+        return upload_status_response(upload)
+
+    @app.route('/admin/uploads/<upload_id>', methods=['DELETE'])
+    @admin_required
+    def upload_session_abort(upload_id):
+        try:
+            abort_upload(app.config['UPLOAD_FOLDER'], get_upload_or_404(upload_id))
+        except UploadError as e:
+            return jsonify({'success': False, 'message': e.message}), e.status
+        schedule_reclaim(app)
+        return jsonify({'success': True})
+
     # Gestion des films
     @app.route('/admin/films')
     @admin_required
@@ -478,6 +536,22 @@ def create_app():
         films = Film.query.order_by(Film.title).all()
         return render_template('admin/films.html', films=films)
     
+    # Progression des conversions en cours (interrogée par la page des films)
+    @app.route('/admin/jobs/status')
+    @admin_required
+    def admin_jobs_status():
+        job_ids = [int(job_id) for job_id in request.args.get('ids', '').split(',') if job_id.isdigit()]
+        jobs = MediaJob.query.filter(MediaJob.id.in_(job_ids)).all() if job_ids else []
+        
+        return jsonify({'jobs': [{
+            'id': job.id,
+            'film_id': job.film_id,
+            'episode_id': job.episode_id,
+            'status': job.status,
+            'progress': round(job.progress or 0, 1),
+            'error': job.error
+        } for job in jobs]})
+    
     @app.route('/admin/films/add', methods=['GET', 'POST'])
     @admin_required
     def add_film():
@@ -504,16 +578,24 @@ def create_app():
                     file.save(file_path)
                     thumbnail_filename = unique_filename
             
-            # Gestion de l'upload du film
+            # Gestion de l'upload du film (upload par morceaux ou formulaire classique)
+            # Le fichier est rangé sur disque ici ; sa référence est comptée dans
+            # l'unité de travail qui crée le film (rejouable si la base est verrouillée)
             film_filename = None
-            if 'film_file' in request.files:
+            acquire_film = None
+            upload_id = request.form.get('upload_id')
+            if upload_id:
+                try:
+                    film_filename = claim_upload(app.config['UPLOAD_FOLDER'], upload_id, 'film', current_user.id)
+                except UploadError as e:
+                    flash(e.message, 'danger')
+                    return render_template('admin/add_film.html')
+                acquire_film = partial(consume_upload, app.config['UPLOAD_FOLDER'], upload_id, film_filename)
+            elif 'film_file' in request.files:
                 file = request.files['film_file']
                 if file and allowed_file(file.filename, app.config['ALLOWED_VIDEO_EXTENSIONS']):
-                    filename = secure_filename(file.filename)
-                    unique_filename = f"{uuid.uuid4()}_{filename}"
-                    file_path = os.path.join(app.config['UPLOAD_FOLDER'], 'films', unique_filename)
-                    file.save(file_path)
-                    film_filename = unique_filename
+                    film_filename = place_stream(app.config['UPLOAD_FOLDER'], file.stream, secure_filename(file.filename))
+                    acquire_film = partial(acquire_media, app.config['UPLOAD_FOLDER'], film_filename)
                 else:
                     flash('Format de fichier vidÃ©o non supportÃ©.', 'danger')
                     return render_template('admin/add_film.html')
@@ -533,18 +615,27 @@ def create_app():
                 genre=genre
             )
             
-            try:
+            def save_film():
+                acquire_film()
                 db.session.add(new_film)
                 db.session.flush()
+                bump_catalog_version(('film', new_film.id, 'upsert'))
+            
+            try:
+                commit_with_retry(save_film)
                 
-                # Calculer la durÃ©e automatiquement
-                new_film.calculate_duration(app)
+                # Sonde, conversion MP4 et versions basse résolution en arrière-plan
+                schedule_media_processing(app, 'film', new_film)
                 
-                db.session.commit()
                 flash('Film ajoutÃ© avec succÃ¨s.', 'success')
                 return redirect(url_for('admin_films'))
             except Exception as e:
                 db.session.rollback()
+                if not upload_id:
+                    # Fichier rangé sans référence : ne pas le laisser orphelin
+                    # (un upload par morceaux reste réutilisable par un nouvel essai)
+                    commit_with_retry(partial(discard_media, app.config['UPLOAD_FOLDER'], film_filename))
+                    schedule_reclaim(app)
                 flash(f"Erreur lors de l'ajout du film: {str(e)}", 'danger')
                 return render_template('admin/add_film.html')
         
@@ -561,6 +652,7 @@ def create_app():
             film.description = request.form.get('description')
             film.price = request.form.get('price')
             film.genre = request.form.get('genre', 'action')
+            file_changed = False
             
             # Gestion de l'upload de thumbnail
             if 'thumbnail' in request.files:
@@ -582,22 +674,23 @@ def create_app():
             if 'film_file' in request.files:
                 file = request.files['film_file']
                 if file and allowed_file(file.filename, app.config['ALLOWED_VIDEO_EXTENSIONS']):
-                    # Supprimer l'ancien fichier s'il existe
-                    if film.chemin:
-                        old_path = os.path.join(app.config['UPLOAD_FOLDER'], 'films', film.chemin)
-                        if os.path.exists(old_path):
-                            os.remove(old_path)
-                    
-                    filename = secure_filename(file.filename)
-                    unique_filename = f"{uuid.uuid4()}_{filename}"
-                    file_path = os.path.join(app.config['UPLOAD_FOLDER'], 'films', unique_filename)
-                    file.save(file_path)
-                    film.chemin = unique_filename
-                    
-                    # Recalculer la durÃ©e aprÃ¨s le changement de fichier
-                    film.calculate_duration(app)
+                    # Nouveau fichier compté avant de libérer l'ancien (supprimé
+                    # après le commit s'il n'est plus utilisé ailleurs)
+                    old_chemin = film.chemin
+                    film.chemin = store_stream(app.config['UPLOAD_FOLDER'], file.stream, secure_filename(file.filename))
+                    release_media(app.config['UPLOAD_FOLDER'], 'films', old_chemin)
+                    remove_renditions(app.config['UPLOAD_FOLDER'], film.renditions)
+                    film.renditions = []
+                    film.duration = None
+                    file_changed = True
             
+            bump_catalog_version(('film', film.id, 'upsert'))
             db.session.commit()
+            library_cache.clear()
+            if file_changed:
+                entitlement_cache.invalidate_content('film', film.id)
+                schedule_reclaim(app)
+                schedule_media_processing(app, 'film', film)
             flash('Film modifiÃ© avec succÃ¨s.', 'success')
             return redirect(url_for('admin_films'))
         
@@ -606,41 +699,8 @@ def create_app():
     @app.route('/client/dashboard')
     @login_required
     def client_dashboard():
-        # Récupérer les tokens actifs de l'utilisateur
-        active_tokens = AccessToken.query.filter_by(user_id=current_user.id).filter(
-            (AccessToken.expiry_date == None) | 
-            (AccessToken.expiry_date >= datetime.utcnow())
-        ).all()
-
-        films = []
-        series = {}
-        
-        for token in active_tokens:
-            for purchase in token.purchases:
-                if purchase.film:
-                    films.append(purchase.film)
-                if purchase.series:
-                    if purchase.series.id not in series:
-                        series[purchase.series.id] = {
-                            'series': purchase.series,
-                            'seasons': {}
-                        }
-                    # Ajouter la saison et les épisodes
-                    if purchase.season:
-                        if purchase.season.id not in series[purchase.series.id]['seasons']:
-                            series[purchase.series.id]['seasons'][purchase.season.id] = {
-                                'season': purchase.season,
-                                'episodes': []
-                            }
-                        if purchase.episode:
-                            series[purchase.series.id]['seasons'][purchase.season.id]['episodes'].append(purchase.episode)
-        
-        # Trier les épisodes par numéro
-        for s_id in series:
-            for se_id in series[s_id]['seasons']:
-                series[s_id]['seasons'][se_id]['episodes'].sort(key=lambda x: x.episode_number)
-
-        return render_template('index_client.html', films=films, series=series.values())
+        # Même bibliothèque que la page d'accueil client, lue dans user_entitlements
+        return redirect(url_for('client_index'))
 
     
     @app.route('/admin/films/delete/<int:film_id>')
@@ -654,18 +714,35 @@ def create_app():
             if os.path.exists(thumbnail_path):
                 os.remove(thumbnail_path)
         
-        # Supprimer le fichier film s'il existe
-        if film.chemin:
-            film_path = os.path.join(app.config['UPLOAD_FOLDER'], 'films', film.chemin)
-            if os.path.exists(film_path):
-                os.remove(film_path)
+        # Libérer le fichier film (supprimé avec sa dernière référence)
+        release_media(app.config['UPLOAD_FOLDER'], 'films', film.chemin)
+        remove_renditions(app.config['UPLOAD_FOLDER'], film.renditions)
+        
+        # Acheteurs du film : leurs statistiques sont recalculées sans lui
+        user_ids = [user_id for user_id, in db.session.query(AccessToken.user_id).distinct().join(
+            TokenPurchase, TokenPurchase.token_id == AccessToken.id
+        ).filter(TokenPurchase.film_id == film.id)]
         
+        # Transactions du film retirées aussi des agrégats du tableau de bord
+        delete_transactions(Transaction.film_id == film.id)
         db.session.delete(film)
+        bump_catalog_version(('film', film_id, 'delete'))
         db.session.commit()
+        entitlement_cache.invalidate_content('film', film_id)
+        content_deleted([], user_ids)
         
         flash('Film supprimÃ© avec succÃ¨s.', 'success')
         return redirect(url_for('admin_films'))
     
+    def content_deleted(episode_ids, user_ids):
+        """Après le commit d'une suppression groupée : caches, statistiques clients et fichiers"""
+        for episode_id in episode_ids:
+            entitlement_cache.invalidate_content('episode', episode_id)
+        library_cache.clear()
+        if user_ids:
+            rebuild_client_stats(user_ids)
+        schedule_reclaim(app)
+    
     # Gestion des sÃ©ries
     @app.route('/admin/series')
     @admin_required
@@ -698,6 +775,8 @@ def create_app():
             )
             
             db.session.add(new_series)
+            db.session.flush()
+            bump_catalog_version(('series', new_series.id, 'upsert'))
             db.session.commit()
             
             flash('SÃ©rie ajoutÃ©e avec succÃ¨s.', 'success')
@@ -709,30 +788,14 @@ def create_app():
     @app.route('/admin/series/delete/<int:series_id>')
     @admin_required
     def delete_series(series_id):
-        series = Series.query.get_or_404(series_id)
+        Series.query.get_or_404(series_id)
         
         try:
-            # Supprimer le thumbnail s'il existe
-            if series.thumbnail:
-                thumbnail_path = os.path.join(app.config['UPLOAD_FOLDER'], 'thumbnails', series.thumbnail)
-                if os.path.exists(thumbnail_path):
-                    os.remove(thumbnail_path)
-            
-            # Supprimer toutes les saisons et Ã©pisodes associÃ©s
-            for season in series.seasons:
-                # Supprimer tous les Ã©pisodes de la saison
-                for episode in season.episodes:
-                    # Supprimer le fichier Ã©pisode s'il existe
-                    if episode.chemin:
-                        episode_path = os.path.join(app.config['UPLOAD_FOLDER'], 'episodes', episode.chemin)
-                        if os.path.exists(episode_path):
-                            os.remove(episode_path)
-                    db.session.delete(episode)
-                
-                db.session.delete(season)
-            
-            db.session.delete(series)
+            # Suppression ensembliste ; les fichiers sont supprimés en arrière-plan
+            episode_ids, user_ids = purge_series(app.config['UPLOAD_FOLDER'], series_id)
+            bump_catalog_version(('series', series_id, 'delete'))
             db.session.commit()
+            content_deleted(episode_ids, user_ids)
             
             flash('SÃ©rie supprimÃ©e avec succÃ¨s.', 'success')
         except Exception as e:
@@ -793,6 +856,7 @@ def create_app():
         
         try:
             db.session.add(new_season)
+            bump_catalog_version(('series', series_id, 'upsert'))
             db.session.commit()
             flash(f'Saison {season_number} crÃ©Ã©e avec succÃ¨s. Vous pouvez maintenant ajouter des Ã©pisodes.', 'success')
             return redirect(url_for('admin_seasons', series_id=series_id))
@@ -813,7 +877,9 @@ def create_app():
             season.description = request.form.get('description')
             season.price = request.form.get('price')
             
+            bump_catalog_version(('series', season.series_id, 'upsert'))
             db.session.commit()
+            library_cache.clear()
             flash('Saison modifiÃ©e avec succÃ¨s.', 'success')
             return redirect(url_for('admin_seasons', series_id=season.series_id))
         
@@ -827,18 +893,11 @@ def create_app():
         series_id = season.series_id
         
         try:
-            # Supprimer tous les Ã©pisodes de la saison
-            episodes = Episode.query.filter_by(season_id=season_id).all()
-            for episode in episodes:
-                # Supprimer le fichier Ã©pisode s'il existe
-                if episode.chemin:
-                    episode_path = os.path.join(app.config['UPLOAD_FOLDER'], 'episodes', episode.chemin)
-                    if os.path.exists(episode_path):
-                        os.remove(episode_path)
-                db.session.delete(episode)
-            
-            db.session.delete(season)
+            # Suppression ensembliste ; les fichiers sont supprimés en arrière-plan
+            episode_ids, user_ids = purge_seasons(app.config['UPLOAD_FOLDER'], [season.id])
+            bump_catalog_version(('series', series_id, 'upsert'))
             db.session.commit()
+            content_deleted(episode_ids, user_ids)
             
             flash('Saison supprimÃ©e avec succÃ¨s.', 'success')
         except Exception as e:
@@ -906,16 +965,24 @@ def create_app():
             flash('Cet Ã©pisode existe dÃ©jÃ  pour cette saison.', 'danger')
             return render_template('admin/add_episode.html', season=season)
         
-        # Gestion de l'upload du fichier Ã©pisode
+        # Gestion de l'upload du fichier Ã©pisode (upload par morceaux ou formulaire classique)
+        # Le fichier est rangé sur disque ici ; sa référence est comptée dans
+        # l'unité de travail qui crée l'épisode (rejouable si la base est verrouillée)
         episode_filename = None
-        if 'episode_file' in request.files:
+        acquire_episode = None
+        upload_id = request.form.get('upload_id')
+        if upload_id:
+            try:
+                episode_filename = claim_upload(app.config['UPLOAD_FOLDER'], upload_id, 'episode', current_user.id)
+            except UploadError as e:
+                flash(e.message, 'danger')
+                return render_template('admin/add_episode.html', season=season)
+            acquire_episode = partial(consume_upload, app.config['UPLOAD_FOLDER'], upload_id, episode_filename)
+        elif 'episode_file' in request.files:
             file = request.files['episode_file']
             if file and allowed_file(file.filename, app.config['ALLOWED_VIDEO_EXTENSIONS']):
-                filename = secure_filename(file.filename)
-                unique_filename = f"{uuid.uuid4()}_{filename}"
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], 'episodes', unique_filename)
-                file.save(file_path)
-                episode_filename = unique_filename
+                episode_filename = place_stream(app.config['UPLOAD_FOLDER'], file.stream, secure_filename(file.filename))
+                acquire_episode = partial(acquire_media, app.config['UPLOAD_FOLDER'], episode_filename)
             else:
                 flash('Format de fichier vidÃ©o non supportÃ©.', 'danger')
                 return render_template('admin/add_episode.html', season=season)
@@ -932,18 +999,27 @@ def create_app():
             chemin=episode_filename
         )
         
-        try:
+        def save_episode():
+            acquire_episode()
             db.session.add(new_episode)
-            db.session.flush()
+            bump_catalog_version(('series', season.series_id, 'upsert'))
+        
+        try:
+            commit_with_retry(save_episode)
+            library_cache.clear()
             
-            # Calculer la durÃ©e automatiquement
-            new_episode.calculate_duration(app)
+            # Sonde, conversion MP4 et versions basse résolution en arrière-plan
+            schedule_media_processing(app, 'episode', new_episode)
             
-            db.session.commit()
             flash('Ã‰pisode ajoutÃ© avec succÃ¨s.', 'success')
             return redirect(url_for('admin_seasons', series_id=season.series_id))
         except Exception as e:
             db.session.rollback()
+            if not upload_id:
+                # Fichier rangé sans référence : ne pas le laisser orphelin
+                # (un upload par morceaux reste réutilisable par un nouvel essai)
+                commit_with_retry(partial(discard_media, app.config['UPLOAD_FOLDER'], episode_filename))
+                schedule_reclaim(app)
             flash(f"Erreur lors de l'ajout de l'Ã©pisode: {str(e)}", 'danger')
             return render_template('admin/add_episode.html', season=season)
     
@@ -956,27 +1032,29 @@ def create_app():
         if request.method == 'POST':
             episode.episode_number = request.form.get('episode_number')
             episode.title = request.form.get('title')
+            file_changed = False
             
             # Gestion de l'upload du nouveau fichier Ã©pisode
             if 'episode_file' in request.files:
                 file = request.files['episode_file']
                 if file and allowed_file(file.filename, app.config['ALLOWED_VIDEO_EXTENSIONS']):
-                    # Supprimer l'ancien fichier s'il existe
-                    if episode.chemin:
-                        old_path = os.path.join(app.config['UPLOAD_FOLDER'], 'episodes', episode.chemin)
-                        if os.path.exists(old_path):
-                            os.remove(old_path)
-                    
-                    filename = secure_filename(file.filename)
-                    unique_filename = f"{uuid.uuid4()}_{filename}"
-                    file_path = os.path.join(app.config['UPLOAD_FOLDER'], 'episodes', unique_filename)
-                    file.save(file_path)
-                    episode.chemin = unique_filename
-                    
-                    # Recalculer la durÃ©e aprÃ¨s le changement de fichier
-                    episode.calculate_duration(app)
+                    # Nouveau fichier compté avant de libérer l'ancien (supprimé
+                    # après le commit s'il n'est plus utilisé ailleurs)
+                    old_chemin = episode.chemin
+                    episode.chemin = store_stream(app.config['UPLOAD_FOLDER'], file.stream, secure_filename(file.filename))
+                    release_media(app.config['UPLOAD_FOLDER'], 'episodes', old_chemin)
+                    remove_renditions(app.config['UPLOAD_FOLDER'], episode.renditions)
+                    episode.renditions = []
+                    episode.duration = None
+                    file_changed = True
             
+            bump_catalog_version(('series', season.series_id, 'upsert'))
             db.session.commit()
+            library_cache.clear()
+            if file_changed:
+                entitlement_cache.invalidate_content('episode', episode.id)
+                schedule_reclaim(app)
+                schedule_media_processing(app, 'episode', episode)
             flash('Ã‰pisode modifiÃ© avec succÃ¨s.', 'success')
             return redirect(url_for('admin_seasons', series_id=season.series_id))
         
@@ -989,14 +1067,16 @@ def create_app():
         season_id = episode.season_id
         season = Season.query.get_or_404(season_id)
         
-        # Supprimer le fichier Ã©pisode s'il existe
-        if episode.chemin:
-            episode_path = os.path.join(app.config['UPLOAD_FOLDER'], 'episodes', episode.chemin)
-            if os.path.exists(episode_path):
-                os.remove(episode_path)
+        # Libérer le fichier épisode (supprimé avec sa dernière référence)
+        release_media(app.config['UPLOAD_FOLDER'], 'episodes', episode.chemin)
+        remove_renditions(app.config['UPLOAD_FOLDER'], episode.renditions)
         
         db.session.delete(episode)
+        bump_catalog_version(('series', season.series_id, 'upsert'))
         db.session.commit()
+        entitlement_cache.invalidate_content('episode', episode_id)
+        library_cache.clear()
+        schedule_reclaim(app)
         
         flash('Ã‰pisode supprimÃ© avec succÃ¨s.', 'success')
         return redirect(url_for('admin_seasons', series_id=season.series_id))
@@ -1021,30 +1101,77 @@ def create_app():
         return send_file(os.path.join(app.config['UPLOAD_FOLDER'], 'screenshots', filename))
     
     # Transactions
+    # Curseur de pagination des transactions : "<date ISO>_<id>"
+    def transaction_cursor(transaction):
+        return f"{transaction.transaction_date.isoformat()}_{transaction.id}"
+
+    def parse_transaction_cursor(value):
+        if not value:
+            return None
+        date_part, _, id_part = value.rpartition('_')
+        try:
+            return datetime.fromisoformat(date_part), int(id_part)
+        except ValueError:
+            return None
+
     @app.route('/admin/transactions')
     @admin_required
     def admin_transactions():
         # RÃ©cupÃ©rer le filtre de statut depuis les paramÃ¨tres de requÃªte
         status_filter = request.args.get('status', 'all')
         
-        # Construire la requÃªte en fonction du filtre
-        if status_filter == 'all':
-            transactions = Transaction.query.order_by(Transaction.transaction_date.desc()).all()
-        else:
-            transactions = Transaction.query.filter_by(status=status_filter).order_by(Transaction.transaction_date.desc()).all()
+        # Construire la requÃªte en fonction du filtre ; client et admin sont
+        # chargÃ©s avec la page, les contenus ensuite (aucune requÃªte par ligne)
+        query = Transaction.query.options(
+            joinedload(Transaction.client),
+            joinedload(Transaction.admin_user)
+        )
+        if status_filter != 'all':
+            query = query.filter_by(status=status_filter)
+        
+        # Pagination par curseur sur (transaction_date, id) : coÃ»t constant quelle que soit la page
+        per_page = app.config['TRANSACTIONS_PER_PAGE']
+        cursor = parse_transaction_cursor(request.args.get('after'))
+        if cursor:
+            cursor_date, cursor_id = cursor
+            query = query.filter(or_(
+                Transaction.transaction_date < cursor_date,
+                and_(Transaction.transaction_date == cursor_date, Transaction.id < cursor_id)
+            ))
+        transactions = query.order_by(
+            Transaction.transaction_date.desc(), Transaction.id.desc()
+        ).limit(per_page + 1).all()
+        next_cursor = transaction_cursor(transactions[per_page - 1]) if len(transactions) > per_page else None
+        transactions = transactions[:per_page]
+        contents = Transaction.load_transaction_contents(transactions)
+        
+        # Comptes crÃ©Ã©s par l'admin : tokens et achats des clients de la page en une fois
+        admin_client_ids = {
+            transaction.user_id for transaction in transactions
+            if transaction.payment_method == 'admin_creation'
+            and not transaction.film_id and not (transaction.series_id and transaction.season_id)
+        }
+        first_tokens = {}
+        token_contents = None
+        if admin_client_ids:
+            tokens = AccessToken.query.filter(AccessToken.user_id.in_(admin_client_ids)).order_by(AccessToken.id).all()
+            for token in tokens:
+                first_tokens.setdefault(token.user_id, token)
+            token_contents = AccessToken.load_token_contents(list(first_tokens.values()))
         
         # PrÃ©parer les donnÃ©es pour l'affichage
         transactions_data = []
         for transaction in transactions:
-            # RÃ©cupÃ©rer les informations sur le client
-            client = User.query.get(transaction.user_id)
+            client = transaction.client
             
-            # RÃ©cupÃ©rer les informations sur le produit (film ou sÃ©rie)
+            # Informations sur le produit (film ou sÃ©rie)
             product_info = {}
             content_details = []
             
-            if transaction.film_id:
-                film = Film.query.get(transaction.film_id)
+            film = contents['films'].get(transaction.film_id)
+            series = contents['series'].get(transaction.series_id)
+            season = contents['seasons'].get(transaction.season_id)
+            if film:
                 product_info = {
                     'type': 'film',
                     'title': film.title,
@@ -1052,9 +1179,7 @@ def create_app():
                     'price': film.price
                 }
                 content_details = [f"Film: {film.title} ({film.year})"]
-            elif transaction.series_id and transaction.season_id:
-                series = Series.query.get(transaction.series_id)
-                season = Season.query.get(transaction.season_id)
+            elif series and season:
                 product_info = {
                     'type': 'sÃ©rie',
                     'title': f"{series.title} - Saison {season.season_number}",
@@ -1063,10 +1188,10 @@ def create_app():
                 }
                 content_details = [f"SÃ©rie: {series.title} - Saison {season.season_number} ({season.year})"]
             elif transaction.payment_method == 'admin_creation':
-                # Pour les comptes crÃ©Ã©s par l'admin, rÃ©cupÃ©rer les dÃ©tails du contenu
-                access_token = AccessToken.query.filter_by(user_id=transaction.user_id).first()
+                # Pour les comptes crÃ©Ã©s par l'admin, dÃ©tailler le contenu du premier token
+                access_token = first_tokens.get(transaction.user_id)
                 if access_token:
-                    purchases = TokenPurchase.query.filter_by(token_id=access_token.id).all()
+                    purchases = access_token.purchases
                     
                     films_count = len([p for p in purchases if p.film_id])
                     seasons_count = len([p for p in purchases if p.series_id and p.season_id])
@@ -1080,20 +1205,18 @@ def create_app():
                     
                     # DÃ©tailler le contenu
                     for purchase in purchases:
-                        if purchase.film_id:
-                            film = Film.query.get(purchase.film_id)
-                            if film:
-                                content_details.append(f"Film: {film.title} ({film.year}) - {film.price} FCFA")
-                        elif purchase.series_id and purchase.season_id:
-                            series = Series.query.get(purchase.series_id)
-                            season = Season.query.get(purchase.season_id)
-                            if series and season:
-                                content_details.append(f"SÃ©rie: {series.title} - Saison {season.season_number} ({season.year}) - {season.price} FCFA")
+                        film = token_contents['films'].get(purchase.film_id)
+                        series = token_contents['series'].get(purchase.series_id)
+                        season = token_contents['seasons'].get(purchase.season_id)
+                        if film:
+                            content_details.append(f"Film: {film.title} ({film.year}) - {film.price} FCFA")
+                        elif series and season:
+                            content_details.append(f"SÃ©rie: {series.title} - Saison {season.season_number} ({season.year}) - {season.price} FCFA")
             
             # RÃ©cupÃ©rer les informations sur l'admin qui a confirmÃ© (si applicable)
             confirmed_by_info = None
             if transaction.confirmed_by:
-                admin_user = User.query.get(transaction.confirmed_by)
+                admin_user = transaction.admin_user
                 confirmed_by_info = {
                     'username': admin_user.username,
                     'date': transaction.confirmed_date.strftime('%Y-%m-%d %H:%M') if transaction.confirmed_date else 'N/A'
@@ -1120,22 +1243,20 @@ def create_app():
             
             transactions_data.append(transaction_data)
         
-        # RÃ©cupÃ©rer les statistiques pour l'affichage
-        total_transactions = Transaction.query.count()
-        pending_transactions = Transaction.query.filter_by(status='pending').count()
-        confirmed_transactions = Transaction.query.filter_by(status='confirmed').count()
-        rejected_transactions = Transaction.query.filter_by(status='rejected').count()
-        
-        # Calculer les revenus
-        total_revenue = db.session.query(db.func.sum(Transaction.amount)).filter_by(status='confirmed').scalar() or 0
-        admin_created_revenue = db.session.query(db.func.sum(Transaction.amount)).filter_by(
-            status='confirmed', 
-            payment_method='admin_creation'
-        ).scalar() or 0
+        # RÃ©cupÃ©rer les statistiques pour l'affichage (table d'agrÃ©gats)
+        totals = transaction_totals()
+        total_transactions = totals['total_transactions']
+        pending_transactions = totals['pending_transactions']
+        confirmed_transactions = totals['confirmed_transactions']
+        rejected_transactions = totals['rejected_transactions']
+        total_revenue = totals['total_revenue']
+        admin_created_revenue = totals['admin_created_revenue']
         
         return render_template('admin/transactions.html', 
                             transactions=transactions_data, 
                             status_filter=status_filter,
+                            next_cursor=next_cursor,
+                            is_first_page=cursor is None,
                             total_transactions=total_transactions,
                             pending_transactions=pending_transactions,
                             confirmed_transactions=confirmed_transactions,
@@ -1166,21 +1287,30 @@ def create_app():
                 token_id=access_token.id,
                 film_id=transaction.film_id
             )
+            price = transaction.film.price if transaction.film else 0
         elif transaction.series_id and transaction.season_id:
             purchase = TokenPurchase(
                 token_id=access_token.id,
                 series_id=transaction.series_id,
                 season_id=transaction.season_id
             )
+            price = transaction.season.price if transaction.season else 0
         
+        grant_purchase(access_token, purchase)
+        record_purchase(access_token, purchase, price)
         db.session.add(purchase)
         
         # Mettre Ã  jour la transaction
+        old_status = transaction.status
         transaction.status = 'confirmed'
         transaction.confirmed_date = datetime.utcnow()
         transaction.confirmed_by = current_user.id
+        record_status_change(transaction, old_status)
+        record_confirmation(transaction)
         
         db.session.commit()
+        entitlement_cache.invalidate_user(transaction.user_id)
+        library_cache.invalidate_user(transaction.user_id)
         
         flash('Transaction confirmÃ©e et token gÃ©nÃ©rÃ©.', 'success')
         return redirect(url_for('admin_transactions'))
@@ -1194,9 +1324,11 @@ def create_app():
             flash('Cette transaction a dÃ©jÃ  Ã©tÃ© traitÃ©e.', 'warning')
             return redirect(url_for('admin_transactions'))
         
+        old_status = transaction.status
         transaction.status = 'rejected'
         transaction.confirmed_date = datetime.utcnow()
         transaction.confirmed_by = current_user.id
+        record_status_change(transaction, old_status)
         
         db.session.commit()
         
@@ -1264,69 +1396,55 @@ def create_app():
         return send_file(file_path, as_attachment=True, download_name='films_et_series.json')
     
     # API pour le bot Telegram
+    # Catalogue du bot : sérialisé une fois par version, servi en octets
+    # pré-encodés (gzip si accepté) avec un ETag fort
+    catalog_snapshots = CatalogSnapshotCache(app.config['CATALOG_SNAPSHOT_CACHE_SIZE'])
+    
+    def public_base_url():
+        """URL racine des liens absolus : PUBLIC_BASE_URL, sinon l'hôte de la requête"""
+        return (app.config['PUBLIC_BASE_URL'] or request.host_url).rstrip('/')
+    
+    def thumbnail_url(filename):
+        return public_base_url() + url_for('get_thumbnail', filename=filename)
+    
+    def catalog_response(kind, build):
+        # Les URLs des vignettes sont absolues : un instantané par URL racine
+        # (une seule avec PUBLIC_BASE_URL ; cache borné sinon, l'en-tête Host
+        # étant choisi par le client)
+        snapshot = catalog_snapshots.get(
+            (kind, public_base_url()), current_catalog_version(),
+            lambda: app.json.dumps(build(thumbnail_url)).encode('utf-8')
+        )
+        use_gzip = request.accept_encodings['gzip'] > 0
+        response = Response(snapshot.gzip_body if use_gzip else snapshot.body, mimetype='application/json')
+        if use_gzip:
+            response.headers['Content-Encoding'] = 'gzip'
+        response.set_etag(snapshot.gzip_etag if use_gzip else snapshot.etag)
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Catalog-Version'] = str(snapshot.version)
+        return response.make_conditional(request)
+    
     @app.route('/api/bot/films', methods=['GET'])
     def api_get_films():
-        films = Film.query.order_by(Film.title).all()
-        films_data = []
-        
-        for film in films:
-            films_data.append({
-                'id': film.id,
-                'title': film.title,
-                'year': film.year,
-                'description': film.description,
-                'price': film.price,
-                'thumbnail_url': url_for('get_thumbnail', filename=film.thumbnail, _external=True) if film.thumbnail else None,
-                'chemin': film.chemin,
-                'genre': film.genre,
-                'duration': film.duration,
-                'formatted_duration': film.get_formatted_duration()
-            })
-        
-        return jsonify(films_data)
+        return catalog_response('films', films_catalog)
     
     @app.route('/api/bot/series', methods=['GET'])
     def api_get_series():
-        series_list = Series.query.order_by(Series.title).all()
-        series_data = []
-        
-        for series in series_list:
-            seasons = Season.query.filter_by(series_id=series.id).all()
-            seasons_data = []
-            
-            for season in seasons:
-                # RÃ©cupÃ©rer les Ã©pisodes de la saison
-                episodes = Episode.query.filter_by(season_id=season.id).order_by(Episode.episode_number).all()
-                episodes_data = []
-                
-                for episode in episodes:
-                    episodes_data.append({
-                        'id': episode.id,
-                        'episode_number': episode.episode_number,
-                        'title': episode.title,
-                        'chemin': episode.chemin,
-                        'duration': episode.duration,
-                        'formatted_duration': episode.get_formatted_duration()
-                    })
-                
-                seasons_data.append({
-                    'id': season.id,
-                    'season_number': season.season_number,
-                    'year': season.year,
-                    'description': season.description,
-                    'price': season.price,
-                    'episodes': episodes_data
-                })
-            
-            series_data.append({
-                'id': series.id,
-                'title': series.title,
-                'description': series.description,
-                'thumbnail_url': url_for('get_thumbnail', filename=series.thumbnail, _external=True) if series.thumbnail else None,
-                'seasons': seasons_data
-            })
-        
-        return jsonify(series_data)
+        return catalog_response('series', series_catalog)
+    
+    @app.route('/api/bot/catalog/changes', methods=['GET'])
+    def api_catalog_changes():
+        # Deltas depuis la version `since` (X-Catalog-Version du catalogue complet)
+        since = request.args.get('since', type=int)
+        if since is None:
+            return jsonify({'error': 'Paramètre since manquant ou invalide'}), 400
+        
+        changes = catalog_changes(since, thumbnail_url, app.config['CATALOG_CHANGES_MAX'])
+        response = jsonify(changes)
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Catalog-Version'] = str(changes['version'])
+        return response
     
     @app.route('/api/bot/transaction', methods=['POST'])
     def api_create_transaction():
@@ -1337,26 +1455,31 @@ def create_app():
         if not all(field in data for field in required_fields):
             return jsonify({'error': 'Champs manquants'}), 400
         
-        # VÃ©rifier si l'utilisateur existe, sinon le crÃ©er
-        user = User.query.filter_by(telegram_id=data['user_id']).first()
-        if not user:
-            user = User(telegram_id=data['user_id'], username=f"user_{data['user_id']}")
-            db.session.add(user)
-            db.session.commit()
-        
-        # CrÃ©er la transaction
-        transaction = Transaction(
-            user_id=user.id,
-            film_id=data.get('film_id'),
-            series_id=data.get('series_id'),
-            season_id=data.get('season_id'),
-            amount=data['amount'],
-            payment_method=data['payment_method'],
-            status='pending'
-        )
+        # Utilisateur (crÃ©Ã© si besoin), transaction et agrÃ©gats : une seule
+        # unitÃ© de travail, rejouÃ©e en entier si la base est verrouillÃ©e
+        def save_transaction():
+            # telegram_id est une chaîne : PostgreSQL refuse de la comparer à un entier
+            telegram_id = str(data['user_id'])
+            user = User.query.filter_by(telegram_id=telegram_id).first()
+            if not user:
+                user = User(telegram_id=telegram_id, username=f"user_{telegram_id}")
+                db.session.add(user)
+                db.session.flush()
+            
+            transaction = Transaction(
+                user_id=user.id,
+                film_id=data.get('film_id'),
+                series_id=data.get('series_id'),
+                season_id=data.get('season_id'),
+                amount=data['amount'],
+                payment_method=data['payment_method'],
+                status='pending'
+            )
+            db.session.add(transaction)
+            record_transaction(transaction)
+            return transaction
         
-        db.session.add(transaction)
-        db.session.commit()
+        transaction = commit_with_retry(save_transaction)
         
         return jsonify({'success': True, 'transaction_id': transaction.id})
     
@@ -1371,28 +1494,15 @@ def create_app():
             return redirect(url_for('admin_dashboard'))
         
         # Vérifier que l'utilisateur a accès à ce film
-        has_access = False
-        active_token = AccessToken.query.filter_by(
-            user_id=current_user.id
-        ).filter(
-            (AccessToken.expiry_date == None) | 
-            (AccessToken.expiry_date >= datetime.utcnow())
-        ).first()
-        
-        if active_token:
-            purchase = TokenPurchase.query.filter_by(
-                token_id=active_token.id,
-                film_id=film_id
-            ).first()
-            if purchase:
-                has_access = True
-        
-        if not has_access:
+        if not can_watch_film(current_user.id, film_id):
             flash('Vous n\'avez pas accès à ce contenu.', 'danger')
             return redirect(url_for('client_index'))
         
         film = Film.query.get_or_404(film_id)
-        return render_template('client/watch_film.html', film=film)
+        return render_template('client/watch_film.html', film=film,
+                            renditions=film.get_ready_renditions(),
+                            stream_url=signed_stream_url('film', film.id),
+                            hls_url=signed_hls_url('film', film))
 
     # Route pour streamer les épisodes
     @app.route('/client/watch/episode/<int:episode_id>')
@@ -1405,24 +1515,7 @@ def create_app():
         episode = Episode.query.get_or_404(episode_id)
         
         # Vérifier que l'utilisateur a accès à cet épisode
-        has_access = False
-        active_token = AccessToken.query.filter_by(
-            user_id=current_user.id
-        ).filter(
-            (AccessToken.expiry_date == None) | 
-            (AccessToken.expiry_date >= datetime.utcnow())
-        ).first()
-        
-        if active_token:
-            purchase = TokenPurchase.query.filter_by(
-                token_id=active_token.id,
-                series_id=episode.season.series_id,
-                season_id=episode.season_id
-            ).first()
-            if purchase:
-                has_access = True
-        
-        if not has_access:
+        if not can_watch_episode(current_user.id, episode):
             flash('Vous n\'avez pas accès à ce contenu.', 'danger')
             return redirect(url_for('client_index'))
         
@@ -1433,204 +1526,337 @@ def create_app():
         
         return render_template('client/watch_episode.html', 
                             episode=episode, 
-                            all_episodes=all_episodes)
+                            all_episodes=all_episodes,
+                            renditions=episode.get_ready_renditions(),
+                            stream_url=signed_stream_url('episode', episode.id),
+                            hls_url=signed_hls_url('episode', episode))
+
+    # Droits de lecture mis en cache par (utilisateur, contenu) : les requêtes
+    # Range successives d'un même lecteur ne touchent plus la base
+    entitlement_cache = EntitlementCache(app.config['ENTITLEMENT_CACHE_TTL'], app.config['ENTITLEMENT_CACHE_SIZE'])
+    
+    # Bibliothèques clients rendues, invalidées par les achats et les modifications du catalogue
+    library_cache = LibraryCache(app.config['LIBRARY_CACHE_TTL'], app.config['LIBRARY_CACHE_SIZE'])
+
+    def stream_user_id():
+        """Identifiant de l'utilisateur connecté, lu dans la session sans charger l'objet User"""
+        user_id = session.get('_user_id')
+        if user_id is None and current_user.is_authenticated:
+            user_id = current_user.id
+        return int(user_id) if user_id is not None else None
+
+    def load_stream_files(content_type, content_id):
+        """Fichiers (original et versions prêtes) d'un contenu, ou None s'il n'existe pas"""
+        if content_type == 'film':
+            content = Film.query.get(content_id)
+            folder = 'films'
+        else:
+            content = Episode.query.get(content_id)
+            folder = 'episodes'
+        if not content:
+            return None
+        
+        renditions_dir = renditions_folder(app.config['UPLOAD_FOLDER'])
+        return {
+            'allowed': True,
+            'path': media_path(app.config['UPLOAD_FOLDER'], folder, content.chemin),
+            'renditions': {
+                rendition.height: os.path.join(renditions_dir, rendition.chemin)
+                for rendition in content.get_ready_renditions() if rendition.chemin
+            }
+        }
+
+    def load_stream_entry(user_id, content_type, content_id):
+        """Droit de lecture et fichiers d'un contenu, ou None si le contenu n'existe pas"""
+        entry = load_stream_files(content_type, content_id)
+        if entry is None:
+            return None
+        
+        user = User.query.get(user_id)
+        if not user or user.is_admin:
+            return {'allowed': False}
+        if content_type == 'film':
+            allowed = can_watch_film(user_id, content_id)
+        else:
+            allowed = can_watch_episode(user_id, Episode.query.get(content_id))
+        return entry if allowed else {'allowed': False}
+
+    # URL de streaming signée (HMAC) : vérifiable sans session ni base de
+    # données, par cette application ou par un serveur de fichiers en frontal
+    def stream_url_secret():
+        return app.config['STREAM_URL_SECRET'] or app.config['SECRET_KEY']
+
+    def signed_stream_url(content_type, content_id, filename=None):
+        endpoint = 'stream_film' if content_type == 'film' else 'stream_episode'
+        id_arg = 'film_id' if content_type == 'film' else 'episode_id'
+        params = sign_stream_url(stream_url_secret(), content_type, content_id,
+                                 current_user.id, app.config['STREAM_URL_TTL'])
+        if filename:
+            # Playlist HLS : même signature que le fichier entier
+            return url_for(f"{endpoint}_hls", **{id_arg: content_id}, filename=filename, **params)
+        return url_for(endpoint, **{id_arg: content_id}, **params)
+
+    def signed_hls_url(content_type, content):
+        """URL signée de la playlist HLS si le fichier actuel est découpé, sinon None"""
+        upload_folder = app.config['UPLOAD_FOLDER']
+        source_path = media_path(upload_folder, 'films' if content_type == 'film' else 'episodes', content.chemin)
+        if not is_packaged(hls_directory(upload_folder, source_path), source_path):
+            return None
+        return signed_stream_url(content_type, content.id, PLAYLIST_NAME)
+
+    def stream_entitlement(content_type, content_id):
+        """Entrée de cache autorisée pour l'utilisateur courant, sinon interrompt la requête"""
+        if 'signature' in request.args:
+            # L'URL signée prouve le droit de lecture : seuls les fichiers restent à résoudre
+            user_id = verify_stream_url(stream_url_secret(), content_type, content_id, request.args)
+            if user_id is None:
+                abort(403)
+            load_entry = load_stream_files
+        else:
+            user_id = stream_user_id()
+            if user_id is None:
+                abort(login_manager.unauthorized())
+            load_entry = partial(load_stream_entry, user_id)
+        
+        entry = entitlement_cache.get(user_id, content_type, content_id)
+        # Fichier remplacé depuis la mise en cache (conversion terminée...) : recharger
+        if entry is None or (entry['allowed'] and not os.path.exists(entry['path'])):
+            entry = load_entry(content_type, content_id)
+            if entry is None:
+                abort(404)
+            entitlement_cache.set(user_id, content_type, content_id, entry)
+        
+        if not entry['allowed']:
+            abort(403)
+        return entry
+
+    # Fichier de la version demandée (?quality=480), sinon l'original
+    def stream_file_path(entry):
+        quality = request.args.get('quality', type=int)
+        return entry['renditions'].get(quality) or entry['path']
 
     # Route pour servir les vidéos avec streaming
     @app.route('/stream/film/<int:film_id>')
-    @login_required
     def stream_film(film_id):
-        if current_user.is_admin:
-            return abort(403)
-        
-        # Vérifier l'accès
-        has_access = False
-        active_token = AccessToken.query.filter_by(
-            user_id=current_user.id
-        ).filter(
-            (AccessToken.expiry_date == None) | 
-            (AccessToken.expiry_date >= datetime.utcnow())
-        ).first()
-        
-        if active_token:
-            purchase = TokenPurchase.query.filter_by(
-                token_id=active_token.id,
-                film_id=film_id
-            ).first()
-            if purchase:
-                has_access = True
-        
-        if not has_access:
-            return abort(403)
-        
-        film = Film.query.get_or_404(film_id)
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], 'films', film.chemin)
+        file_path = stream_file_path(stream_entitlement('film', film_id))
         
         if not os.path.exists(file_path):
             return abort(404)
         
-        # Supporter le streaming avec range requests
-        def generate():
-            with open(file_path, 'rb') as f:
-                data = f.read(1024)
-                while data:
-                    yield data
-                    data = f.read(1024)
-        
-        # Déterminer le type MIME
-        file_ext = os.path.splitext(film.chemin)[1].lower()
-        mime_type = {
-            '.mp4': 'video/mp4',
-            '.avi': 'video/x-msvideo',
-            '.mkv': 'video/x-matroska',
-            '.mov': 'video/quicktime',
-            '.wmv': 'video/x-ms-wmv'
-        }.get(file_ext, 'video/mp4')
-        
-        file_size = os.path.getsize(file_path)
-        
-        # Gérer les range requests pour le streaming
-        range_header = request.headers.get('Range', None)
-        if range_header:
-            byte_start = 0
-            byte_end = file_size - 1
-            
-            range_match = re.search(r'bytes=(\d+)-(\d*)', range_header)
-            if range_match:
-                byte_start = int(range_match.group(1))
-                if range_match.group(2):
-                    byte_end = int(range_match.group(2))
-            
-            def generate_range():
-                with open(file_path, 'rb') as f:
-                    f.seek(byte_start)
-                    remaining = byte_end - byte_start + 1
-                    while remaining:
-                        chunk_size = min(1024, remaining)
-                        data = f.read(chunk_size)
-                        if not data:
-                            break
-                        remaining -= len(data)
-                        yield data
-            
-            response = Response(
-                generate_range(),
-                206,
-                {
-                    'Content-Type': mime_type,
-                    'Accept-Ranges': 'bytes',
-                    'Content-Range': f'bytes {byte_start}-{byte_end}/{file_size}',
-                    'Content-Length': str(byte_end - byte_start + 1),
-                }
-            )
-        else:
-            response = Response(
-                generate(),
-                200,
-                {
-                    'Content-Type': mime_type,
-                    'Content-Length': str(file_size),
-                }
-            )
-        
-        return response
+        return serve_video(request, file_path)
 
     @app.route('/stream/episode/<int:episode_id>')
-    @login_required
     def stream_episode(episode_id):
-        if current_user.is_admin:
-            return abort(403)
-        
-        episode = Episode.query.get_or_404(episode_id)
+        file_path = stream_file_path(stream_entitlement('episode', episode_id))
         
-        # Vérifier l'accès
-        has_access = False
-        active_token = AccessToken.query.filter_by(
-            user_id=current_user.id
-        ).filter(
-            (AccessToken.expiry_date == None) | 
-            (AccessToken.expiry_date >= datetime.utcnow())
-        ).first()
-        
-        if active_token:
-            purchase = TokenPurchase.query.filter_by(
-                token_id=active_token.id,
-                series_id=episode.season.series_id,
-                season_id=episode.season_id
-            ).first()
-            if purchase:
-                has_access = True
-        
-        if not has_access:
-            return abort(403)
+        if not os.path.exists(file_path):
+            return abort(404)
         
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], 'episodes', episode.chemin)
+        return serve_video(request, file_path)
+
+    # Streaming HLS : playlist et segments pré-découpés (jobs.package_content, `flask package-hls`)
+    def send_hls_file(entry, filename):
+        hls_dir = hls_directory(app.config['UPLOAD_FOLDER'], entry['path'])
+        if not os.path.exists(os.path.join(hls_dir, PLAYLIST_NAME)):
+            return abort(404)
         
-        if not os.path.exists(file_path):
+        if filename == PLAYLIST_NAME:
+            mimetype = 'application/vnd.apple.mpegurl'
+            if 'signature' in request.args:
+                # Propager la signature aux segments (URIs relatives de la playlist)
+                query = request.query_string.decode('ascii')
+                with open(os.path.join(hls_dir, PLAYLIST_NAME), encoding='utf-8') as f:
+                    lines = [line if not line.strip() or line.startswith('#') else f"{line}?{query}"
+                             for line in f.read().splitlines()]
+                return Response('\n'.join(lines) + '\n', mimetype=mimetype)
+        elif filename.endswith('.ts'):
+            mimetype = 'video/mp2t'
+        else:
             return abort(404)
         
-        # Même logique de streaming que pour les films
-        def generate():
-            with open(file_path, 'rb') as f:
-                data = f.read(1024)
-                while data:
-                    yield data
-                    data = f.read(1024)
-        
-        file_ext = os.path.splitext(episode.chemin)[1].lower()
-        mime_type = {
-            '.mp4': 'video/mp4',
-            '.avi': 'video/x-msvideo',
-            '.mkv': 'video/x-matroska',
-            '.mov': 'video/quicktime',
-            '.wmv': 'video/x-ms-wmv'
-        }.get(file_ext, 'video/mp4')
-        
-        file_size = os.path.getsize(file_path)
-        
-        range_header = request.headers.get('Range', None)
-        if range_header:
-            byte_start = 0
-            byte_end = file_size - 1
-            
-            range_match = re.search(r'bytes=(\d+)-(\d*)', range_header)
-            if range_match:
-                byte_start = int(range_match.group(1))
-                if range_match.group(2):
-                    byte_end = int(range_match.group(2))
+        return send_from_directory(hls_dir, filename, mimetype=mimetype, conditional=True)
+
+    @app.route('/stream/film/<int:film_id>/<filename>')
+    def stream_film_hls(film_id, filename):
+        return send_hls_file(stream_entitlement('film', film_id), filename)
+
+    @app.route('/stream/episode/<int:episode_id>/<filename>')
+    def stream_episode_hls(episode_id, filename):
+        return send_hls_file(stream_entitlement('episode', episode_id), filename)
+
+    # Commande CLI : découpage HLS hors ligne de tout le catalogue
+    @app.cli.command('package-hls')
+    @click.option('--force', is_flag=True, help='Redécouper même si le cache est à jour.')
+    def package_hls_command(force):
+        """Découpe les films et épisodes en segments HLS sous uploads/hls."""
+        upload_folder = app.config['UPLOAD_FOLDER']
+        contents = [('film', film.id, media_path(upload_folder, 'films', film.chemin))
+                    for film in Film.query.all()]
+        contents += [('episode', episode.id, media_path(upload_folder, 'episodes', episode.chemin))
+                     for episode in Episode.query.all()]
+        
+        packaged = skipped = failed = 0
+        for content_type, content_id, source_path in contents:
+            if not os.path.exists(source_path):
+                click.echo(f"{content_type} {content_id}: fichier introuvable ({source_path})")
+                failed += 1
+                continue
             
-            def generate_range():
-                with open(file_path, 'rb') as f:
-                    f.seek(byte_start)
-                    remaining = byte_end - byte_start + 1
-                    while remaining:
-                        chunk_size = min(1024, remaining)
-                        data = f.read(chunk_size)
-                        if not data:
-                            break
-                        remaining -= len(data)
-                        yield data
+            output_dir = hls_directory(upload_folder, source_path)
+            if not force and is_packaged(output_dir, source_path):
+                skipped += 1
+                continue
             
-            response = Response(
-                generate_range(),
-                206,
-                {
-                    'Content-Type': mime_type,
-                    'Accept-Ranges': 'bytes',
-                    'Content-Range': f'bytes {byte_start}-{byte_end}/{file_size}',
-                    'Content-Length': str(byte_end - byte_start + 1),
-                }
-            )
-        else:
-            response = Response(
-                generate(),
-                200,
-                {
-                    'Content-Type': mime_type,
-                    'Content-Length': str(file_size),
-                }
-            )
+            try:
+                package_hls(source_path, output_dir,
+                            segment_duration=app.config['HLS_SEGMENT_DURATION'],
+                            ffmpeg=app.config['FFMPEG_BINARY'])
+                click.echo(f"{content_type} {content_id}: découpé")
+                packaged += 1
+            except Exception as e:
+                click.echo(f"{content_type} {content_id}: erreur - {str(e)}")
+                failed += 1
         
-        return response
+        click.echo(f"{packaged} découpé(s), {skipped} déjà à jour, {failed} en erreur.")
+
+    # Commande CLI : conversion en MP4 des vidéos illisibles par les navigateurs
+    @app.cli.command('convert-media')
+    def convert_media_command():
+        """Convertit en MP4 H.264/AAC les films et épisodes mkv/avi/mov/wmv."""
+        contents = [('film', film) for film in Film.query.all()]
+        contents += [('episode', episode) for episode in Episode.query.all()]
+        
+        queued = 0
+        for content_type, content in contents:
+            if not needs_conversion(content.chemin):
+                continue
+            if any(job.is_active() for job in content.jobs):
+                continue
+            enqueue_conversion(app, content_type, content)
+            queued += 1
+        
+        click.echo(f"{queued} conversion(s) en file, attente de la fin...")
+        get_pool(app).shutdown(wait=True)
+        click.echo("Conversions terminées.")
+
+    # Commande CLI : placer l'atome moov en tête des MP4 existants
+    @app.cli.command('faststart')
+    def faststart_command():
+        """Réécrit en faststart (moov en tête) les MP4 dont l'index est en fin de fichier."""
+        upload_folder = app.config['UPLOAD_FOLDER']
+        contents = [('film', film.id, media_path(upload_folder, 'films', film.chemin)) for film in Film.query.all()]
+        contents += [('episode', episode.id, media_path(upload_folder, 'episodes', episode.chemin))
+                     for episode in Episode.query.all()]
+        
+        rewritten = 0
+        for content_type, content_id, file_path in contents:
+            if not os.path.exists(file_path):
+                continue
+            try:
+                if faststart_content(app, content_type, content_id):
+                    click.echo(f"{os.path.basename(file_path)}: réécrit")
+                    rewritten += 1
+            except Exception as e:
+                click.echo(f"{os.path.basename(file_path)}: erreur - {str(e)}")
+        
+        click.echo(f"{rewritten} fichier(s) réécrit(s).")
+
+    # Commande CLI : sonde en parallèle des contenus sans durée
+    @app.cli.command('reprobe')
+    @click.option('--dry-run', is_flag=True, help='Sonder sans rien écrire en base.')
+    @click.option('--workers', type=click.IntRange(min=1), default=None, help='Nombre de processus (défaut : un par cœur).')
+    @click.option('--batch-size', type=click.IntRange(min=1), default=100, show_default=True, help='Lignes écrites par commit.')
+    @click.option('--all', 'probe_all', is_flag=True, help='Re-sonder aussi les contenus qui ont déjà une durée.')
+    def reprobe_command(dry_run, workers, batch_size, probe_all):
+        """Remplit durée, codecs, résolution et débit des films et épisodes qui n'en ont pas."""
+        reprobe_missing(app, workers=workers, batch_size=batch_size,
+                        dry_run=dry_run, probe_all=probe_all, echo=click.echo)
+
+    # Commande CLI : génération des versions basse résolution manquantes
+    @app.cli.command('build-renditions')
+    def build_renditions_command():
+        """Transcode en 240p/480p/720p les films et épisodes qui n'ont pas encore ces versions."""
+        contents = [('film', film.id) for film in Film.query.all()]
+        contents += [('episode', episode.id) for episode in Episode.query.all()]
+        
+        for content_type, content_id in contents:
+            build_renditions(app, content_type, content_id)
+            click.echo(f"{content_type} {content_id}: traité")
+
+    # Commande CLI : recalcul de la table d'agrégats des transactions
+    @app.cli.command('rebuild-stats')
+    def rebuild_stats_command():
+        """Recalcule les statistiques des transactions à partir de la table transactions."""
+        db.create_all()
+        count = rebuild_transaction_stats()
+        click.echo(f"{count} ligne(s) d'agrégats recalculée(s).")
+
+    # Commande CLI : migrations du schéma (colonnes et index des bases existantes)
+    @app.cli.command('upgrade-db')
+    def upgrade_db_command():
+        """Crée les tables manquantes et applique les migrations en attente."""
+        count = run_migrations(echo=click.echo)
+        click.echo(f"{count} migration(s) appliquée(s).")
+
+    @app.cli.command('explain-queries')
+    def explain_queries_command():
+        """Affiche le plan d'exécution des requêtes chaudes et signale celles sans index."""
+        missing = 0
+        for label, plan, indexed in explain_hot_queries():
+            click.echo(f"[{'OK' if indexed else 'SANS INDEX'}] {label}")
+            for line in plan:
+                click.echo(f"    {line}")
+            missing += not indexed
+        if missing:
+            raise SystemExit(1)
+
+    @app.cli.command('reclaim-media')
+    def reclaim_media_command():
+        """Supprime du disque les fichiers des contenus supprimés (tombstones), à lancer par cron."""
+        reclaimed, failed = reclaim_tombstones(app)
+        click.echo(f"{reclaimed} fichier(s) supprimé(s), {failed} en échec (nouvelle tentative plus tard).")
+
+    @app.cli.command('expire-uploads')
+    def expire_uploads_command():
+        """Supprime les uploads par morceaux abandonnés et leurs fichiers (à lancer par cron)."""
+        count = expire_uploads(app.config['UPLOAD_FOLDER'], app.config['UPLOAD_EXPIRY'])
+        reclaimed, failed = reclaim_tombstones(app)
+        click.echo(f"{count} upload(s) abandonné(s) supprimé(s), {reclaimed} fichier(s) supprimé(s), {failed} en échec.")
+
+    @app.cli.command('copy-to-postgres')
+    @click.argument('target_url')
+    def copy_to_postgres_command(target_url):
+        """Copie la base SQLite actuelle dans une base PostgreSQL vide (COPY en masse)."""
+        if not is_sqlite(app.config['SQLALCHEMY_DATABASE_URI']):
+            raise click.ClickException("DATABASE_URL doit désigner la base SQLite source.")
+        run_migrations(echo=click.echo)
+        try:
+            copy_sqlite_to_postgres(db.engine.url.database, normalize_database_url(target_url), echo=click.echo)
+        except CopyError as e:
+            raise click.ClickException(str(e))
+        click.echo("Copie terminée : définir DATABASE_URL sur la base PostgreSQL.")
+
+    # Commandes CLI : statistiques clients (expiration des tokens et recalcul complet)
+    @app.cli.command('expire-client-stats')
+    def expire_client_stats_command():
+        """Retire des statistiques clients les achats des tokens expirés (à lancer par cron)."""
+        count = expire_client_stats()
+        click.echo(f"{count} token(s) expiré(s) retiré(s) des statistiques.")
+
+    @app.cli.command('rebuild-client-stats')
+    def rebuild_client_stats_command():
+        """Recalcule les statistiques de tous les clients en quelques requêtes groupées."""
+        db.create_all()
+        count = rebuild_client_stats()
+        click.echo(f"Statistiques de {count} client(s) recalculées.")
+
+    # Commande CLI : remplissage de user_entitlements sur une base existante
+    @app.cli.command('rebuild-entitlements')
+    def rebuild_entitlements_command():
+        """Reconstruit les droits de lecture à partir des tokens et des achats."""
+        db.create_all()
+        count = rebuild_entitlements()
+        click.echo(f"{count} droit(s) de lecture reconstruit(s).")
     
     # Page de tÃ©lÃ©chargement client
     #@app.route('/client/<token>')
@@ -1686,9 +1912,9 @@ def create_app():
 if __name__ == '__main__':
     app = create_app()
     
-    # CrÃ©er les tables si elles n'existent pas
+    # CrÃ©er les tables si elles n'existent pas et appliquer les migrations
     with app.app_context():
-        db.create_all()
+        run_migrations()
         
         # CrÃ©er un utilisateur admin par dÃ©faut si aucun n'existe
         if not User.query.filter_by(is_admin=True).first():
@@ -1,7 +1,10 @@
+import os
 import json
+import asyncio
 import logging
 import re
 from uuid import uuid4
+import httpx
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup
 from telegram.ext import (
     Application, CommandHandler, MessageHandler,
@@ -18,6 +21,11 @@ PAYMENT_METHODS = {
     "orange": "+237658723403"
 }
 
+# API du site (ex. https://exemple.com/api/bot) : si elle est définie, le
+# catalogue est chargé puis tenu à jour par deltas toutes les quelques secondes
+CATALOG_API_URL = os.environ.get("CATALOG_API_URL")
+CATALOG_POLL_INTERVAL = 5  # secondes
+
 # États de conversation
 BROWSING, WAITING_PAYMENT_PROOF, WAITING_ADMIN_LINKS = range(3)
 
@@ -25,7 +33,8 @@ BROWSING, WAITING_PAYMENT_PROOF, WAITING_ADMIN_LINKS = range(3)
 catalog = {
     "films": [],
     "series": [],
-    "transactions": {}
+    "transactions": {},
+    "version": None  # Version du catalogue de l'API déjà appliquée
 }
 
 # Initialisation du logging
@@ -51,6 +60,92 @@ def load_catalog():
     except Exception as e:
         logger.error(f"Erreur lors du chargement du catalogue : {e}")
 
+# --- Format de l'API du site -> format de catalog.json lu par les handlers ---
+def duration_minutes(seconds):
+    return round(seconds / 60) if seconds else "??"
+
+def adapt_film(film):
+    """Film de l'API : vignette en image_url, durée lisible"""
+    return dict(film, image_url=film.get("thumbnail_url"),
+                duration=film.get("formatted_duration") or "Non spécifié")
+
+def adapt_series(series):
+    """
+    Série de l'API : vignette en cover_url, season_number/episode_number en
+    number, durées des épisodes en minutes. Le prix est celui de la saison
+    (pas de prix par épisode), voir season_price.
+    """
+    return dict(series, cover_url=series.get("thumbnail_url"), seasons=[
+        dict(season, number=season["season_number"], episodes=[
+            dict(episode, number=episode["episode_number"], duration=duration_minutes(episode.get("duration")))
+            for episode in season.get("episodes", [])
+        ]) for season in series.get("seasons", [])
+    ])
+
+def season_price(season):
+    """Prix de la saison (API), sinon somme des prix des épisodes (catalog.json)"""
+    if season.get("price") is not None:
+        return season["price"]
+    return sum(episode.get("price", 0) for episode in season.get("episodes", []))
+
+# --- Synchronisation du catalogue avec l'API du site ---
+async def fetch_full_catalog(client):
+    """Recharge films et séries complets depuis l'API"""
+    films_response = await client.get(f"{CATALOG_API_URL}/films")
+    films_response.raise_for_status()
+    series_response = await client.get(f"{CATALOG_API_URL}/series")
+    series_response.raise_for_status()
+
+    catalog["films"] = [adapt_film(film) for film in films_response.json()]
+    catalog["series"] = [adapt_series(series) for series in series_response.json()]
+    # Plus petite des deux versions : une modification faite entre les deux
+    # appels sera simplement réappliquée par le prochain delta
+    catalog["version"] = min(int(films_response.headers.get("X-Catalog-Version", 0)),
+                             int(series_response.headers.get("X-Catalog-Version", 0)))
+    logger.info(f"Catalogue v{catalog['version']} chargé depuis l'API : "
+                f"{len(catalog['films'])} films, {len(catalog['series'])} séries.")
+
+def apply_catalog_changes(changes):
+    """Applique un delta de /catalog/changes (contenus modifiés et supprimés)"""
+    for key, deleted_key, adapt in (("films", "deleted_films", adapt_film), ("series", "deleted_series", adapt_series)):
+        updated = {item["id"]: adapt(item) for item in changes[key]}
+        removed = set(changes[deleted_key]) | set(updated)
+        items = [item for item in catalog[key] if item["id"] not in removed] + list(updated.values())
+        # Même ordre que l'API (par titre)
+        items.sort(key=lambda item: item.get("title") or "")
+        catalog[key] = items
+    catalog["version"] = changes["version"]
+
+async def sync_catalog(client):
+    if catalog["version"] is None:
+        await fetch_full_catalog(client)
+        return
+
+    response = await client.get(f"{CATALOG_API_URL}/catalog/changes", params={"since": catalog["version"]})
+    response.raise_for_status()
+    changes = response.json()
+    if changes["reset"]:
+        await fetch_full_catalog(client)
+    elif changes["version"] != catalog["version"]:
+        apply_catalog_changes(changes)
+        logger.info(f"Catalogue mis à jour en v{changes['version']} : "
+                    f"{len(changes['films']) + len(changes['series'])} modifié(s), "
+                    f"{len(changes['deleted_films']) + len(changes['deleted_series'])} supprimé(s).")
+
+async def poll_catalog():
+    async with httpx.AsyncClient(timeout=30) as client:
+        while True:
+            try:
+                await sync_catalog(client)
+            except Exception as e:
+                # Toute erreur est journalisée : la tâche de synchronisation ne doit pas s'arrêter
+                logger.exception(f"Synchronisation du catalogue impossible : {e}")
+            await asyncio.sleep(CATALOG_POLL_INTERVAL)
+
+async def start_catalog_sync(application: Application):
+    # Référence conservée pour que la tâche ne soit pas ramassée
+    application.bot_data["catalog_sync"] = asyncio.create_task(poll_catalog())
+
 # ==================== FONCTIONS ADMIN ====================
 async def handle_admin_document(update: Update, context: CallbackContext):
     """Reçoit et traite le fichier JSON de l'admin"""
@@ -360,8 +455,7 @@ async def add_to_cart(update: Update, context: CallbackContext):
         if series:
             item_title = series['title'] + " (Série Complète)"
             for season in series.get('seasons', []):
-                for episode in season.get('episodes', []):
-                    item_price += episode.get('price', 0)
+                item_price += season_price(season)
         else:
             await query.answer("Série introuvable.", show_alert=True)
             return
@@ -372,8 +466,7 @@ async def add_to_cart(update: Update, context: CallbackContext):
             season = next((s for s in series.get("seasons", []) if s["number"] == season_number), None)
             if season:
                 item_title = f"{series['title']} - Saison {season_number}"
-                for episode in season.get('episodes', []):
-                    item_price += episode.get('price', 0)
+                item_price += season_price(season)
             else:
                 await query.answer("Saison introuvable.", show_alert=True)
                 return
@@ -832,10 +925,7 @@ async def show_series_detail(update: Update, context: CallbackContext):
     text = f"📺 *{series['title']}*\n\n{series.get('description', 'Pas de description disponible.')}\n\n"
     buttons = []
 
-    total_series_price = 0
-    for season in series.get('seasons', []):
-        for episode in season.get('episodes', []):
-            total_series_price += episode.get('price', 0)
+    total_series_price = sum(season_price(season) for season in series.get('seasons', []))
 
     if total_series_price > 0:
         text += f"💰 *Prix de la série complète* : {total_series_price} FCFA\n\n"
@@ -844,7 +934,7 @@ async def show_series_detail(update: Update, context: CallbackContext):
     if series.get('seasons'):
         text += "*Saisons disponibles :*\n"
         for season in series["seasons"]:
-            season_price_display = sum(ep.get('price', 0) for ep in season.get('episodes', []))
+            season_price_display = season_price(season)
             season_button_text = f"Saison {season['number']}"
             if season_price_display > 0:
                 season_button_text += f" ({season_price_display} FCFA)"
@@ -908,13 +998,14 @@ async def show_season_detail(update: Update, context: CallbackContext):
 
     text = f"📺 *{series['title']} - Saison {season_number}*\n\n"
     
-    season_price_for_purchase = sum(ep.get('price', 0) for ep in season.get('episodes', []))
+    season_price_for_purchase = season_price(season)
     logger.info(f"Prix calculé pour Saison {season_number} de {series['title']}: {season_price_for_purchase}")
 
     if "episodes" in season and season["episodes"]:
         text += "*Épisodes :*\n"
         for ep in season["episodes"]:
-            text += f"- {ep['title']} ({ep.get('duration', '??')} min) - {ep.get('price', '0')} FCFA\n"
+            text += f"- {ep['title']} ({ep.get('duration', '??')} min)"
+            text += f" - {ep['price']} FCFA\n" if 'price' in ep else "\n"
     else:
         text += "Pas d'épisodes disponibles pour cette saison."
 
@@ -1130,7 +1221,10 @@ def main():
     """Configure et lance le bot"""
     load_catalog()
 
-    application = Application.builder().token(TOKEN).build()
+    builder = Application.builder().token(TOKEN)
+    if CATALOG_API_URL:
+        builder = builder.post_init(start_catalog_sync)
+    application = builder.build()
 
     # ConversationHandler pour le processus de paiement
     conv_handler = ConversationHandler(
@@ -0,0 +1,227 @@
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import func, insert
+from sqlalchemy.exc import IntegrityError
+from models import db, Film, Series, Season, Episode, CatalogState, CatalogChange
+
+
+def bump_catalog_version(*changes):
+    """
+    Incrémente la version du catalogue ; à appeler avant le commit de toute
+    écriture sur films, séries, saisons ou épisodes (même transaction).
+
+    Chaque modification est un tuple (type, id, action) : type 'film' ou
+    'series' (une saison ou un épisode modifie sa série), action 'upsert' ou
+    'delete'. Elles sont inscrites au journal sous la nouvelle version, et
+    les versions plus anciennes que CATALOG_CHANGES_RETENTION sont purgées.
+    Retourne la nouvelle version.
+    """
+    values = {'version': CatalogState.version + 1, 'updated_date': datetime.utcnow()}
+    if not CatalogState.query.filter_by(id=1).update(values, synchronize_session=False):
+        try:
+            with db.session.begin_nested():
+                db.session.add(CatalogState(id=1, version=1))
+        except IntegrityError:
+            # Ligne créée en parallèle par une autre requête
+            CatalogState.query.filter_by(id=1).update(values, synchronize_session=False)
+    version = current_catalog_version()
+
+    rows = [{'version': version, 'entity_type': entity_type, 'entity_id': entity_id, 'action': action}
+            for entity_type, entity_id, action in dict.fromkeys(changes)]
+    if rows:
+        db.session.execute(insert(CatalogChange), rows)
+    retention = current_app.config.get('CATALOG_CHANGES_RETENTION', 1000)
+    CatalogChange.query.filter(CatalogChange.version <= version - retention).delete(synchronize_session=False)
+    return version
+
+
+def current_catalog_version():
+    return db.session.query(CatalogState.version).filter_by(id=1).scalar() or 0
+
+
+def content_changes(content_type, content_ids):
+    """Modifications à journaliser pour des films ou des épisodes mis à jour"""
+    if content_type == 'film':
+        return [('film', film_id, 'upsert') for film_id in content_ids]
+    series_ids = db.session.query(Season.series_id).distinct().join(
+        Episode, Episode.season_id == Season.id
+    ).filter(Episode.id.in_(list(content_ids)))
+    return [('series', series_id, 'upsert') for series_id, in series_ids]
+
+
+def film_payload(film, thumbnail_url):
+    return {
+        'id': film.id,
+        'title': film.title,
+        'year': film.year,
+        'description': film.description,
+        'price': film.price,
+        'thumbnail_url': thumbnail_url(film.thumbnail) if film.thumbnail else None,
+        'chemin': film.chemin,
+        'genre': film.genre,
+        'duration': film.duration,
+        'formatted_duration': film.get_formatted_duration()
+    }
+
+
+def episode_payload(episode):
+    return {
+        'id': episode.id,
+        'episode_number': episode.episode_number,
+        'title': episode.title,
+        'chemin': episode.chemin,
+        'duration': episode.duration,
+        'formatted_duration': episode.get_formatted_duration()
+    }
+
+
+def season_payload(season, episodes):
+    return {
+        'id': season.id,
+        'season_number': season.season_number,
+        'year': season.year,
+        'description': season.description,
+        'price': season.price,
+        'episodes': [episode_payload(episode) for episode in episodes]
+    }
+
+
+def series_payload(series, seasons, episodes_by_season, thumbnail_url):
+    return {
+        'id': series.id,
+        'title': series.title,
+        'description': series.description,
+        'thumbnail_url': thumbnail_url(series.thumbnail) if series.thumbnail else None,
+        'seasons': [season_payload(season, episodes_by_season.get(season.id, [])) for season in seasons]
+    }
+
+
+def films_catalog(thumbnail_url, film_ids=None):
+    query = Film.query
+    if film_ids is not None:
+        query = query.filter(Film.id.in_(film_ids))
+    return [film_payload(film, thumbnail_url) for film in query.order_by(Film.title)]
+
+
+def series_catalog(thumbnail_url, series_ids=None):
+    """
+    Séries, saisons et épisodes en trois requêtes, quelle que soit la taille
+    du catalogue (ou des seules séries `series_ids`).
+    """
+    series_query, season_query = Series.query, Season.query
+    episode_query = Episode.query
+    if series_ids is not None:
+        series_query = series_query.filter(Series.id.in_(series_ids))
+        season_query = season_query.filter(Season.series_id.in_(series_ids))
+        episode_query = episode_query.join(Season, Episode.season_id == Season.id).filter(
+            Season.series_id.in_(series_ids))
+
+    seasons_by_series = {}
+    for season in season_query.order_by(Season.series_id, Season.id):
+        seasons_by_series.setdefault(season.series_id, []).append(season)
+    episodes_by_season = {}
+    for episode in episode_query.order_by(Episode.season_id, Episode.episode_number):
+        episodes_by_season.setdefault(episode.season_id, []).append(episode)
+
+    return [series_payload(series, seasons_by_series.get(series.id, []), episodes_by_season, thumbnail_url)
+            for series in series_query.order_by(Series.title)]
+
+
+def catalog_changes(since, thumbnail_url, max_changes):
+    """
+    Modifications du catalogue depuis la version `since`.
+
+    Les films et séries modifiés sont renvoyés dans leur état actuel (même
+    forme que /api/bot/films et /api/bot/series) et les supprimés par id.
+    `reset` demande au bot de recharger le catalogue complet : version
+    inconnue, journal déjà purgé ou plus de `max_changes` contenus modifiés.
+    """
+    version = current_catalog_version()
+    delta = {'version': version, 'reset': False, 'films': [], 'series': [],
+             'deleted_films': [], 'deleted_series': []}
+    if since == version:
+        return delta
+
+    # Journal complet si toutes les versions après `since` y figurent encore
+    oldest = db.session.query(func.min(CatalogChange.version)).scalar()
+    if since > version or oldest is None or since < oldest - 1:
+        return dict(delta, reset=True)
+
+    latest = {}
+    for entity_type, entity_id, action in db.session.query(
+            CatalogChange.entity_type, CatalogChange.entity_id, CatalogChange.action
+    ).filter(CatalogChange.version > since, CatalogChange.version <= version).order_by(
+            CatalogChange.version, CatalogChange.id):
+        # Seule la dernière action de chaque contenu compte
+        latest.pop((entity_type, entity_id), None)
+        latest[(entity_type, entity_id)] = action
+    if len(latest) > max_changes:
+        return dict(delta, reset=True)
+
+    upserts = {'film': [], 'series': []}
+    for (entity_type, entity_id), action in latest.items():
+        if action == 'delete':
+            delta['deleted_films' if entity_type == 'film' else 'deleted_series'].append(entity_id)
+        else:
+            upserts[entity_type].append(entity_id)
+
+    if upserts['film']:
+        delta['films'] = films_catalog(thumbnail_url, upserts['film'])
+    if upserts['series']:
+        delta['series'] = series_catalog(thumbnail_url, upserts['series'])
+    # Contenu supprimé depuis la lecture de la version : il sera aussi dans le
+    # prochain delta, le bot le retire dès maintenant
+    delta['deleted_films'] += sorted(set(upserts['film']) - {film['id'] for film in delta['films']})
+    delta['deleted_series'] += sorted(set(upserts['series']) - {series['id'] for series in delta['series']})
+    return delta
+
+
+class CatalogSnapshot:
+    """Réponse JSON pré-encodée d'une version du catalogue, brute et compressée"""
+
+    def __init__(self, version, body):
+        self.version = version
+        self.body = body
+        self.gzip_body = gzip.compress(body, compresslevel=6)
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        # ETags forts distincts par représentation (identité / gzip)
+        self.etag = f"{version}-{digest}"
+        self.gzip_etag = f"{version}-{digest}-gzip"
+
+
+class CatalogSnapshotCache:
+    """
+    Instantanés du catalogue par clé (type, URL racine), propres au processus.
+
+    Un instantané est reconstruit uniquement quand la version en base a
+    changé ; la construction est sérialisée pour qu'une rafale de requêtes
+    après une modification ne sérialise le catalogue qu'une fois. Au-delà de
+    `max_size` clés, les moins récemment utilisées sont retirées.
+    """
+
+    def __init__(self, max_size=16):
+        self.max_size = max_size
+        self._snapshots = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version, build):
+        snapshot = self._snapshots.get(key)
+        if snapshot is not None and snapshot.version == version:
+            return snapshot
+        with self._lock:
+            snapshot = self._snapshots.get(key)
+            if snapshot is None or snapshot.version != version:
+                snapshot = CatalogSnapshot(version, build())
+                self._snapshots[key] = snapshot
+            self._snapshots.move_to_end(key)
+            while len(self._snapshots) > self.max_size:
+                self._snapshots.popitem(last=False)
+            return snapshot
+
+    def clear(self):
+        with self._lock:
+            self._snapshots.clear()
@@ -5,10 +5,18 @@ load_dotenv()
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
+
+def normalize_database_url(database_uri):
+    """Les URLs `postgres://` (Heroku, Scalingo...) ne sont plus acceptées par SQLAlchemy 1.4+"""
+    if database_uri.startswith('postgres://'):
+        return 'postgresql://' + database_uri[len('postgres://'):]
+    return database_uri
+
+
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'votre_cle_secrete_super_securisee'
-    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
-        'sqlite:///' + os.path.join(basedir, 'films_series.db')
+    SQLALCHEMY_DATABASE_URI = normalize_database_url(os.environ.get('DATABASE_URL') or
+                                                     'sqlite:///' + os.path.join(basedir, 'films_series.db'))
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     
     # Configuration Telegram Bot
@@ -40,10 +48,105 @@ class Config:
     UPLOAD_FOLDER = os.path.join(basedir, 'uploads')
     MAX_CONTENT_LENGTH = 1000 * 1024 * 1024  # 100MB max file size
     
+    # Uploads vidéo reprenables : chaque morceau reste sous MAX_CONTENT_LENGTH
+    UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+    MAX_VIDEO_UPLOAD_SIZE = int(os.environ.get('MAX_VIDEO_UPLOAD_SIZE') or 20 * 1024 * 1024 * 1024)
+    # Sessions sans nouveau morceau depuis ce délai supprimées par `flask expire-uploads`
+    UPLOAD_EXPIRY = int(os.environ.get('UPLOAD_EXPIRY') or 24 * 3600)  # secondes
+    
     # Types de fichiers autorisés
     ALLOWED_VIDEO_EXTENSIONS = {'mp4', 'avi', 'mkv', 'mov', 'wmv'}
     ALLOWED_IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
-    
+
+    # Moteur de streaming vidéo :
+    #   'sendfile'   -> os.sendfile via wsgi.file_wrapper (gunicorn)
+    #   'x-sendfile' -> délégation à Apache/lighttpd (mod_xsendfile)
+    #   'x-accel'    -> délégation à nginx (location internal sur STREAM_ACCEL_PREFIX)
+    STREAM_BACKEND = os.environ.get('STREAM_BACKEND') or 'sendfile'
+    STREAM_ACCEL_PREFIX = os.environ.get('STREAM_ACCEL_PREFIX') or '/protected-media/'
+    STREAM_CHUNK_SIZE = 256 * 1024  # Taille de bloc pour la lecture de secours
+
+    # Cache des droits de lecture (requêtes Range sans accès à la base)
+    ENTITLEMENT_CACHE_TTL = int(os.environ.get('ENTITLEMENT_CACHE_TTL') or 60)  # secondes
+    ENTITLEMENT_CACHE_SIZE = 10000
+
+    # Bibliothèques clients rendues (page d'accueil client), par utilisateur
+    LIBRARY_CACHE_TTL = int(os.environ.get('LIBRARY_CACHE_TTL') or 300)  # secondes
+    LIBRARY_CACHE_SIZE = 2000
+
+    # Fichiers des contenus supprimés : délai avant nouvelle tentative, doublé à chaque échec
+    RECLAIM_RETRY_DELAY = 60  # secondes
+
+    # Création groupée de comptes clients (import CSV)
+    MAX_PROVISION_ACCOUNTS = 500
+
+    # Journal du catalogue pour le bot : versions conservées, et nombre de
+    # contenus modifiés au-delà duquel le bot recharge le catalogue complet
+    CATALOG_CHANGES_RETENTION = 1000
+    CATALOG_CHANGES_MAX = 200
+    # URL publique du site (ex. https://films.example.com) pour les URLs absolues
+    # des vignettes de l'API ; à défaut, l'hôte de la requête est utilisé
+    PUBLIC_BASE_URL = os.environ.get('PUBLIC_BASE_URL')
+    # Instantanés du catalogue gardés en mémoire (un par type et URL racine)
+    CATALOG_SNAPSHOT_CACHE_SIZE = 16
+
+    # URLs de streaming signées (HMAC-SHA256) ; par défaut signées avec SECRET_KEY.
+    # La durée doit couvrir un visionnage complet : le lecteur garde la même URL.
+    STREAM_URL_SECRET = os.environ.get('STREAM_URL_SECRET')
+    STREAM_URL_TTL = int(os.environ.get('STREAM_URL_TTL') or 4 * 3600)  # secondes
+
+    # Découpage HLS après chaque upload ou remplacement (`flask package-hls` pour l'existant)
+    FFMPEG_BINARY = os.environ.get('FFMPEG_BINARY') or 'ffmpeg'
+    HLS_SEGMENT_DURATION = 6  # Durée cible d'un segment en secondes
+
+    # Versions basse résolution générées en arrière-plan (débits en kbit/s)
+    FFPROBE_BINARY = os.environ.get('FFPROBE_BINARY') or 'ffprobe'
+    TRANSCODE_WORKERS = int(os.environ.get('TRANSCODE_WORKERS') or 1)
+    RENDITION_LADDER = [
+        {'height': 240, 'video_bitrate': 300, 'audio_bitrate': 64},
+        {'height': 480, 'video_bitrate': 900, 'audio_bitrate': 96},
+        {'height': 720, 'video_bitrate': 2200, 'audio_bitrate': 128},
+    ]
+
+    # Conversion en MP4 des formats non lisibles par les navigateurs (mkv/avi/mov/wmv)
+    CONVERT_WORKERS = int(os.environ.get('CONVERT_WORKERS') or 1)
+
+    # Sonde des médias (durée, codecs, résolution, débit) après l'upload
+    PROBE_WORKERS = int(os.environ.get('PROBE_WORKERS') or 2)
+
+    # Administration : transactions affichées par page
+    TRANSACTIONS_PER_PAGE = 50
+
+    # Profil SQLite appliqué à chaque connexion : WAL (les lectures ne sont plus
+    # bloquées par l'écriture en cours), attente du verrou au lieu d'une erreur
+    # immédiate « database is locked », cache et mmap par connexion
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT') or 5000),  # millisecondes
+        'synchronous': 'NORMAL',
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64000,  # valeur négative : en Kio (64 Mo)
+    }
+
+    # Pool de connexions PostgreSQL (par processus : prévoir workers x (taille + débordement)
+    # connexions côté serveur). pre_ping écarte les connexions coupées par un
+    # redémarrage ou un pgbouncer ; recycle les renouvelle avant les timeouts réseau.
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': int(os.environ.get('DATABASE_POOL_SIZE') or 10),
+        'max_overflow': int(os.environ.get('DATABASE_MAX_OVERFLOW') or 20),
+        'pool_timeout': 30,
+        'pool_pre_ping': True,
+        'pool_recycle': int(os.environ.get('DATABASE_POOL_RECYCLE') or 1800),  # secondes
+    } if SQLALCHEMY_DATABASE_URI.startswith('postgresql') else {}
+
+    # Unités de travail rejouées si la base reste verrouillée au-delà de busy_timeout
+    WRITE_RETRY_ATTEMPTS = 5
+    WRITE_RETRY_DELAY = 0.1  # secondes, doublé à chaque tentative
+
+    # Migrations en attente appliquées au démarrage de chaque processus
+    # (gunicorn, flask run) ; AUTO_MIGRATE=0 pour les lancer à part (flask upgrade-db)
+    AUTO_MIGRATE = (os.environ.get('AUTO_MIGRATE') or '1') != '0'
+
     @staticmethod
     def init_app(app):
         # Créer les dossiers d'upload s'ils n'existent pas
@@ -52,7 +155,9 @@ class Config:
             os.path.join(Config.UPLOAD_FOLDER, 'thumbnails'),
             os.path.join(Config.UPLOAD_FOLDER, 'films'),
             os.path.join(Config.UPLOAD_FOLDER, 'episodes'),
-            os.path.join(Config.UPLOAD_FOLDER, 'screenshots')
+            os.path.join(Config.UPLOAD_FOLDER, 'screenshots'),
+            os.path.join(Config.UPLOAD_FOLDER, 'hls'),
+            os.path.join(Config.UPLOAD_FOLDER, 'renditions')
         ]
         
         for folder in upload_folders:
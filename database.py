@@ -0,0 +1,65 @@
+import time
+import logging
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from models import db
+
+
+logger = logging.getLogger(__name__)
+
+
+def is_sqlite(database_uri):
+    return database_uri.startswith('sqlite')
+
+
+def apply_sqlite_profile(engine, pragmas):
+    """Applique les pragmas (WAL, busy_timeout...) à chaque nouvelle connexion du moteur"""
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+
+    event.listen(engine, 'connect', set_pragmas)
+
+
+def init_database(app):
+    """Profil de production du moteur de l'application (SQLite uniquement)"""
+    if is_sqlite(app.config['SQLALCHEMY_DATABASE_URI']):
+        with app.app_context():
+            apply_sqlite_profile(db.engine, app.config['SQLITE_PRAGMAS'])
+
+
+# Erreurs transitoires : verrou SQLite, interblocage ou conflit de sérialisation PostgreSQL
+RETRYABLE_ERRORS = ('database is locked', 'database is busy', 'deadlock detected', 'could not serialize access')
+
+
+def is_locked_error(error):
+    message = str(getattr(error, 'orig', error)).lower()
+    return any(marker in message for marker in RETRYABLE_ERRORS)
+
+
+def commit_with_retry(work):
+    """
+    Exécute l'unité de travail `work()` puis commit.
+
+    Si la base reste verrouillée au-delà de busy_timeout, la transaction est
+    annulée et `work` est rejouée en entier : après un rollback la session a
+    perdu ses modifications, `work` doit donc toutes les refaire. Retourne le
+    résultat de `work()`.
+    """
+    attempts = current_app.config.get('WRITE_RETRY_ATTEMPTS', 5)
+    delay = current_app.config.get('WRITE_RETRY_DELAY', 0.1)
+
+    for attempt in range(1, attempts + 1):
+        try:
+            result = work()
+            db.session.commit()
+            return result
+        except OperationalError as e:
+            db.session.rollback()
+            if not is_locked_error(e) or attempt == attempts:
+                raise
+            logger.warning(f"Base verrouillée, nouvelle tentative {attempt}/{attempts - 1}")
+            time.sleep(delay * 2 ** (attempt - 1))
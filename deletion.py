@@ -0,0 +1,88 @@
+import os
+from models import (db, Series, Season, Episode, Rendition, MediaJob, Transaction, AccessToken,
+                    TokenPurchase, UserEntitlement)
+from media_store import release_media_batch
+from transcoding import renditions_folder
+from reclaim import tombstone
+from stats import add_to_rollup
+
+
+def purge_seasons(upload_folder, season_ids, series_id=None):
+    """
+    Supprime des saisons (ou une série entière si `series_id` est donné) avec
+    des DELETE ensemblistes, dans la transaction courante.
+
+    Reproduit les cascades des modèles (épisodes, versions, tâches, achats et
+    droits de lecture ; transactions de la série) sans charger les lignes.
+    Aucun accès disque : fichiers vidéo libérés, versions, caches HLS et
+    vignette sont confiés aux tombstones. Retourne (ids des épisodes
+    supprimés, ids des clients dont les achats ont changé).
+    """
+    episodes = db.session.query(Episode.id, Episode.chemin).filter(Episode.season_id.in_(season_ids)).all()
+    episode_ids = [episode_id for episode_id, _ in episodes]
+    # Sous-requête plutôt qu'une liste d'ids : pas de limite de paramètres SQL
+    episode_scope = db.session.query(Episode.id).filter(Episode.season_id.in_(season_ids)).scalar_subquery()
+
+    purchase_filter = TokenPurchase.season_id.in_(season_ids)
+    if series_id is not None:
+        purchase_filter = purchase_filter | (TokenPurchase.series_id == series_id)
+    purchase_ids = db.session.query(TokenPurchase.id).filter(purchase_filter)
+    user_ids = [user_id for user_id, in db.session.query(AccessToken.user_id).distinct().join(
+        TokenPurchase, TokenPurchase.token_id == AccessToken.id
+    ).filter(purchase_filter)]
+
+    UserEntitlement.query.filter(UserEntitlement.purchase_id.in_(purchase_ids.scalar_subquery())).delete(
+        synchronize_session=False
+    )
+    TokenPurchase.query.filter(purchase_filter).delete(synchronize_session=False)
+
+    if episode_ids:
+        rendition_paths = [os.path.join(renditions_folder(upload_folder), chemin)
+                           for chemin, in db.session.query(Rendition.chemin).filter(
+                               Rendition.episode_id.in_(episode_scope), Rendition.chemin != None)]
+        tombstone(upload_folder, rendition_paths)
+        release_media_batch(upload_folder, 'episodes', [chemin for _, chemin in episodes])
+
+        Rendition.query.filter(Rendition.episode_id.in_(episode_scope)).delete(synchronize_session=False)
+        MediaJob.query.filter(MediaJob.episode_id.in_(episode_scope)).delete(synchronize_session=False)
+        Episode.query.filter(Episode.season_id.in_(season_ids)).delete(synchronize_session=False)
+
+    Season.query.filter(Season.id.in_(season_ids)).delete(synchronize_session=False)
+
+    if series_id is not None:
+        delete_transactions(Transaction.series_id == series_id)
+        thumbnail, = db.session.query(Series.thumbnail).filter(Series.id == series_id).one()
+        if thumbnail:
+            tombstone(upload_folder, [os.path.join(upload_folder, 'thumbnails', thumbnail)])
+        Series.query.filter(Series.id == series_id).delete(synchronize_session=False)
+
+    # Objets éventuellement chargés dans la session : ne plus les écrire
+    db.session.expire_all()
+    return episode_ids, user_ids
+
+
+def delete_transactions(criterion):
+    """
+    Transactions d'un contenu supprimé (cascade des modèles Film et Series),
+    retirées aussi des agrégats de TransactionRollup
+    """
+    rows = db.session.query(
+        Transaction.transaction_date, Transaction.status, Transaction.payment_method, Transaction.amount
+    ).filter(criterion).all()
+
+    deltas = {}
+    for transaction_date, status, payment_method, amount in rows:
+        if transaction_date is None:
+            continue
+        key = (transaction_date.date(), status or 'pending', payment_method)
+        count, total = deltas.get(key, (0, 0))
+        deltas[key] = (count + 1, total + (amount or 0))
+    for (day, status, payment_method), (count, total) in deltas.items():
+        add_to_rollup(day, status, payment_method, -count, -total)
+
+    Transaction.query.filter(criterion).delete(synchronize_session=False)
+
+
+def purge_series(upload_folder, series_id):
+    season_ids = [season_id for season_id, in db.session.query(Season.id).filter(Season.series_id == series_id)]
+    return purge_seasons(upload_folder, season_ids, series_id=series_id)
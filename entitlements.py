@@ -0,0 +1,156 @@
+import time
+import threading
+from datetime import datetime
+from collections import OrderedDict
+from sqlalchemy import and_, insert, literal, select
+from models import db, AccessToken, TokenPurchase, UserEntitlement
+
+
+class EntitlementCache:
+    """
+    Cache mémoire des droits de lecture, clé (utilisateur, type, contenu).
+
+    Chaque entrée expire après `ttl` secondes ; les écritures qui changent les
+    droits (confirmation de transaction, création de compte client) ou les
+    fichiers d'un contenu (édition, suppression) l'invalident explicitement.
+    Le cache est propre au processus : sous gunicorn, les autres workers
+    s'alignent au plus tard à l'expiration du TTL.
+    """
+
+    def __init__(self, ttl=60, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id, content_type, content_id):
+        key = (user_id, content_type, content_id)
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires_at, entry = item
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, user_id, content_type, content_id, entry):
+        key = (user_id, content_type, content_id)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, entry)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == user_id]:
+                del self._entries[key]
+
+    def invalidate_content(self, content_type, content_id):
+        with self._lock:
+            for key in [key for key in self._entries if key[1:] == (content_type, content_id)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def purchase_content(purchase):
+    """(type, id) du contenu donné par un achat : un film ou une saison entière"""
+    if purchase.film_id:
+        return 'film', purchase.film_id
+    if purchase.series_id and purchase.season_id:
+        return 'season', purchase.season_id
+    return None
+
+
+def grant_purchase(access_token, purchase):
+    """
+    Crée le droit de lecture d'un achat, dans la même transaction.
+
+    À appeler partout où un TokenPurchase est créé (le token doit déjà avoir
+    un id et un user_id).
+    """
+    content = purchase_content(purchase)
+    if content is None:
+        return None
+    purchase.entitlement = UserEntitlement(
+        user_id=access_token.user_id,
+        content_type=content[0],
+        content_id=content[1],
+        expiry_date=access_token.expiry_date
+    )
+    return purchase.entitlement
+
+
+def active_entitlements(user_id):
+    """Droits de lecture non expirés d'un utilisateur, tous tokens confondus"""
+    return UserEntitlement.query.filter(
+        UserEntitlement.user_id == user_id,
+        (UserEntitlement.expiry_date == None) |
+        (UserEntitlement.expiry_date >= datetime.utcnow())
+    )
+
+
+def has_entitlement(user_id, content_type, content_id):
+    """Recherche indexée (user_id, content_type, content_id, expiry_date)"""
+    return db.session.query(
+        active_entitlements(user_id).filter(
+            UserEntitlement.content_type == content_type,
+            UserEntitlement.content_id == content_id
+        ).exists()
+    ).scalar()
+
+
+def can_watch_film(user_id, film_id):
+    return has_entitlement(user_id, 'film', film_id)
+
+
+def can_watch_episode(user_id, episode):
+    return has_entitlement(user_id, 'season', episode.season_id)
+
+
+def insert_entitlements(purchase_filter=None):
+    """Deux INSERT ... SELECT (films, saisons) des droits des achats filtrés"""
+    columns = ['user_id', 'content_type', 'content_id', 'purchase_id', 'expiry_date']
+    sources = (
+        ('film', TokenPurchase.film_id, TokenPurchase.film_id != None),
+        ('season', TokenPurchase.season_id, and_(
+            TokenPurchase.film_id == None,
+            TokenPurchase.series_id != None,
+            TokenPurchase.season_id != None
+        )),
+    )
+    for content_type, content_column, condition in sources:
+        rows = select(
+            AccessToken.user_id, literal(content_type), content_column,
+            TokenPurchase.id, AccessToken.expiry_date
+        ).join(AccessToken, TokenPurchase.token_id == AccessToken.id).where(condition)
+        if purchase_filter is not None:
+            rows = rows.where(purchase_filter)
+        db.session.execute(insert(UserEntitlement).from_select(columns, rows))
+
+
+def grant_token_purchases(token_ids):
+    """
+    Version ensembliste de grant_purchase : crée les droits de tous les achats
+    des tokens, insérés en masse dans la même transaction.
+    """
+    insert_entitlements(TokenPurchase.token_id.in_(token_ids))
+
+
+def rebuild_entitlements():
+    """
+    Reconstruit toute la table à partir des tokens et achats existants.
+
+    Sert au remplissage initial d'une base existante. Retourne le nombre de
+    droits créés.
+    """
+    db.session.query(UserEntitlement).delete(synchronize_session=False)
+    insert_entitlements()
+    db.session.commit()
+    return UserEntitlement.query.count()
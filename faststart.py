@@ -0,0 +1,89 @@
+import os
+import struct
+import subprocess
+
+
+def iter_top_level_atoms(file_path):
+    """Parcourt les atomes de premier niveau d'un MP4 : (type, position, taille)"""
+    file_size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as f:
+        offset = 0
+        while offset + 8 <= file_size:
+            f.seek(offset)
+            size, kind = struct.unpack('>I4s', f.read(8))
+            header_size = 8
+            if size == 1:
+                # Taille étendue sur 64 bits
+                size = struct.unpack('>Q', f.read(8))[0]
+                header_size = 16
+            elif size == 0:
+                # Dernier atome : s'étend jusqu'à la fin du fichier
+                size = file_size - offset
+            if size < header_size:
+                break
+            yield kind.decode('latin-1'), offset, size
+            offset += size
+
+
+def needs_faststart(file_path):
+    """Vrai si l'atome moov est placé après mdat (lecture lente au démarrage)"""
+    try:
+        for kind, _, _ in iter_top_level_atoms(file_path):
+            if kind == 'moov':
+                return False
+            if kind == 'mdat':
+                return True
+    except (OSError, struct.error):
+        pass
+    return False
+
+
+def rewrite_faststart(file_path, ffmpeg='ffmpeg', output_path=None):
+    """
+    Réécrit un MP4 avec l'atome moov en tête, sans réencodage.
+
+    Le résultat est écrit à côté de la destination (l'original par défaut),
+    synchronisé sur disque puis substitué par os.replace() : en cas d'arrêt
+    brutal, on garde soit l'ancien fichier, soit le nouveau, jamais un
+    fichier partiel. Les lectures en cours continuent sur l'ancien inode
+    jusqu'à leur fin.
+    """
+    output_path = output_path or file_path
+    tmp_path = output_path + '.faststart.part'
+    cmd = [
+        ffmpeg, '-v', 'error', '-y', '-i', file_path,
+        '-map', '0', '-c', 'copy', '-movflags', '+faststart',
+        '-f', 'mp4', tmp_path
+    ]
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise RuntimeError(result.stderr.strip() or f"ffmpeg a échoué ({result.returncode})")
+
+    with open(tmp_path, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, output_path)
+
+    # Rendre le renommage durable
+    dir_fd = os.open(os.path.dirname(os.path.abspath(output_path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def is_faststart_candidate(file_path):
+    return file_path.lower().endswith(('.mp4', '.m4v')) and needs_faststart(file_path)
+
+
+def ensure_faststart(file_path, ffmpeg='ffmpeg'):
+    """
+    Réécrit le fichier sur place si nécessaire ; retourne True s'il a été
+    modifié. Pas pour le stockage partagé : le nom d'un fichier y est son
+    empreinte (voir jobs.faststart_content).
+    """
+    if not is_faststart_candidate(file_path):
+        return False
+    rewrite_faststart(file_path, ffmpeg)
+    return True
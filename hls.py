@@ -0,0 +1,88 @@
+import os
+import json
+import shutil
+import subprocess
+import tempfile
+
+
+PLAYLIST_NAME = 'index.m3u8'
+STAMP_NAME = 'source.json'
+
+def hls_directory(upload_folder, source_path):
+    """
+    Dossier du cache de segments HLS d'un fichier vidéo.
+
+    Indexé par le fichier source (uploads/hls/blobs/ab/<sha256>.mp4/...) et
+    non par l'id du film ou de l'épisode, que SQLite peut réattribuer : un
+    fichier remplacé a un nouveau cache, et l'ancien part avec son fichier.
+    """
+    return os.path.join(upload_folder, 'hls', os.path.relpath(source_path, upload_folder))
+
+
+def source_stamp(source_path):
+    """Empreinte (nom, taille, mtime) du fichier source, pour invalider le cache"""
+    stat = os.stat(source_path)
+    return {
+        'source': os.path.basename(source_path),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns
+    }
+
+
+def is_packaged(output_dir, source_path):
+    """Vérifie que le cache HLS existe et correspond au fichier source actuel"""
+    stamp_path = os.path.join(output_dir, STAMP_NAME)
+    if not os.path.exists(os.path.join(output_dir, PLAYLIST_NAME)) or not os.path.exists(stamp_path):
+        return False
+    try:
+        with open(stamp_path, 'r', encoding='utf-8') as f:
+            return json.load(f) == source_stamp(source_path)
+    except (OSError, json.JSONDecodeError):
+        return False
+
+
+def package_hls(source_path, output_dir, segment_duration=6, ffmpeg='ffmpeg'):
+    """
+    Découpe une vidéo en segments HLS (.ts) avec leur playlist VOD.
+
+    Les flux sont copiés sans réencodage. Le découpage se fait dans un dossier
+    temporaire voisin qui remplace le cache existant une fois terminé, pour
+    qu'un lecteur ne voie jamais une playlist incomplète.
+    """
+    parent_dir = os.path.dirname(output_dir)
+    os.makedirs(parent_dir, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix='.hls-', dir=parent_dir)
+
+    try:
+        cmd = [
+            ffmpeg, '-v', 'error', '-y', '-i', source_path,
+            '-map', '0:v:0', '-map', '0:a:0?',
+            '-c', 'copy',
+            '-f', 'hls',
+            '-hls_time', str(segment_duration),
+            '-hls_playlist_type', 'vod',
+            '-hls_segment_filename', os.path.join(work_dir, 'seg_%05d.ts'),
+            os.path.join(work_dir, PLAYLIST_NAME)
+        ]
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip() or f"ffmpeg a échoué ({result.returncode})")
+
+        with open(os.path.join(work_dir, STAMP_NAME), 'w', encoding='utf-8') as f:
+            json.dump(source_stamp(source_path), f)
+
+        # Remplacer l'ancien cache par le nouveau
+        if os.path.exists(output_dir):
+            old_dir = output_dir + '.old'
+            shutil.rmtree(old_dir, ignore_errors=True)
+            os.rename(output_dir, old_dir)
+            os.rename(work_dir, output_dir)
+            shutil.rmtree(old_dir, ignore_errors=True)
+        else:
+            os.rename(work_dir, output_dir)
+    except Exception:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise
+
+    return output_dir
+
@@ -0,0 +1,281 @@
+import os
+import time
+import shutil
+import uuid
+import logging
+import tempfile
+import subprocess
+import multiprocessing
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy import create_engine, text
+from models import db, Film, Episode, MediaJob
+from transcoding import build_renditions, get_executor, schedule_renditions
+from faststart import ensure_faststart, is_faststart_candidate, rewrite_faststart
+from hls import hls_directory, is_packaged, package_hls
+from probing import probe_media, schedule_probe
+from media_store import BLOB_PREFIX, media_path, store_file, release_media
+from reclaim import schedule_reclaim
+from database import is_sqlite, apply_sqlite_profile
+from catalog import bump_catalog_version, content_changes
+
+
+logger = logging.getLogger(__name__)
+
+# Extensions lisibles directement par la balise <video> des navigateurs
+BROWSER_VIDEO_EXTENSIONS = {'mp4'}
+
+# Intervalle minimal entre deux mises à jour de progression (secondes)
+PROGRESS_INTERVAL = 2.0
+
+_pool = None
+
+
+def get_pool(app):
+    """Pool de processus de conversion (démarré à la première tâche)"""
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(
+            max_workers=app.config.get('CONVERT_WORKERS', 1),
+            mp_context=multiprocessing.get_context('spawn')
+        )
+    return _pool
+
+
+def needs_conversion(filename):
+    """Vrai si le fichier doit être converti en MP4 pour être lu dans le navigateur"""
+    return filename.rsplit('.', 1)[-1].lower() not in BROWSER_VIDEO_EXTENSIONS
+
+
+def run_conversion(job_id, database_uri, source_path, output_path, ffmpeg='ffmpeg', ffprobe='ffprobe',
+                   sqlite_pragmas=None):
+    """
+    Convertit une vidéo en MP4 H.264/AAC avec l'atome moov en tête.
+
+    Exécuté dans un processus du pool : la progression est écrite directement
+    dans media_jobs par une connexion propre au processus. Si les flux sont
+    déjà en H.264/AAC, ils sont simplement remultiplexés (copie sans perte).
+    """
+    engine = create_engine(database_uri)
+    if sqlite_pragmas and is_sqlite(database_uri):
+        apply_sqlite_profile(engine, sqlite_pragmas)
+
+    def report(**values):
+        assignments = ', '.join(f"{key} = :{key}" for key in values)
+        with engine.begin() as conn:
+            conn.execute(text(f"UPDATE media_jobs SET {assignments} WHERE id = :job_id"),
+                         dict(values, job_id=job_id))
+
+    report(status='running', progress=0.0)
+
+    info = probe_media(source_path, ffprobe) or {}
+    duration = info.get('duration')
+    remux = info.get('video_codec') == 'h264' and info.get('audio_codec') in ('aac', None)
+
+    cmd = [ffmpeg, '-v', 'error', '-y', '-nostats', '-progress', 'pipe:1',
+           '-i', source_path, '-map', '0:v:0', '-map', '0:a:0?']
+    if remux:
+        cmd += ['-c', 'copy']
+    else:
+        cmd += ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23', '-pix_fmt', 'yuv420p',
+                '-c:a', 'aac', '-b:a', '128k', '-ac', '2']
+    tmp_path = output_path + '.part'
+    cmd += ['-movflags', '+faststart', '-f', 'mp4', tmp_path]
+
+    with tempfile.TemporaryFile(mode='w+') as stderr:
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr, text=True)
+        last_report = 0.0
+        for line in process.stdout:
+            key, _, value = line.strip().partition('=')
+            # out_time_us (out_time_ms est aussi en microsecondes malgré son nom)
+            if key in ('out_time_us', 'out_time_ms') and duration and value.isdigit():
+                now = time.monotonic()
+                if now - last_report >= PROGRESS_INTERVAL:
+                    last_report = now
+                    report(progress=min(99.0, int(value) / 1e6 / duration * 100))
+        returncode = process.wait()
+
+        if returncode != 0:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            stderr.seek(0)
+            raise RuntimeError(stderr.read().strip() or f"ffmpeg a échoué ({returncode})")
+
+    os.replace(tmp_path, output_path)
+    engine.dispose()
+    return output_path
+
+
+def content_folder(content_type):
+    return 'films' if content_type == 'film' else 'episodes'
+
+
+def get_content(content_type, content_id):
+    return Film.query.get(content_id) if content_type == 'film' else Episode.query.get(content_id)
+
+
+def finish_conversion(app, job_id, content_type, content_id, output_filename, future):
+    """
+    Rappel de fin de tâche : remplace `chemin` par le MP4 converti.
+
+    Le MP4 converti est rangé dans le stockage partagé, puis `chemin` est
+    mis à jour et la référence sur l'ancien fichier est libérée dans le même
+    commit.
+    """
+    upload_folder = app.config['UPLOAD_FOLDER']
+    folder = content_folder(content_type)
+    output_path = os.path.join(upload_folder, folder, output_filename)
+
+    with app.app_context():
+        job = MediaJob.query.get(job_id)
+        try:
+            future.result()
+        except Exception as e:
+            logger.error(f"Conversion {content_type} {content_id} impossible : {e}")
+            if job:
+                job.status = 'failed'
+                job.error = str(e)
+                db.session.commit()
+            return
+
+        content = get_content(content_type, content_id)
+        # Contenu supprimé ou fichier remplacé entre-temps : abandonner le résultat
+        if not job or not content or content.chemin != job.source:
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            if job:
+                job.status = 'failed'
+                job.error = "Le fichier source a changé pendant la conversion"
+                db.session.commit()
+            return
+
+        old_chemin = content.chemin
+        content.chemin = store_file(upload_folder, output_path)
+        release_media(upload_folder, folder, old_chemin)
+        job.status = 'done'
+        job.progress = 100.0
+        bump_catalog_version(*content_changes(content_type, [content_id]))
+        db.session.commit()
+    schedule_reclaim(app)
+
+    # Nouvelle sonde, segments HLS et versions basse résolution à partir du MP4 converti
+    schedule_probe(app, content_type, content_id)
+    get_executor(app).submit(package_content, app, content_type, content_id)
+    schedule_renditions(app, content_type, content_id)
+
+
+def enqueue_conversion(app, content_type, content):
+    """Crée une tâche de conversion pour un film ou un épisode (après commit)"""
+    job = MediaJob(source=content.chemin, status='queued', progress=0.0)
+    content.jobs.append(job)
+    db.session.commit()
+
+    upload_folder = app.config['UPLOAD_FOLDER']
+    folder = content_folder(content_type)
+    base_name = os.path.splitext(os.path.basename(content.chemin))[0].split('_', 1)[-1]
+    output_filename = f"{uuid.uuid4()}_{base_name}.mp4"
+
+    future = get_pool(app).submit(
+        run_conversion, job.id, app.config['SQLALCHEMY_DATABASE_URI'],
+        media_path(upload_folder, folder, content.chemin), os.path.join(upload_folder, folder, output_filename),
+        app.config['FFMPEG_BINARY'], app.config['FFPROBE_BINARY'], app.config['SQLITE_PRAGMAS']
+    )
+    future.add_done_callback(partial(finish_conversion, app, job.id, content_type, content.id, output_filename))
+    return job
+
+
+def faststart_content(app, content_type, content_id):
+    """
+    Place l'atome moov en tête du fichier d'un film ou d'un épisode.
+
+    Un fichier du stockage partagé n'est jamais réécrit sur place (son nom
+    est l'empreinte de son contenu) : la version faststart devient un nouveau
+    fichier partagé vers lequel le contenu est basculé, comme après une
+    conversion. Retourne True si le fichier a changé.
+    """
+    upload_folder = app.config['UPLOAD_FOLDER']
+    folder = content_folder(content_type)
+    with app.app_context():
+        content = get_content(content_type, content_id)
+        if not content:
+            return False
+        chemin = content.chemin
+    file_path = media_path(upload_folder, folder, chemin)
+
+    if not chemin.startswith(BLOB_PREFIX):
+        return ensure_faststart(file_path, app.config['FFMPEG_BINARY'])
+    if not is_faststart_candidate(file_path):
+        return False
+
+    tmp_dir = os.path.join(upload_folder, BLOB_PREFIX, 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    output_path = os.path.join(tmp_dir, f"{uuid.uuid4()}{os.path.splitext(chemin)[1]}")
+    rewrite_faststart(file_path, app.config['FFMPEG_BINARY'], output_path=output_path)
+
+    with app.app_context():
+        content = get_content(content_type, content_id)
+        # Contenu supprimé ou fichier remplacé entre-temps : abandonner le résultat
+        if not content or content.chemin != chemin:
+            os.remove(output_path)
+            return False
+        content.chemin = store_file(upload_folder, output_path)
+        release_media(upload_folder, folder, chemin)
+        bump_catalog_version(*content_changes(content_type, [content_id]))
+        db.session.commit()
+    schedule_reclaim(app)
+    return True
+
+
+def package_content(app, content_type, content_id):
+    """
+    Découpe HLS du fichier actuel d'un film ou d'un épisode.
+
+    Le cache est indexé par fichier source : après un remplacement ou une
+    conversion, le nouveau fichier est découpé et l'ancien cache part avec
+    l'ancien fichier. Retourne True si un découpage a eu lieu.
+    """
+    upload_folder = app.config['UPLOAD_FOLDER']
+    with app.app_context():
+        content = get_content(content_type, content_id)
+        if not content or needs_conversion(content.chemin):
+            return False
+        source_path = media_path(upload_folder, content_folder(content_type), content.chemin)
+
+    output_dir = hls_directory(upload_folder, source_path)
+    if not os.path.exists(source_path) or is_packaged(output_dir, source_path):
+        return False
+    try:
+        package_hls(source_path, output_dir,
+                    segment_duration=app.config['HLS_SEGMENT_DURATION'],
+                    ffmpeg=app.config['FFMPEG_BINARY'])
+    except Exception as e:
+        logger.error(f"Découpage HLS de {content_type} {content_id} impossible : {e}")
+        return False
+
+    # Fichier récupéré pendant le découpage : le cache ne servirait plus
+    if not os.path.exists(source_path):
+        shutil.rmtree(output_dir, ignore_errors=True)
+        return False
+    return True
+
+
+def prepare_browser_upload(app, content_type, content_id):
+    """MP4 déjà lisible : placer moov en tête, découper en HLS, puis générer les versions"""
+    try:
+        if faststart_content(app, content_type, content_id):
+            logger.info(f"{content_type} {content_id} réécrit en faststart")
+    except Exception as e:
+        logger.error(f"Réécriture faststart de {content_type} {content_id} impossible : {e}")
+
+    package_content(app, content_type, content_id)
+
+    build_renditions(app, content_type, content_id)
+
+
+def schedule_media_processing(app, content_type, content):
+    """Après un upload : sonde, puis conversion si nécessaire, sinon faststart et génération des versions"""
+    schedule_probe(app, content_type, content.id)
+    if needs_conversion(content.chemin):
+        enqueue_conversion(app, content_type, content)
+    else:
+        get_executor(app).submit(prepare_browser_upload, app, content_type, content.id)
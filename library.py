@@ -0,0 +1,120 @@
+import time
+import threading
+from datetime import datetime
+from collections import OrderedDict
+from sqlalchemy import func
+from models import db, Film, Series, Season, Episode, UserEntitlement
+from entitlements import active_entitlements
+from catalog import current_catalog_version
+
+
+class LibraryCache:
+    """
+    Bibliothèque rendue (HTML et compteurs) de chaque client, clé user_id.
+
+    Une entrée expire après `ttl` secondes, ou plus tôt si l'un des droits
+    affichés expire avant. Chaque entrée porte l'empreinte en base
+    (library_stamp) avec laquelle elle a été rendue et n'est servie que si
+    l'empreinte n'a pas changé : une modification faite par un autre
+    processus, la sonde ou une conversion l'invalide aussi. invalidate_user
+    et clear libèrent la mémoire du processus courant.
+    """
+
+    def __init__(self, ttl=300, max_size=2000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id, stamp):
+        with self._lock:
+            item = self._entries.get(user_id)
+            if item is None:
+                return None
+            expires_at, entry_stamp, library = item
+            if expires_at <= time.monotonic() or entry_stamp != stamp:
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return library
+
+    def set(self, user_id, library, stamp, expires_in=None):
+        ttl = self.ttl if expires_in is None else min(self.ttl, expires_in)
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + ttl, stamp, library)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def library_stamp(user_id):
+    """
+    Empreinte en base de la bibliothèque d'un client : version du catalogue
+    et état de ses droits (nombre, dernier id, bornes d'expiration). Elle
+    change avec tout contenu modifié et tout achat ajouté, retiré ou prolongé.
+    """
+    entitlements = db.session.query(
+        func.count(UserEntitlement.id), func.max(UserEntitlement.id),
+        func.min(UserEntitlement.expiry_date), func.max(UserEntitlement.expiry_date)
+    ).filter(UserEntitlement.user_id == user_id).one()
+    return (current_catalog_version(),) + tuple(entitlements)
+
+
+def load_library(user_id, now=None):
+    """
+    Films et séries accessibles au client, en cinq requêtes quel que soit le
+    nombre d'achats : droits actifs, puis films, saisons, séries et épisodes
+    avec une requête IN chacun.
+
+    Retourne (films, séries, secondes avant la première expiration ou None) ;
+    les séries ont la forme attendue par client/_library.html. Retourne None
+    si le client n'a aucun droit actif.
+    """
+    now = now or datetime.utcnow()
+    rows = active_entitlements(user_id).with_entities(
+        UserEntitlement.content_type, UserEntitlement.content_id, UserEntitlement.expiry_date
+    ).order_by(UserEntitlement.id).all()
+    if not rows:
+        return None
+
+    # Ordre d'achat conservé, doublons (plusieurs tokens) retirés
+    film_ids = list(dict.fromkeys(content_id for content_type, content_id, _ in rows if content_type == 'film'))
+    season_ids = list(dict.fromkeys(content_id for content_type, content_id, _ in rows if content_type == 'season'))
+    expiries = [expiry_date for _, _, expiry_date in rows if expiry_date is not None]
+    expires_in = (min(expiries) - now).total_seconds() if expiries else None
+
+    films_by_id = {film.id: film for film in Film.query.filter(Film.id.in_(film_ids))} if film_ids else {}
+    films = [films_by_id[film_id] for film_id in film_ids if film_id in films_by_id]
+
+    series = []
+    if season_ids:
+        seasons = {season.id: season for season in Season.query.filter(Season.id.in_(season_ids))}
+        series_by_id = {s.id: s for s in Series.query.filter(
+            Series.id.in_({season.series_id for season in seasons.values()})
+        )}
+        episodes = {}
+        for episode in Episode.query.filter(Episode.season_id.in_(list(seasons))).order_by(
+                Episode.season_id, Episode.episode_number):
+            episodes.setdefault(episode.season_id, []).append(episode)
+
+        grouped = OrderedDict()
+        for season_id in season_ids:
+            season = seasons.get(season_id)
+            series_obj = series_by_id.get(season.series_id) if season else None
+            if series_obj is None:
+                continue
+            grouped.setdefault(series_obj.id, {'series': series_obj, 'seasons': []})['seasons'].append({
+                'season': season,
+                'episodes': episodes.get(season_id, [])
+            })
+        series = list(grouped.values())
+
+    return films, series, expires_in
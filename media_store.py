@@ -0,0 +1,205 @@
+import os
+import uuid
+import hashlib
+from collections import Counter
+from sqlalchemy import tuple_
+from sqlalchemy.exc import IntegrityError
+from models import db, MediaBlob
+from hls import hls_directory
+from reclaim import tombstone, lock_blob
+
+
+# Les `chemin` du stockage adressé par contenu commencent par ce préfixe ;
+# les anciens `chemin` restent des noms de fichiers dans films/ ou episodes/
+BLOB_PREFIX = 'blobs/'
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def media_path(upload_folder, folder, chemin):
+    """Chemin disque d'un fichier vidéo, qu'il soit dans le stockage partagé ou non"""
+    if chemin.startswith(BLOB_PREFIX):
+        return os.path.join(upload_folder, chemin)
+    return os.path.join(upload_folder, folder, chemin)
+
+
+def blob_chemin(digest, extension):
+    return f"{BLOB_PREFIX}{digest[:2]}/{digest}{extension}"
+
+
+def split_blob_chemin(chemin):
+    """Retourne (sha256, extension) d'un `chemin` du stockage partagé"""
+    digest, extension = os.path.splitext(os.path.basename(chemin))
+    return digest, extension
+
+
+def file_extension(filename):
+    return os.path.splitext(filename)[1].lower()
+
+
+def hash_file(path):
+    """SHA-256 d'un fichier déjà sur disque (lecture séquentielle)"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def place_blob(upload_folder, tmp_path, digest, extension):
+    """
+    Range un fichier fraîchement écrit dans le stockage, sans toucher à la base.
+
+    Si un fichier identique existe déjà, le nouveau est supprimé : le contenu
+    n'est conservé qu'une fois sur disque. Retourne le `chemin` à enregistrer.
+    """
+    chemin = blob_chemin(digest, extension)
+    final_path = os.path.join(upload_folder, chemin)
+
+    if os.path.exists(final_path):
+        os.remove(tmp_path)
+    else:
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        os.replace(tmp_path, final_path)
+    return chemin
+
+
+def acquire_media(upload_folder, chemin):
+    """
+    Compte une référence sur un fichier du stockage partagé.
+
+    Écritures en base uniquement : peut être rejoué dans une unité de travail
+    (database.commit_with_retry) après un rollback. Le verrou du fichier est
+    partagé avec reclaim_tombstones, qui ne supprime jamais un fichier
+    référencé de nouveau ; si le fichier a été récupéré juste avant (plus
+    aucune référence au moment de placer l'upload), getsize échoue et la
+    requête est annulée plutôt que d'enregistrer un fichier absent.
+    """
+    digest, extension = split_blob_chemin(chemin)
+    lock_blob(digest)
+    updated = MediaBlob.query.filter_by(sha256=digest, extension=extension).update(
+        {'ref_count': MediaBlob.ref_count + 1}, synchronize_session=False
+    )
+    if updated:
+        return chemin
+
+    size = os.path.getsize(os.path.join(upload_folder, chemin))
+    try:
+        with db.session.begin_nested():
+            db.session.add(MediaBlob(sha256=digest, extension=extension, size=size, ref_count=1))
+    except IntegrityError:
+        # Même contenu enregistré en parallèle par une autre requête
+        MediaBlob.query.filter_by(sha256=digest, extension=extension).update(
+            {'ref_count': MediaBlob.ref_count + 1}, synchronize_session=False
+        )
+    return chemin
+
+
+def place_stream(upload_folder, stream, filename):
+    """
+    Enregistre un fichier uploadé en calculant son empreinte au fil de l'écriture.
+
+    Remplace `file.save()` : une seule écriture sur disque, puis rangement
+    (ou dédoublonnage) dans le stockage partagé. La référence est comptée
+    séparément par `acquire_media`.
+    """
+    extension = file_extension(filename)
+    tmp_dir = os.path.join(upload_folder, BLOB_PREFIX, 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    tmp_path = os.path.join(tmp_dir, f"{uuid.uuid4()}{extension}.part")
+
+    digest = hashlib.sha256()
+    try:
+        with open(tmp_path, 'wb') as f:
+            for block in iter(lambda: stream.read(HASH_BLOCK_SIZE), b''):
+                digest.update(block)
+                f.write(block)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    return place_blob(upload_folder, tmp_path, digest.hexdigest(), extension)
+
+
+def place_file(upload_folder, path):
+    """Range un fichier déjà présent sur disque (upload par morceaux, conversion)"""
+    return place_blob(upload_folder, path, hash_file(path), file_extension(path))
+
+
+def store_stream(upload_folder, stream, filename):
+    """place_stream + acquire_media"""
+    return acquire_media(upload_folder, place_stream(upload_folder, stream, filename))
+
+
+def store_file(upload_folder, path):
+    """place_file + acquire_media"""
+    return acquire_media(upload_folder, place_file(upload_folder, path))
+
+
+def discard_media(upload_folder, chemin):
+    """
+    Abandonne un fichier rangé par place_stream/place_file (ou claim_upload)
+    sans référence enregistrée : la requête a échoué ou l'upload est abandonné.
+
+    Confié aux tombstones ; un fichier identique référencé entre-temps par un
+    autre contenu reste sur disque (voir reclaim_tombstones).
+    """
+    if chemin and chemin.startswith(BLOB_PREFIX):
+        tombstone(upload_folder, [os.path.join(upload_folder, chemin)])
+
+
+def release_media(upload_folder, folder, chemin):
+    """
+    Libère la référence d'un film/épisode sur son fichier vidéo.
+
+    Pour le stockage partagé, le fichier n'est supprimé qu'avec sa dernière
+    référence ; les anciens fichiers hors stockage le sont directement. Voir
+    release_media_batch : la suppression a lieu après le commit.
+    """
+    if chemin:
+        release_media_batch(upload_folder, folder, [chemin])
+
+
+def release_media_batch(upload_folder, folder, chemins):
+    """
+    Version ensembliste de release_media, sans accès disque.
+
+    Décrémente les références de tous les fichiers partagés en quelques
+    requêtes et supprime les lignes tombées à zéro. Les fichiers libérés sont
+    confiés aux tombstones avec leur cache HLS : ils ne quittent le disque
+    qu'une fois la transaction validée (reclaim.schedule_reclaim après le
+    commit), jamais si elle est annulée. Retourne leurs chemins.
+    """
+    paths = [os.path.join(upload_folder, folder, chemin)
+             for chemin in chemins if chemin and not chemin.startswith(BLOB_PREFIX)]
+    blobs = Counter(split_blob_chemin(chemin) for chemin in chemins if chemin and chemin.startswith(BLOB_PREFIX))
+    if not blobs:
+        tombstone_media(upload_folder, paths)
+        return paths
+
+    # Une requête par valeur de décrément (presque toujours 1)
+    by_count = {}
+    for key, count in blobs.items():
+        by_count.setdefault(count, []).append(key)
+    for count, keys in by_count.items():
+        MediaBlob.query.filter(tuple_(MediaBlob.sha256, MediaBlob.extension).in_(keys)).update(
+            {'ref_count': MediaBlob.ref_count - count}, synchronize_session=False
+        )
+
+    released = MediaBlob.query.filter(
+        tuple_(MediaBlob.sha256, MediaBlob.extension).in_(list(blobs)), MediaBlob.ref_count <= 0
+    ).with_entities(MediaBlob.id, MediaBlob.sha256, MediaBlob.extension).all()
+    if released:
+        MediaBlob.query.filter(MediaBlob.id.in_([blob_id for blob_id, _, _ in released])).delete(
+            synchronize_session=False
+        )
+    paths += [os.path.join(upload_folder, blob_chemin(digest, extension)) for _, digest, extension in released]
+    tombstone_media(upload_folder, paths)
+    return paths
+
+
+def tombstone_media(upload_folder, paths):
+    """Tombstones des fichiers vidéo libérés et de leurs caches HLS"""
+    tombstone(upload_folder, paths)
+    tombstone(upload_folder, [hls_directory(upload_folder, path) for path in paths], is_directory=True)
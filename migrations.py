@@ -0,0 +1,225 @@
+import os
+from datetime import datetime
+from contextlib import contextmanager
+from sqlalchemy import inspect, text
+from models import db
+
+try:
+    import fcntl
+except ImportError:  # Windows : pas de verrou entre processus
+    fcntl = None
+
+
+# Migrations versionnées, appliquées dans l'ordre et une seule fois par base
+# (table schema_migrations). db.create_all() crée les nouvelles tables mais ne
+# modifie jamais les tables existantes : colonnes et index ajoutés aux modèles
+# doivent aussi être livrés ici pour les bases déjà déployées.
+MIGRATIONS = []
+
+
+def migration(version, description):
+    def decorator(func):
+        MIGRATIONS.append((version, description, func))
+        return func
+    return decorator
+
+
+def column_names(table):
+    return {column['name'] for column in inspect(db.session.connection()).get_columns(table)}
+
+
+def add_column(table, column, ddl):
+    """ALTER TABLE ... ADD COLUMN, sauf si la colonne existe déjà"""
+    if column not in column_names(table):
+        db.session.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+
+def create_index(name, table, columns):
+    db.session.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"))
+
+
+@migration(1, "Index secondaires des accès, achats, transactions et épisodes")
+def add_secondary_indexes():
+    create_index('ix_token_purchases_token_film', 'token_purchases', ['token_id', 'film_id'])
+    create_index('ix_token_purchases_token_season', 'token_purchases', ['token_id', 'series_id', 'season_id'])
+    create_index('ix_access_tokens_user_expiry', 'access_tokens', ['user_id', 'expiry_date'])
+    create_index('ix_transactions_status_date', 'transactions', ['status', 'transaction_date'])
+    create_index('ix_transactions_date_id', 'transactions', ['transaction_date', 'id'])
+    create_index('ix_episodes_season_number', 'episodes', ['season_id', 'episode_number'])
+
+
+@migration(2, "Métadonnées de sonde (codecs, résolution, débit) des films et épisodes")
+def add_probe_columns():
+    for table in ('films', 'episodes'):
+        add_column(table, 'video_codec', 'VARCHAR(50)')
+        add_column(table, 'audio_codec', 'VARCHAR(50)')
+        add_column(table, 'width', 'INTEGER')
+        add_column(table, 'height', 'INTEGER')
+        add_column(table, 'bitrate', 'INTEGER')
+
+
+@migration(3, "Indicateur access_tokens.stats_counted")
+def add_stats_counted():
+    add_column('access_tokens', 'stats_counted', 'BOOLEAN DEFAULT FALSE')
+
+
+@migration(4, "Remplissage de user_entitlements")
+def fill_entitlements():
+    from entitlements import rebuild_entitlements
+    rebuild_entitlements()
+
+
+@migration(5, "Remplissage des agrégats de transactions")
+def fill_transaction_rollups():
+    from stats import rebuild_transaction_stats
+    rebuild_transaction_stats()
+
+
+@migration(6, "Recalcul des statistiques clients")
+def fill_client_stats():
+    from stats import rebuild_client_stats
+    rebuild_client_stats()
+
+
+
+@migration(7, "Caches HLS indexés par fichier source (anciens dossiers par id supprimés)")
+def drop_hls_by_id():
+    from flask import current_app
+    from reclaim import tombstone
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    tombstone(upload_folder, [os.path.join(upload_folder, 'hls', folder) for folder in ('films', 'episodes')],
+              is_directory=True)
+
+
+
+@migration(8, "Empreinte SHA-256 des uploads par morceaux")
+def add_upload_sha256():
+    add_column('upload_sessions', 'sha256', 'VARCHAR(64)')
+
+
+SCHEMA_MIGRATIONS_DDL = (
+    "CREATE TABLE IF NOT EXISTS schema_migrations ("
+    "version INTEGER PRIMARY KEY, description VARCHAR(200), applied_date TIMESTAMP)"
+)
+
+
+def applied_versions():
+    db.session.execute(text(SCHEMA_MIGRATIONS_DDL))
+    return {row[0] for row in db.session.execute(text("SELECT version FROM schema_migrations"))}
+
+
+# Clé du verrou consultatif PostgreSQL des migrations
+MIGRATION_LOCK_KEY = 727401
+
+
+@contextmanager
+def migration_lock():
+    """
+    Sérialise les migrations entre processus : les workers gunicorn démarrent
+    ensemble et chacun applique les migrations en attente. Verrou consultatif
+    sous PostgreSQL, verrou de fichier à côté de la base sous SQLite.
+    """
+    if db.engine.dialect.name == 'postgresql':
+        with db.engine.connect() as connection:
+            connection.execute(text("SELECT pg_advisory_lock(:key)"), {'key': MIGRATION_LOCK_KEY})
+            try:
+                yield
+            finally:
+                connection.execute(text("SELECT pg_advisory_unlock(:key)"), {'key': MIGRATION_LOCK_KEY})
+        return
+
+    database = db.engine.url.database
+    if fcntl is None or not database or database == ':memory:':
+        yield
+        return
+    with open(f"{database}.migrate.lock", 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def run_migrations(echo=print):
+    """Crée les tables manquantes puis applique les migrations en attente ; retourne leur nombre"""
+    with migration_lock():
+        # Relu sous le verrou : un autre processus a pu tout appliquer entre-temps
+        db.create_all()
+        applied = applied_versions()
+        db.session.commit()
+
+        count = 0
+        for version, description, func in sorted(MIGRATIONS, key=lambda m: m[0]):
+            if version in applied:
+                continue
+            echo(f"Migration {version} : {description}")
+            func()
+            db.session.execute(
+                text("INSERT INTO schema_migrations (version, description, applied_date) VALUES (:v, :d, :t)"),
+                {'v': version, 'd': description, 't': datetime.utcnow()}
+            )
+            db.session.commit()
+            count += 1
+        return count
+
+
+# Requêtes chaudes vérifiées par `flask explain-queries` : chacune doit passer
+# par un index et non par un parcours complet de la table
+HOT_QUERIES = {
+    'droit de lecture': (
+        "SELECT 1 FROM user_entitlements WHERE user_id = 1 AND content_type = 'film' "
+        "AND content_id = 1 AND (expiry_date IS NULL OR expiry_date >= '2000-01-01')"
+    ),
+    'tokens actifs': (
+        "SELECT id FROM access_tokens WHERE user_id = 1 "
+        "AND (expiry_date IS NULL OR expiry_date >= '2000-01-01')"
+    ),
+    'achat de film': "SELECT id FROM token_purchases WHERE token_id = 1 AND film_id = 1",
+    'achat de saison': (
+        "SELECT id FROM token_purchases WHERE token_id = 1 AND series_id = 1 AND season_id = 1"
+    ),
+    'transactions par statut': (
+        "SELECT id FROM transactions WHERE status = 'pending' ORDER BY transaction_date DESC LIMIT 50"
+    ),
+    'page de transactions': (
+        "SELECT id FROM transactions ORDER BY transaction_date DESC, id DESC LIMIT 50"
+    ),
+    'épisodes d\'une saison': "SELECT id FROM episodes WHERE season_id = 1 ORDER BY episode_number",
+}
+
+
+def sqlite_plan(sql):
+    plan = [row[-1] for row in db.session.execute(text(f"EXPLAIN QUERY PLAN {sql}"))]
+    indexed = not any((line.startswith('SCAN') and 'USING' not in line) or 'TEMP B-TREE' in line
+                      for line in plan)
+    return plan, indexed
+
+
+def postgresql_plan(sql):
+    plan = [row[0] for row in db.session.execute(text(f"EXPLAIN {sql}"))]
+    indexed = not any('Seq Scan' in line or line.lstrip(' ->').startswith('Sort') for line in plan)
+    return plan, indexed
+
+
+def explain_hot_queries():
+    """
+    Plans d'exécution des requêtes chaudes (SQLite ou PostgreSQL).
+
+    Retourne [(libellé, [lignes du plan], utilise_un_index)] ; une requête
+    qui parcourt toute sa table ou trie ses résultats est signalée comme non
+    indexée. Sous PostgreSQL les parcours séquentiels sont désactivés le temps
+    de l'analyse : sur une petite table le planificateur les préférerait
+    même en présence d'un index.
+    """
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(text("SET LOCAL enable_seqscan = off"))
+        explain = postgresql_plan
+    else:
+        explain = sqlite_plan
+
+    results = []
+    for label, sql in HOT_QUERIES.items():
+        plan, indexed = explain(sql)
+        results.append((label, plan, indexed))
+    db.session.rollback()
+    return results
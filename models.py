@@ -1,40 +1,12 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
+from sqlalchemy import inspect
+from sqlalchemy.orm.attributes import set_committed_value
 from datetime import datetime
 import uuid
-import os
 
 
 db = SQLAlchemy()
-try:
-    from moviepy.editor import VideoFileClip
-except ImportError:
-    # Si moviepy n'est pas installé, on peut utiliser une alternative
-    VideoFileClip = None
-
-# Ou utiliser cette alternative si moviepy pose des problèmes :
-import subprocess
-import json
-
-def get_video_duration_ffprobe(file_path):
-    """
-    Obtenir la durée d'une vidéo avec ffprobe (plus léger que moviepy)
-    """
-    try:
-        cmd = [
-            'ffprobe', '-v', 'quiet', '-print_format', 'json', 
-            '-show_format', file_path
-        ]
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        
-        if result.returncode == 0:
-            data = json.loads(result.stdout)
-            duration = float(data['format']['duration'])
-            return int(duration)
-    except (subprocess.SubprocessError, json.JSONDecodeError, KeyError, ValueError):
-        pass
-    
-    return None
 
 
 class User(UserMixin, db.Model):
@@ -70,38 +42,19 @@ class Film(db.Model):
     duration = db.Column(db.Integer, nullable=True)  # Durée en secondes
     genre = db.Column(db.String(50), default='action')  # Genre avec valeur par défaut
     
+    # Métadonnées techniques (remplies en arrière-plan par probing.py)
+    video_codec = db.Column(db.String(50), nullable=True)
+    audio_codec = db.Column(db.String(50), nullable=True)
+    width = db.Column(db.Integer, nullable=True)
+    height = db.Column(db.Integer, nullable=True)
+    bitrate = db.Column(db.Integer, nullable=True)  # Débit total en bit/s
+    
     # Relations
     transactions = db.relationship('Transaction', backref='film', lazy=True, cascade="all, delete-orphan")
     purchases = db.relationship('TokenPurchase', backref='film', lazy=True, cascade="all, delete-orphan")
+    renditions = db.relationship('Rendition', backref='film', lazy=True, cascade="all, delete-orphan")
+    jobs = db.relationship('MediaJob', backref='film', lazy=True, cascade="all, delete-orphan")
     
-    # MÉTHODE POUR CALCULER LA DURÉE AUTOMATIQUEMENT
-    def calculate_duration(self, app):
-        if self.chemin:
-            try:
-                # Construire le chemin complet du fichier
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], 'films', self.chemin)
-                
-                if os.path.exists(file_path):
-                    # Essayer d'abord avec moviepy si disponible
-                    if VideoFileClip:
-                        try:
-                            video = VideoFileClip(file_path)
-                            self.duration = int(video.duration)
-                            video.close()
-                            return True
-                        except Exception as e:
-                            print(f"Erreur avec moviepy: {str(e)}")
-                    
-                    # Alternative avec ffprobe
-                    duration = get_video_duration_ffprobe(file_path)
-                    if duration:
-                        self.duration = duration
-                        return True
-                        
-            except Exception as e:
-                print(f"Erreur lors du calcul de la durée: {str(e)}")
-                return False
-        return False
     def get_formatted_duration(self):
         if self.duration:
             hours = self.duration // 3600
@@ -113,6 +66,14 @@ class Film(db.Model):
             else:
                 return f"{minutes}min {seconds:02d}s"
         return "Durée non disponible"
+
+    def get_ready_renditions(self):
+        """Retourne les versions basse résolution prêtes, de la plus petite à la plus grande"""
+        return sorted([r for r in self.renditions if r.status == 'ready'], key=lambda r: r.height)
+
+    def get_latest_job(self):
+        """Dernière tâche de conversion lancée pour ce film, ou None"""
+        return max(self.jobs, key=lambda job: job.id) if self.jobs else None
     
 
 class Series(db.Model):
@@ -155,42 +116,182 @@ class Episode(db.Model):
     # NOUVEAU CHAMP
     duration = db.Column(db.Integer, nullable=True)  # Durée en secondes
     
-    # MÉTHODE POUR CALCULER LA DURÉE AUTOMATIQUEMENT
-    def calculate_duration(self, app):
-        if self.chemin:
-            try:
-                # Construire le chemin complet du fichier
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], 'episodes', self.chemin)
-                
-                if os.path.exists(file_path):
-                    # Essayer d'abord avec moviepy si disponible
-                    if VideoFileClip:
-                        try:
-                            video = VideoFileClip(file_path)
-                            self.duration = int(video.duration)
-                            video.close()
-                            return True
-                        except Exception as e:
-                            print(f"Erreur avec moviepy: {str(e)}")
-                    
-                    # Alternative avec ffprobe
-                    duration = get_video_duration_ffprobe(file_path)
-                    if duration:
-                        self.duration = duration
-                        return True
-                        
-            except Exception as e:
-                print(f"Erreur lors du calcul de la durée: {str(e)}")
-                return False
-        return False    
+    # Métadonnées techniques (remplies en arrière-plan par probing.py)
+    video_codec = db.Column(db.String(50), nullable=True)
+    audio_codec = db.Column(db.String(50), nullable=True)
+    width = db.Column(db.Integer, nullable=True)
+    height = db.Column(db.Integer, nullable=True)
+    bitrate = db.Column(db.Integer, nullable=True)  # Débit total en bit/s
+    
+    # Relations
+    renditions = db.relationship('Rendition', backref='episode', lazy=True, cascade="all, delete-orphan")
+    jobs = db.relationship('MediaJob', backref='episode', lazy=True, cascade="all, delete-orphan")
+    
+    # Index (bases existantes : migration 1 de migrations.py)
+    __table_args__ = (
+        db.Index('ix_episodes_season_number', 'season_id', 'episode_number'),
+    )
+    
     def get_formatted_duration(self):
         if self.duration:
             minutes = self.duration // 60
             seconds = self.duration % 60
             return f"{minutes}min {seconds:02d}s"
         return "Durée non disponible"
+
+    def get_ready_renditions(self):
+        """Retourne les versions basse résolution prêtes, de la plus petite à la plus grande"""
+        return sorted([r for r in self.renditions if r.status == 'ready'], key=lambda r: r.height)
+    
+
+# Versions transcodées (240p/480p/720p) d'un film ou d'un épisode
+class Rendition(db.Model):
+    __tablename__ = 'renditions'
+    id = db.Column(db.Integer, primary_key=True)
+    film_id = db.Column(db.Integer, db.ForeignKey('films.id'), nullable=True)
+    episode_id = db.Column(db.Integer, db.ForeignKey('episodes.id'), nullable=True)
+    height = db.Column(db.Integer, nullable=False)  # 240, 480, 720...
+    video_bitrate = db.Column(db.Integer, nullable=False)  # kbit/s
+    audio_bitrate = db.Column(db.Integer, nullable=False)  # kbit/s
+    chemin = db.Column(db.String(500), nullable=True)  # Fichier dans uploads/renditions
+    status = db.Column(db.String(20), default='pending')  # pending, ready, failed
+    created_date = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def get_label(self):
+        return f"{self.height}p"
+    
+    def get_total_bitrate(self):
+        """Débit total en kbit/s (vidéo + audio)"""
+        return self.video_bitrate + self.audio_bitrate
+
+
+# File de tâches de conversion (mkv/avi/mov/wmv -> MP4 H.264/AAC faststart)
+class MediaJob(db.Model):
+    __tablename__ = 'media_jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    film_id = db.Column(db.Integer, db.ForeignKey('films.id'), nullable=True)
+    episode_id = db.Column(db.Integer, db.ForeignKey('episodes.id'), nullable=True)
+    kind = db.Column(db.String(20), default='convert')
+    status = db.Column(db.String(20), default='queued')  # queued, running, done, failed
+    progress = db.Column(db.Float, default=0.0)  # Pourcentage 0-100
+    source = db.Column(db.String(500), nullable=False)  # Fichier d'origine (chemin)
+    error = db.Column(db.Text, nullable=True)
+    created_date = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_date = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def is_active(self):
+        return self.status in ('queued', 'running')
+
+
+# Fichier vidéo du stockage adressé par contenu (uploads/blobs), partagé
+# entre tous les films/épisodes dont le `chemin` pointe dessus
+class MediaBlob(db.Model):
+    __tablename__ = 'media_blobs'
+    id = db.Column(db.Integer, primary_key=True)
+    sha256 = db.Column(db.String(64), nullable=False)
+    extension = db.Column(db.String(10), nullable=False)  # '.mp4', '.mkv'...
+    size = db.Column(db.BigInteger, nullable=False)
+    ref_count = db.Column(db.Integer, default=0)  # Nombre de films/épisodes qui l'utilisent
+    created_date = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (db.UniqueConstraint('sha256', 'extension'),)
+
+
+# Fichier ou dossier à supprimer du disque, enregistré dans la transaction qui
+# supprime les lignes ; récupéré en arrière-plan (reclaim.py), retenté en cas d'échec
+class MediaTombstone(db.Model):
+    __tablename__ = 'media_tombstones'
+    id = db.Column(db.Integer, primary_key=True)
+    path = db.Column(db.String(500), nullable=False)  # Relatif à UPLOAD_FOLDER
+    is_directory = db.Column(db.Boolean, default=False)  # Cache HLS : suppression récursive
+    attempts = db.Column(db.Integer, default=0)
+    last_error = db.Column(db.Text, nullable=True)
+    next_attempt = db.Column(db.DateTime, default=datetime.utcnow)
+    created_date = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (db.Index('ix_media_tombstones_next_attempt', 'next_attempt'),)
+
+
+# Version du catalogue (ligne unique id=1), incrémentée dans la transaction de
+# chaque écriture qui modifie films, séries, saisons ou épisodes (catalog.py)
+class CatalogState(db.Model):
+    __tablename__ = 'catalog_state'
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_date = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+# Journal des modifications du catalogue : une ligne par film ou série touché
+# à chaque version (les saisons et épisodes sont publiés avec leur série)
+class CatalogChange(db.Model):
+    __tablename__ = 'catalog_changes'
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+    entity_type = db.Column(db.String(20), nullable=False)  # 'film' ou 'series'
+    entity_id = db.Column(db.Integer, nullable=False)
+    action = db.Column(db.String(20), nullable=False)  # 'upsert' ou 'delete'
+    created_date = db.Column(db.DateTime, default=datetime.utcnow)
     
+    __table_args__ = (db.Index('ix_catalog_changes_version', 'version'),)
+
+
+# Upload reprenable par morceaux (PATCH avec Upload-Offset)
+class UploadSession(db.Model):
+    __tablename__ = 'upload_sessions'
+    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    kind = db.Column(db.String(20), nullable=False)  # film, episode
+    original_filename = db.Column(db.String(255), nullable=False)
+    filename = db.Column(db.String(500), nullable=False)  # Nom final dans uploads/films ou uploads/episodes
+    size = db.Column(db.BigInteger, nullable=False)  # Taille totale annoncée
+    received = db.Column(db.BigInteger, default=0)  # Octets reçus et synchronisés sur disque (offset courant)
+    status = db.Column(db.String(20), default='uploading')  # uploading, complete, consumed
+    sha256 = db.Column(db.String(64), nullable=True)  # Empreinte du fichier complet (fin de l'upload)
+    created_date = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_date = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+# Import CSV de comptes clients exécuté en arrière-plan (provisioning.run_import).
+# Les mots de passe ne sont jamais stockés ici : l'administrateur les reçoit
+# dans la réponse de l'import
+class ProvisioningJob(db.Model):
+    __tablename__ = 'provisioning_jobs'
+    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    admin_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    total = db.Column(db.Integer, nullable=False)  # Nombre de comptes à créer
+    status = db.Column(db.String(20), default='queued')  # queued, running, done, failed
+    error = db.Column(db.Text, nullable=True)
+    created_date = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_date = db.Column(db.DateTime, nullable=True)
+
+
+def load_contents(film_ids=(), series_ids=(), season_ids=()):
+    """
+    Résout films, séries et saisons avec une requête IN par type.
+
+    Les objets déjà présents dans l'identity map de la session sont réutilisés
+    sans requête. Retourne {'films': {id: Film}, 'series': {...}, 'seasons': {...}}.
+    """
+    def fetch(model, ids):
+        mapper = inspect(model)
+        found = {}
+        missing = []
+        for content_id in {content_id for content_id in ids if content_id}:
+            obj = db.session.identity_map.get(mapper.identity_key_from_primary_key((content_id,)))
+            if obj is not None:
+                found[content_id] = obj
+            else:
+                missing.append(content_id)
+        if missing:
+            found.update((obj.id, obj) for obj in model.query.filter(model.id.in_(missing)))
+        return found
     
+    return {
+        'films': fetch(Film, film_ids),
+        'series': fetch(Series, series_ids),
+        'seasons': fetch(Season, season_ids)
+    }
+
 
 # 1. Modifier la classe Transaction pour ajouter de nouveaux champs
 class Transaction(db.Model):
@@ -209,34 +310,54 @@ class Transaction(db.Model):
     confirmed_by = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
     description = db.Column(db.Text, nullable=True)  # NOUVEAU: Description détaillée
     
-    def get_total_content_value(self):
+    # season_id n'a pas de clé étrangère : relation en lecture seule
+    season = db.relationship('Season', primaryjoin='foreign(Transaction.season_id) == Season.id', viewonly=True)
+    
+    # Index (bases existantes : migration 1 de migrations.py)
+    __table_args__ = (
+        db.Index('ix_transactions_status_date', 'status', 'transaction_date'),
+        db.Index('ix_transactions_date_id', 'transaction_date', 'id'),
+    )
+    
+    @staticmethod
+    def load_transaction_contents(transactions):
+        """Contenus d'une liste de transactions : une requête IN par type"""
+        return load_contents(
+            film_ids=[t.film_id for t in transactions],
+            series_ids=[t.series_id for t in transactions if t.season_id],
+            season_ids=[t.season_id for t in transactions if t.series_id]
+        )
+    
+    def get_total_content_value(self, contents=None):
         """Calcule la valeur totale du contenu associé à cette transaction"""
+        contents = contents or Transaction.load_transaction_contents([self])
         total = 0
         
         if self.film_id:
-            film = Film.query.get(self.film_id)
+            film = contents['films'].get(self.film_id)
             if film:
                 total += film.price
         
         if self.series_id and self.season_id:
-            season = Season.query.get(self.season_id)
+            season = contents['seasons'].get(self.season_id)
             if season:
                 total += season.price
         
         return total
     
-    def get_content_summary(self):
+    def get_content_summary(self, contents=None):
         """Retourne un résumé du contenu de la transaction"""
+        contents = contents or Transaction.load_transaction_contents([self])
         content = []
         
         if self.film_id:
-            film = Film.query.get(self.film_id)
+            film = contents['films'].get(self.film_id)
             if film:
                 content.append(f"Film: {film.title} ({film.year})")
         
         if self.series_id and self.season_id:
-            series = Series.query.get(self.series_id)
-            season = Season.query.get(self.season_id)
+            series = contents['series'].get(self.series_id)
+            season = contents['seasons'].get(self.season_id)
             if series and season:
                 content.append(f"Série: {series.title} - Saison {season.season_number}")
         
@@ -252,39 +373,68 @@ class AccessToken(db.Model):
     created_date = db.Column(db.DateTime, default=datetime.utcnow)
     expiry_date = db.Column(db.DateTime, nullable=True)
     total_amount = db.Column(db.Float, default=0.0)  # NOUVEAU: Montant total des achats
+    stats_counted = db.Column(db.Boolean, default=False)  # Achats inclus dans ClientStats
     
     # Relations
     purchases = db.relationship('TokenPurchase', backref='access_token', lazy=True, cascade="all, delete-orphan")
     
-    def calculate_total_value(self):
+    # Index (bases existantes : migration 1 de migrations.py)
+    __table_args__ = (
+        db.Index('ix_access_tokens_user_expiry', 'user_id', 'expiry_date'),
+    )
+    
+    @staticmethod
+    def load_token_contents(tokens):
+        """
+        Achats et contenus d'une liste de tokens : une requête pour les achats
+        non encore chargés, puis une requête IN par type de contenu
+        """
+        pending = [token for token in tokens if 'purchases' in inspect(token).unloaded]
+        if pending:
+            purchases_by_token = {token.id: [] for token in pending}
+            for purchase in TokenPurchase.query.filter(TokenPurchase.token_id.in_(purchases_by_token)):
+                purchases_by_token[purchase.token_id].append(purchase)
+            for token in pending:
+                set_committed_value(token, 'purchases', purchases_by_token[token.id])
+        
+        purchases = [purchase for token in tokens for purchase in token.purchases]
+        return load_contents(
+            film_ids=[p.film_id for p in purchases],
+            series_ids=[p.series_id for p in purchases if p.season_id],
+            season_ids=[p.season_id for p in purchases if p.series_id]
+        )
+    
+    def calculate_total_value(self, contents=None):
         """Calcule la valeur totale des contenus associés à ce token"""
+        contents = contents or AccessToken.load_token_contents([self])
         total = 0
         
         for purchase in self.purchases:
             if purchase.film_id:
-                film = Film.query.get(purchase.film_id)
+                film = contents['films'].get(purchase.film_id)
                 if film:
                     total += film.price
             elif purchase.series_id and purchase.season_id:
-                season = Season.query.get(purchase.season_id)
+                season = contents['seasons'].get(purchase.season_id)
                 if season:
                     total += season.price
         
         return total
     
-    def get_content_summary(self):
+    def get_content_summary(self, contents=None):
         """Retourne un résumé des contenus associés"""
+        contents = contents or AccessToken.load_token_contents([self])
         films = []
         series = []
         
         for purchase in self.purchases:
             if purchase.film_id:
-                film = Film.query.get(purchase.film_id)
+                film = contents['films'].get(purchase.film_id)
                 if film:
                     films.append(film)
             elif purchase.series_id and purchase.season_id:
-                series_obj = Series.query.get(purchase.series_id)
-                season = Season.query.get(purchase.season_id)
+                series_obj = contents['series'].get(purchase.series_id)
+                season = contents['seasons'].get(purchase.season_id)
                 if series_obj and season:
                     series.append(f"{series_obj.title} - Saison {season.season_number}")
         
@@ -295,6 +445,19 @@ class AccessToken(db.Model):
             'total_series': len(series)
         }
 
+# Statistiques des transactions agrégées par (jour, statut, moyen de paiement),
+# tenues à jour dans la même transaction que chaque écriture de Transaction
+class TransactionRollup(db.Model):
+    __tablename__ = 'transaction_rollups'
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)  # Jour de Transaction.transaction_date
+    status = db.Column(db.String(20), nullable=False)
+    payment_method = db.Column(db.String(50), nullable=False)
+    count = db.Column(db.Integer, default=0)
+    amount = db.Column(db.Float, default=0.0)
+    
+    __table_args__ = (db.UniqueConstraint('day', 'status', 'payment_method'),)
+
 # 3. Ajouter une nouvelle classe pour les statistiques
 class ClientStats(db.Model):
     __tablename__ = 'client_stats'
@@ -312,44 +475,10 @@ class ClientStats(db.Model):
     
     @staticmethod
     def update_client_stats(user_id):
-        """Met à jour les statistiques d'un client"""
-        stats = ClientStats.query.filter_by(user_id=user_id).first()
-        if not stats:
-            stats = ClientStats(user_id=user_id)
-            db.session.add(stats)
-        
-        # Calculer les totaux depuis les tokens actifs
-        active_tokens = AccessToken.query.filter_by(user_id=user_id).filter(
-            (AccessToken.expiry_date == None) | 
-            (AccessToken.expiry_date >= datetime.utcnow())
-        ).all()
-        
-        total_spent = 0
-        total_films = 0
-        total_series = 0
-        
-        for token in active_tokens:
-            total_spent += token.calculate_total_value()
-            content = token.get_content_summary()
-            total_films += content['total_films']
-            total_series += content['total_series']
-        
-        stats.total_spent = total_spent
-        stats.total_films = total_films
-        stats.total_series = total_series
-        stats.updated_date = datetime.utcnow()
-        
-        # Dernière date d'achat
-        last_transaction = Transaction.query.filter_by(
-            user_id=user_id, 
-            status='confirmed'
-        ).order_by(Transaction.confirmed_date.desc()).first()
-        
-        if last_transaction:
-            stats.last_purchase_date = last_transaction.confirmed_date
-        
-        db.session.commit()
-        return stats
+        """Recalcule les statistiques d'un client (voir stats.rebuild_client_stats)"""
+        from stats import rebuild_client_stats
+        rebuild_client_stats([user_id])
+        return ClientStats.query.filter_by(user_id=user_id).first()
     
     
 class TokenPurchase(db.Model):
@@ -358,4 +487,32 @@ class TokenPurchase(db.Model):
     token_id = db.Column(db.Integer, db.ForeignKey('access_tokens.id'), nullable=False)
     film_id = db.Column(db.Integer, db.ForeignKey('films.id'), nullable=True)
     series_id = db.Column(db.Integer, db.ForeignKey('series.id'), nullable=True)
-    season_id = db.Column(db.Integer, db.ForeignKey('seasons.id'), nullable=True)
\ No newline at end of file
+    season_id = db.Column(db.Integer, db.ForeignKey('seasons.id'), nullable=True)
+    
+    # Droit de lecture dénormalisé créé avec l'achat
+    entitlement = db.relationship('UserEntitlement', backref='purchase', uselist=False, cascade="all, delete-orphan")
+    
+    # Index (bases existantes : migration 1 de migrations.py)
+    __table_args__ = (
+        db.Index('ix_token_purchases_token_film', 'token_id', 'film_id'),
+        db.Index('ix_token_purchases_token_season', 'token_id', 'series_id', 'season_id'),
+    )
+
+
+# Droits de lecture matérialisés : une ligne par achat, avec l'expiration du
+# token, pour vérifier un accès en une seule recherche indexée
+class UserEntitlement(db.Model):
+    __tablename__ = 'user_entitlements'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    content_type = db.Column(db.String(10), nullable=False)  # 'film' ou 'season'
+    content_id = db.Column(db.Integer, nullable=False)
+    purchase_id = db.Column(db.Integer, db.ForeignKey('token_purchases.id'), nullable=False)
+    expiry_date = db.Column(db.DateTime, nullable=True)  # Copie de AccessToken.expiry_date
+    
+    __table_args__ = (
+        db.Index('ix_user_entitlements_lookup', 'user_id', 'content_type', 'content_id', 'expiry_date'),
+    )
+    
+    def is_active(self):
+        return self.expiry_date is None or self.expiry_date >= datetime.utcnow()
@@ -0,0 +1,148 @@
+import io
+import csv
+import sqlite3
+from datetime import datetime
+from sqlalchemy import create_engine, text
+from models import db
+from migrations import MIGRATIONS, SCHEMA_MIGRATIONS_DDL
+
+
+# Lignes envoyées par commande COPY (tampon mémoire de quelques Mo)
+COPY_BATCH_ROWS = 50000
+
+# Marqueur NULL du format CSV de COPY : une chaîne vide reste une chaîne vide
+NULL_MARKER = '\\N'
+
+
+class CopyError(Exception):
+    pass
+
+
+def source_columns(source, table):
+    return [row[1] for row in source.execute(f'PRAGMA table_info("{table}")')]
+
+
+def foreign_key_checks(table, columns):
+    """[(index de colonne, table référencée, colonne nullable)] des clés étrangères copiées"""
+    checks = []
+    for column in table.columns:
+        if column.name not in columns:
+            continue
+        for foreign_key in column.foreign_keys:
+            checks.append((columns.index(column.name), foreign_key.column.table.name, column.nullable))
+    return checks
+
+
+def copy_table(source, cursor, table, copied_ids):
+    """
+    Copie une table par COPY ... FROM STDIN (CSV), par lots de COPY_BATCH_ROWS.
+
+    SQLite n'appliquait pas les clés étrangères : une référence vers une ligne
+    absente est mise à NULL si la colonne le permet, sinon la ligne est
+    ignorée. Retourne (copiées, ignorées, références mises à NULL).
+    """
+    available = set(source_columns(source, table.name))
+    columns = [column.name for column in table.columns if column.name in available]
+    checks = foreign_key_checks(table, columns)
+    track_ids = 'id' in columns and table.name in copied_ids
+    id_index = columns.index('id') if 'id' in columns else None
+
+    quoted = ', '.join(f'"{name}"' for name in columns)
+    copy_sql = f'COPY "{table.name}" ({quoted}) FROM STDIN WITH (FORMAT csv, NULL \'{NULL_MARKER}\')'
+    rows = source.execute(f'SELECT {quoted} FROM "{table.name}"')
+
+    copied = skipped = nulled = 0
+    while True:
+        batch = rows.fetchmany(COPY_BATCH_ROWS)
+        if not batch:
+            break
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in batch:
+            row = list(row)
+            orphan = False
+            for index, referenced, nullable in checks:
+                if row[index] is None or row[index] in copied_ids.get(referenced, ()):
+                    continue
+                if not nullable:
+                    orphan = True
+                    break
+                row[index] = None
+                nulled += 1
+            if orphan:
+                skipped += 1
+                continue
+            if track_ids:
+                copied_ids[table.name].add(row[id_index])
+            writer.writerow([NULL_MARKER if value is None else value for value in row])
+            copied += 1
+        buffer.seek(0)
+        cursor.copy_expert(copy_sql, buffer)
+    return copied, skipped, nulled
+
+
+def reset_sequences(cursor, tables):
+    """Repositionne les séquences SERIAL après l'insertion des id d'origine"""
+    for table in tables:
+        if 'id' not in table.columns or not table.columns['id'].autoincrement:
+            continue
+        cursor.execute(
+            f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+            f"COALESCE(MAX(id), 0) + 1, false) FROM \"{table.name}\""
+        )
+
+
+def copy_sqlite_to_postgres(sqlite_path, target_url, echo=print):
+    """
+    Copie une base SQLite (films_series.db) dans une base PostgreSQL vide.
+
+    Le schéma cible est créé à partir des modèles, les tables sont copiées
+    dans l'ordre des clés étrangères en une seule transaction, puis les
+    séquences sont recalées et toutes les migrations marquées comme
+    appliquées. La base source doit être à jour (`flask upgrade-db`).
+    """
+    engine = create_engine(target_url)
+    if engine.dialect.name != 'postgresql':
+        raise CopyError("La base cible doit être PostgreSQL")
+
+    tables = db.metadata.sorted_tables
+    db.metadata.create_all(engine)
+    with engine.connect() as conn:
+        for table in tables:
+            if conn.execute(text(f'SELECT EXISTS (SELECT 1 FROM "{table.name}")')).scalar():
+                raise CopyError(f"La base cible n'est pas vide (table {table.name})")
+
+    referenced = {fk.column.table.name for table in tables for fk in table.foreign_keys}
+    copied_ids = {name: set() for name in referenced}
+
+    source = sqlite3.connect(sqlite_path)
+    source_tables = {row[0] for row in source.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    raw = engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        for table in tables:
+            if table.name not in source_tables:
+                echo(f"{table.name} : absente de la source")
+                continue
+            copied, skipped, nulled = copy_table(source, cursor, table, copied_ids)
+            echo(f"{table.name} : {copied} ligne(s) copiée(s)"
+                 + (f", {skipped} ignorée(s)" if skipped else "")
+                 + (f", {nulled} référence(s) orpheline(s) mise(s) à NULL" if nulled else ""))
+        reset_sequences(cursor, tables)
+        raw.commit()
+    except Exception:
+        raw.rollback()
+        raise
+    finally:
+        raw.close()
+        source.close()
+
+    # Le schéma cible vient des modèles actuels : rien à migrer
+    with engine.begin() as conn:
+        conn.execute(text(SCHEMA_MIGRATIONS_DDL))
+        for version, description, func in MIGRATIONS:
+            conn.execute(
+                text("INSERT INTO schema_migrations (version, description, applied_date) VALUES (:v, :d, :t)"),
+                {'v': version, 'd': description, 't': datetime.utcnow()}
+            )
+    engine.dispose()
@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import logging
+import threading
+import subprocess
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from models import db, Film, Episode
+from media_store import media_path
+from catalog import bump_catalog_version, content_changes
+
+
+logger = logging.getLogger(__name__)
+
+# Cache des sondes, clé (chemin, taille, mtime) : un fichier inchangé n'est
+# jamais sondé deux fois
+PROBE_CACHE_SIZE = 1024
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+_executor = None
+
+# Champs remplis sur Film / Episode
+PROBE_FIELDS = ('duration', 'video_codec', 'audio_codec', 'width', 'height', 'bitrate')
+
+
+def get_executor(app):
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=app.config.get('PROBE_WORKERS', 2),
+            thread_name_prefix='probe'
+        )
+    return _executor
+
+
+def run_ffprobe(file_path, ffprobe='ffprobe'):
+    """
+    Sonde un fichier vidéo avec un seul appel ffprobe.
+
+    Retourne un dict (durée en secondes, codecs, résolution, débit en bit/s)
+    ou None si le fichier n'est pas lisible.
+    """
+    cmd = [
+        ffprobe, '-v', 'quiet', '-print_format', 'json',
+        '-show_format', '-show_streams', file_path
+    ]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        if result.returncode != 0:
+            return None
+        data = json.loads(result.stdout)
+    except (OSError, subprocess.SubprocessError, json.JSONDecodeError):
+        return None
+
+    info = dict.fromkeys(PROBE_FIELDS)
+    for stream in data.get('streams', []):
+        if stream.get('codec_type') == 'video' and info['video_codec'] is None:
+            info['video_codec'] = stream.get('codec_name')
+            info['width'] = stream.get('width')
+            info['height'] = stream.get('height')
+        elif stream.get('codec_type') == 'audio' and info['audio_codec'] is None:
+            info['audio_codec'] = stream.get('codec_name')
+
+    file_format = data.get('format', {})
+    try:
+        info['duration'] = int(float(file_format['duration']))
+    except (KeyError, ValueError):
+        pass
+    try:
+        info['bitrate'] = int(file_format['bit_rate'])
+    except (KeyError, ValueError):
+        pass
+    return info
+
+
+def probe_media(file_path, ffprobe='ffprobe'):
+    """Sonde un fichier en passant par le cache (chemin, taille, mtime)"""
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    info = run_ffprobe(file_path, ffprobe)
+    if info is None:
+        return None
+
+    with _cache_lock:
+        _cache[key] = info
+        while len(_cache) > PROBE_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return info
+
+
+def content_path(app, content_type, content):
+    folder = 'films' if content_type == 'film' else 'episodes'
+    return media_path(app.config['UPLOAD_FOLDER'], folder, content.chemin)
+
+
+def apply_probe(content, info):
+    """Recopie les métadonnées sondées sur le film ou l'épisode"""
+    for field in PROBE_FIELDS:
+        if info.get(field) is not None:
+            setattr(content, field, info[field])
+
+
+def probe_content(app, content_type, content_id):
+    """Sonde un film ou un épisode et enregistre le résultat"""
+    with app.app_context():
+        content = Film.query.get(content_id) if content_type == 'film' else Episode.query.get(content_id)
+        if not content or not content.chemin:
+            return False
+
+        info = probe_media(content_path(app, content_type, content), app.config['FFPROBE_BINARY'])
+        if info is None:
+            logger.warning(f"Sonde impossible pour {content_type} {content_id}")
+            return False
+
+        apply_probe(content, info)
+        bump_catalog_version(*content_changes(content_type, [content_id]))
+        db.session.commit()
+        return True
+
+
+def schedule_probe(app, content_type, content_id):
+    """Met en file la sonde d'un contenu (à appeler après le commit)"""
+    return get_executor(app).submit(probe_content, app, content_type, content_id)
+
+
+def reprobe_missing(app, workers=None, batch_size=100, dry_run=False, probe_all=False, echo=print):
+    """
+    Re-sonde en parallèle les films et épisodes sans durée.
+
+    Les appels ffprobe sont répartis sur un pool de processus (un par cœur par
+    défaut) ; les résultats sont écrits par lots avec un UPDATE groupé par
+    commit. Retourne le nombre de contenus mis à jour.
+    """
+    ffprobe = app.config['FFPROBE_BINARY']
+    upload_folder = app.config['UPLOAD_FOLDER']
+
+    targets = []
+    for model, folder in ((Film, 'films'), (Episode, 'episodes')):
+        query = db.session.query(model.id, model.chemin)
+        if not probe_all:
+            query = query.filter(model.duration == None)
+        targets += [(model, content_id, media_path(upload_folder, folder, chemin))
+                    for content_id, chemin in query.all() if chemin]
+
+    total = len(targets)
+    echo(f"{total} contenu(s) à sonder avec {workers or os.cpu_count()} processus"
+         f"{' (simulation)' if dry_run else ''}.")
+    if not total:
+        return 0
+
+    pending = {Film: [], Episode: []}
+    done = updated = failed = 0
+    started = time.monotonic()
+
+    def flush():
+        changes = []
+        for model, mappings in pending.items():
+            if mappings and not dry_run:
+                db.session.bulk_update_mappings(model, mappings)
+                changes += content_changes('film' if model is Film else 'episode',
+                                           [mapping['id'] for mapping in mappings])
+            mappings.clear()
+        if not dry_run:
+            if changes:
+                bump_catalog_version(*changes)
+            db.session.commit()
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_ffprobe, path, ffprobe): (model, content_id, path)
+                   for model, content_id, path in targets}
+
+        for future in as_completed(futures):
+            model, content_id, path = futures[future]
+            done += 1
+            info = future.result()
+            if info is None or info.get('duration') is None:
+                failed += 1
+                echo(f"{model.__tablename__} {content_id}: sonde impossible ({os.path.basename(path)})")
+            else:
+                values = {field: info[field] for field in PROBE_FIELDS if info.get(field) is not None}
+                pending[model].append(dict(values, id=content_id))
+                updated += 1
+
+            if done % batch_size == 0 or done == total:
+                flush()
+                elapsed = time.monotonic() - started
+                echo(f"{done}/{total} sondé(s) - {done / elapsed if elapsed else 0:.1f} fichiers/s")
+
+    elapsed = time.monotonic() - started
+    echo(f"Terminé en {elapsed:.1f}s : {updated} mis à jour, {failed} en erreur"
+         f"{' (aucune écriture, simulation)' if dry_run else ''}.")
+    return updated
@@ -0,0 +1,270 @@
+import os
+import csv
+import io
+import secrets
+import logging
+from collections import Counter
+from datetime import datetime, timedelta
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import insert
+from werkzeug.security import generate_password_hash
+from models import db, User, Film, Season, AccessToken, TokenPurchase, Transaction, ProvisioningJob
+from database import commit_with_retry
+from entitlements import grant_token_purchases
+from stats import add_to_rollup, record_new_clients
+
+
+logger = logging.getLogger(__name__)
+
+# Colonnes du fichier d'import ; films et saisons sont séparés par des « ; »
+# (saisons au format série-saison, comme le formulaire de création)
+CSV_COLUMNS = ['username', 'client_id', 'password', 'films', 'seasons', 'token_duration']
+
+
+class ProvisioningError(Exception):
+    """Erreur de création de comptes, avec le code HTTP à renvoyer"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def parse_film_ids(values):
+    try:
+        return list(dict.fromkeys(int(value) for value in values if value))
+    except ValueError:
+        raise ProvisioningError("Identifiant de film invalide")
+
+
+def parse_season_keys(values):
+    """[(series_id, season_id)] à partir de valeurs « série-saison »"""
+    keys = []
+    for value in values:
+        if not value:
+            continue
+        try:
+            series_id, season_id = value.split('-')
+            keys.append((int(series_id), int(season_id)))
+        except ValueError:
+            raise ProvisioningError(f"Saison invalide : {value}")
+    return list(dict.fromkeys(keys))
+
+
+def resolve_selection(film_ids, season_keys):
+    """
+    Valide les films et saisons demandés avec une requête IN par type.
+
+    Retourne ({id: Film}, {id: Season}) ; un identifiant inconnu ou une
+    saison rattachée à une autre série lève ProvisioningError.
+    """
+    film_ids = set(film_ids)
+    season_ids = {season_id for _, season_id in season_keys}
+    films = {film.id: film for film in Film.query.filter(Film.id.in_(film_ids))} if film_ids else {}
+    seasons = {season.id: season for season in Season.query.filter(Season.id.in_(season_ids))} if season_ids else {}
+
+    unknown_films = film_ids - set(films)
+    if unknown_films:
+        raise ProvisioningError(f"Film(s) introuvable(s) : {', '.join(map(str, sorted(unknown_films)))}")
+    for series_id, season_id in season_keys:
+        if season_id not in seasons or seasons[season_id].series_id != series_id:
+            raise ProvisioningError(f"Saison introuvable : {series_id}-{season_id}")
+    return films, seasons
+
+
+def new_account(username, client_id, password, film_ids, season_keys, token_duration):
+    return {
+        'username': username,
+        'client_id': client_id,
+        'password': password or secrets.token_urlsafe(8),
+        'films': parse_film_ids(film_ids),
+        'seasons': parse_season_keys(season_keys),
+        'token_duration': token_duration
+    }
+
+
+def read_accounts_csv(stream, default_duration, max_accounts):
+    """
+    Comptes décrits par un fichier CSV (en-tête CSV_COLUMNS, séparateur « , »).
+
+    Seuls username et client_id sont obligatoires ; un mot de passe est
+    généré s'il est absent.
+    """
+    try:
+        reader = csv.DictReader(io.StringIO(stream.read().decode('utf-8-sig')))
+    except UnicodeDecodeError:
+        raise ProvisioningError("Le fichier CSV doit être encodé en UTF-8")
+    missing = {'username', 'client_id'} - set(reader.fieldnames or [])
+    if missing:
+        raise ProvisioningError(f"Colonne(s) manquante(s) : {', '.join(sorted(missing))}")
+
+    accounts = []
+    for line, row in enumerate(reader, start=2):
+        username = (row.get('username') or '').strip()
+        client_id = (row.get('client_id') or '').strip()
+        if not username or not client_id:
+            raise ProvisioningError(f"Ligne {line} : username et client_id sont obligatoires")
+        try:
+            duration = int(row.get('token_duration') or default_duration)
+        except ValueError:
+            raise ProvisioningError(f"Ligne {line} : durée invalide")
+        accounts.append(new_account(
+            username, client_id, (row.get('password') or '').strip(),
+            (row.get('films') or '').split(';'), (row.get('seasons') or '').split(';'), duration
+        ))
+        if len(accounts) > max_accounts:
+            raise ProvisioningError(f"Au plus {max_accounts} comptes par import")
+    if not accounts:
+        raise ProvisioningError("Aucun compte dans le fichier")
+    return accounts
+
+
+def hash_passwords(accounts):
+    """
+    Calcule les empreintes des mots de passe en parallèle.
+
+    PBKDF2 coûte plusieurs centaines de millisecondes par compte et libère le
+    GIL : c'est l'étape la plus lente d'un import, à faire hors transaction.
+    """
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+        hashes = executor.map(generate_password_hash, [account['password'] for account in accounts])
+        for account, password_hash in zip(accounts, hashes):
+            account['password_hash'] = password_hash
+    return accounts
+
+
+def validate_accounts(accounts):
+    """
+    Vérifie les comptes avant création (ID client en double ou déjà pris,
+    contenus inconnus) et complète chacun avec total_price. Lecture seule :
+    permet de refuser un import avant de le mettre en file.
+    """
+    client_ids = [account['client_id'] for account in accounts]
+    duplicates = {client_id for client_id, count in Counter(client_ids).items() if count > 1}
+    if duplicates:
+        raise ProvisioningError(f"ID client en double : {', '.join(sorted(duplicates))}")
+    existing = [username for username, in db.session.query(User.username).filter(User.username.in_(client_ids))]
+    if existing:
+        raise ProvisioningError(f"Un utilisateur avec cet ID client existe déjà : {', '.join(existing)}")
+
+    films, seasons = resolve_selection(
+        [film_id for account in accounts for film_id in account['films']],
+        [key for account in accounts for key in account['seasons']]
+    )
+    for account in accounts:
+        account['total_price'] = (sum(films[film_id].price for film_id in account['films']) +
+                                  sum(seasons[season_id].price for _, season_id in account['seasons']))
+    return accounts
+
+
+def provision_clients(accounts, payment_method, admin_id, now=None):
+    """
+    Crée comptes, tokens, achats, droits de lecture, transactions confirmées
+    et statistiques de plusieurs clients, en un nombre fixe de requêtes
+    groupées.
+
+    Écritures en base uniquement (commit par l'appelant, rejouable par
+    commit_with_retry) ; les comptes doivent être passés par hash_passwords.
+    Complète chaque compte avec user_id et total_price (validate_accounts).
+    """
+    now = now or datetime.utcnow()
+    validate_accounts(accounts)
+
+    users = [User(
+        username=account['client_id'],
+        password_hash=account['password_hash'],
+        is_admin=False,
+        email=f"{account['client_id']}@client.local"
+    ) for account in accounts]
+    db.session.add_all(users)
+    db.session.flush()
+
+    for account, user in zip(accounts, users):
+        account['user_id'] = user.id
+
+    # Les achats sont comptés dans les statistiques à leur création (record_new_clients)
+    tokens = [AccessToken(
+        user_id=account['user_id'],
+        expiry_date=now + timedelta(days=account['token_duration']),
+        total_amount=account['total_price'],
+        stats_counted=True
+    ) for account in accounts]
+    db.session.add_all(tokens)
+    db.session.flush()
+
+    purchases = []
+    for account, token in zip(accounts, tokens):
+        purchases += [{'token_id': token.id, 'film_id': film_id, 'series_id': None, 'season_id': None}
+                      for film_id in account['films']]
+        purchases += [{'token_id': token.id, 'film_id': None, 'series_id': series_id, 'season_id': season_id}
+                      for series_id, season_id in account['seasons']]
+    if purchases:
+        db.session.execute(insert(TokenPurchase), purchases)
+        grant_token_purchases([token.id for token in tokens])
+
+    db.session.add_all([Transaction(
+        user_id=account['user_id'],
+        amount=account['total_price'],
+        payment_method=payment_method,
+        status='confirmed',
+        transaction_date=now,
+        confirmed_date=now,
+        confirmed_by=admin_id,
+        description=(f"Compte créé par admin pour {account['username']} - "
+                     f"{len(account['films'])} films, {len(account['seasons'])} saisons")
+    ) for account in accounts])
+    add_to_rollup(now.date(), 'confirmed', payment_method, len(accounts),
+                  sum(account['total_price'] for account in accounts))
+
+    record_new_clients({
+        account['user_id']: (account['total_price'], len(account['films']), len(account['seasons']))
+        for account in accounts
+    }, now)
+    return accounts
+
+
+_executor = None
+
+
+def get_executor(app):
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='provisioning')
+    return _executor
+
+
+def run_import(app, job_id, accounts, payment_method, admin_id):
+    """Empreintes des mots de passe puis création des comptes, hors requête"""
+    with app.app_context():
+        ProvisioningJob.query.filter_by(id=job_id).update({'status': 'running'}, synchronize_session=False)
+        db.session.commit()
+        try:
+            hash_passwords(accounts)
+            commit_with_retry(partial(provision_clients, accounts, payment_method, admin_id))
+            values = {'status': 'done'}
+        except ProvisioningError as e:
+            db.session.rollback()
+            values = {'status': 'failed', 'error': e.message}
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Import de comptes clients {job_id} impossible : {e}")
+            values = {'status': 'failed', 'error': str(e)}
+        values['finished_date'] = datetime.utcnow()
+        ProvisioningJob.query.filter_by(id=job_id).update(values, synchronize_session=False)
+        db.session.commit()
+
+
+def schedule_import(app, accounts, payment_method, admin_id):
+    """
+    Met en file la création de comptes validés par validate_accounts.
+
+    PBKDF2 coûte environ 0,2 s par compte : un import de plusieurs centaines
+    de comptes dépasse le délai d'une requête. Retourne la ProvisioningJob,
+    à suivre jusqu'à l'état done ou failed.
+    """
+    job = ProvisioningJob(admin_id=admin_id, total=len(accounts))
+    db.session.add(job)
+    db.session.commit()
+    get_executor(app).submit(run_import, app, job.id, accounts, payment_method, admin_id)
+    return job
@@ -0,0 +1,135 @@
+import os
+import shutil
+import logging
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import insert, text
+from models import db, MediaBlob, MediaTombstone
+
+
+logger = logging.getLogger(__name__)
+
+# Tombstones traités par passage du récupérateur
+RECLAIM_BATCH_SIZE = 500
+
+_executor = None
+
+
+def get_executor(app):
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='reclaim')
+    return _executor
+
+
+def tombstone(upload_folder, paths, is_directory=False):
+    """
+    Enregistre des fichiers (ou dossiers) à supprimer, dans la transaction
+    courante : ils ne quittent le disque qu'une fois la suppression des lignes
+    validée, et une erreur d'accès disque ne bloque plus la requête.
+    """
+    rows = [{'path': os.path.relpath(path, upload_folder), 'is_directory': is_directory}
+            for path in dict.fromkeys(paths)]
+    if rows:
+        db.session.execute(insert(MediaTombstone), rows)
+
+
+def lock_blob(digest):
+    """
+    Verrou de transaction sur un fichier du stockage partagé (PostgreSQL).
+
+    Sérialise acquire_media et reclaim_tombstones pour un même contenu ; sous
+    SQLite, le verrou d'écriture de la base joue ce rôle.
+    """
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(text("SELECT pg_advisory_xact_lock(hashtext(:digest))"), {'digest': digest})
+
+
+def blob_key(path):
+    """(sha256, extension) du fichier partagé visé par un tombstone (fichier ou cache HLS), sinon None"""
+    parts = path.replace(os.sep, '/').split('/')
+    if parts[0] == 'hls':
+        parts = parts[1:]
+    if len(parts) != 3 or parts[0] != 'blobs' or parts[1] == 'tmp':
+        return None
+    return os.path.splitext(parts[2])
+
+
+def remove_path(path, is_directory):
+    if is_directory:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def reclaim_tombstones(app, now=None):
+    """
+    Supprime du disque les fichiers des tombstones arrivés à échéance.
+
+    Chaque tombstone est traité dans sa propre transaction : la ligne est
+    supprimée en premier (verrou d'écriture), puis, pour un fichier partagé,
+    on vérifie qu'il n'a pas été référencé de nouveau depuis sa libération
+    (ligne MediaBlob) ; dans ce cas il reste sur disque. En cas d'échec, le
+    tombstone est reprogrammé avec un délai doublé à chaque tentative.
+    Retourne (supprimés, en échec).
+    """
+    upload_folder = app.config['UPLOAD_FOLDER']
+    retry_delay = app.config.get('RECLAIM_RETRY_DELAY', 60)
+    reclaimed = failed = 0
+
+    with app.app_context():
+        while True:
+            tombstones = MediaTombstone.query.filter(
+                MediaTombstone.next_attempt <= (now or datetime.utcnow())
+            ).order_by(MediaTombstone.id).with_entities(
+                MediaTombstone.id, MediaTombstone.path, MediaTombstone.is_directory, MediaTombstone.attempts
+            ).limit(RECLAIM_BATCH_SIZE).all()
+            db.session.commit()
+            if not tombstones:
+                break
+
+            for tombstone_id, path, is_directory, attempts in tombstones:
+                key = blob_key(path)
+                if key:
+                    lock_blob(key[0])
+                if not MediaTombstone.query.filter_by(id=tombstone_id).delete(synchronize_session=False):
+                    # Déjà traité par un autre passage
+                    db.session.rollback()
+                    continue
+                try:
+                    if not (key and MediaBlob.query.filter_by(sha256=key[0], extension=key[1]).count()):
+                        remove_path(os.path.join(upload_folder, path), is_directory)
+                    db.session.commit()
+                    reclaimed += 1
+                except OSError as e:
+                    db.session.rollback()
+                    logger.warning(f"Suppression de {path} impossible : {e}")
+                    attempts = (attempts or 0) + 1
+                    MediaTombstone.query.filter_by(id=tombstone_id).update({
+                        'attempts': attempts,
+                        'last_error': str(e),
+                        'next_attempt': datetime.utcnow() + timedelta(seconds=retry_delay * 2 ** (attempts - 1))
+                    }, synchronize_session=False)
+                    db.session.commit()
+                    failed += 1
+            if len(tombstones) < RECLAIM_BATCH_SIZE:
+                break
+    return reclaimed, failed
+
+
+def run_reclaim(app):
+    try:
+        reclaim_tombstones(app)
+    except Exception as e:
+        logger.error(f"Récupération des fichiers supprimés interrompue : {e}")
+
+
+def schedule_reclaim(app):
+    """
+    Lance la récupération en arrière-plan (après le commit de la suppression).
+
+    Un seul thread : les passages s'enchaînent. Les tombstones en échec sont
+    repris au passage suivant ou par `flask reclaim-media` (cron).
+    """
+    get_executor(app).submit(run_reclaim, app)
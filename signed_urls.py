@@ -0,0 +1,48 @@
+import hmac
+import time
+import base64
+import hashlib
+
+
+def stream_resource(content_type, content_id):
+    """Chemin signé : couvre le flux progressif et les fichiers HLS du contenu"""
+    return f"/stream/{content_type}/{content_id}"
+
+
+def stream_signature(secret, resource, user_id, expires):
+    message = f"{resource}\n{user_id}\n{expires}".encode('utf-8')
+    digest = hmac.new(secret.encode('utf-8'), message, hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode('ascii')
+
+
+def sign_stream_url(secret, content_type, content_id, user_id, ttl):
+    """Paramètres d'URL signés (utilisateur, expiration, signature) à passer à url_for"""
+    expires = int(time.time()) + ttl
+    resource = stream_resource(content_type, content_id)
+    return {
+        'user': user_id,
+        'expires': expires,
+        'signature': stream_signature(secret, resource, user_id, expires)
+    }
+
+
+def verify_stream_url(secret, content_type, content_id, args):
+    """
+    Vérifie les paramètres signés d'une requête de streaming.
+
+    Retourne l'identifiant de l'utilisateur si la signature est valide et non
+    expirée, sinon None. Aucune session ni requête SQL n'est nécessaire : un
+    proxy qui connaît le secret peut faire la même vérification.
+    """
+    try:
+        user_id = int(args.get('user', ''))
+        expires = int(args.get('expires', ''))
+    except ValueError:
+        return None
+    if expires < time.time():
+        return None
+
+    expected = stream_signature(secret, stream_resource(content_type, content_id), user_id, expires)
+    if not hmac.compare_digest(expected, args.get('signature', '')):
+        return None
+    return user_id
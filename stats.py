@@ -0,0 +1,252 @@
+from datetime import datetime
+from sqlalchemy import and_, case, func, insert, literal_column, select
+from sqlalchemy.exc import IntegrityError
+from models import db, Film, Season, Transaction, TransactionRollup, AccessToken, TokenPurchase, ClientStats
+
+
+def add_to_rollup(day, status, payment_method, count, amount):
+    """Ajoute (count, amount) au compteur du jour ; crée la ligne si besoin"""
+    key = dict(day=day, status=status or 'pending', payment_method=payment_method)
+    values = {
+        'count': TransactionRollup.count + count,
+        'amount': TransactionRollup.amount + amount
+    }
+    if TransactionRollup.query.filter_by(**key).update(values, synchronize_session=False):
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(TransactionRollup(count=count, amount=amount, **key))
+    except IntegrityError:
+        # Ligne créée en parallèle par une autre requête
+        TransactionRollup.query.filter_by(**key).update(values, synchronize_session=False)
+
+
+def record_transaction(transaction):
+    """À appeler après chaque création de Transaction, avant le commit"""
+    if transaction.transaction_date is None:
+        transaction.transaction_date = datetime.utcnow()
+    add_to_rollup(transaction.transaction_date.date(), transaction.status,
+                  transaction.payment_method, 1, transaction.amount or 0)
+
+
+def record_status_change(transaction, old_status):
+    """À appeler après chaque changement de statut, avant le commit"""
+    if old_status == transaction.status:
+        return
+    day = transaction.transaction_date.date()
+    amount = transaction.amount or 0
+    add_to_rollup(day, old_status, transaction.payment_method, -1, -amount)
+    add_to_rollup(day, transaction.status, transaction.payment_method, 1, amount)
+
+
+def transaction_totals(now=None):
+    """
+    Compteurs et revenus des tableaux de bord, lus dans la table d'agrégats.
+
+    Une seule requête sur quelques lignes par jour, quelle que soit la taille
+    de la table des transactions.
+    """
+    month_start = (now or datetime.utcnow()).date().replace(day=1)
+    # Agrégat conditionnel plutôt qu'un GROUP BY sur une expression paramétrée
+    # (refusé par PostgreSQL : chaque occurrence reçoit son propre paramètre)
+    month_amount = case((TransactionRollup.day >= month_start, TransactionRollup.amount), else_=0)
+    rows = db.session.query(
+        TransactionRollup.status, TransactionRollup.payment_method,
+        func.sum(TransactionRollup.count), func.sum(TransactionRollup.amount), func.sum(month_amount)
+    ).group_by(TransactionRollup.status, TransactionRollup.payment_method).all()
+
+    totals = {
+        'total_transactions': 0,
+        'pending_transactions': 0,
+        'confirmed_transactions': 0,
+        'rejected_transactions': 0,
+        'total_revenue': 0,
+        'monthly_revenue': 0,
+        'admin_created_revenue': 0,
+        'revenue_by_payment_method': {}
+    }
+    for status, payment_method, count, amount, monthly_amount in rows:
+        totals['total_transactions'] += count or 0
+        if f'{status}_transactions' in totals:
+            totals[f'{status}_transactions'] += count or 0
+        if status != 'confirmed':
+            continue
+        totals['total_revenue'] += amount or 0
+        totals['monthly_revenue'] += monthly_amount or 0
+        if payment_method == 'admin_creation':
+            totals['admin_created_revenue'] += amount or 0
+        by_method = totals['revenue_by_payment_method']
+        by_method[payment_method] = by_method.get(payment_method, 0) + (amount or 0)
+    return totals
+
+
+def rebuild_transaction_stats():
+    """Recalcule toute la table d'agrégats avec un INSERT ... SELECT groupé"""
+    db.session.query(TransactionRollup).delete(synchronize_session=False)
+
+    # date() existe sous SQLite et PostgreSQL ; 'pending' est écrit en clair pour
+    # que SELECT et GROUP BY portent sur la même expression
+    day = func.date(Transaction.transaction_date)
+    status = func.coalesce(Transaction.status, literal_column("'pending'"))
+    rows = select(
+        day, status, Transaction.payment_method,
+        func.count(Transaction.id), func.sum(Transaction.amount)
+    ).group_by(day, status, Transaction.payment_method)
+    db.session.execute(insert(TransactionRollup).from_select(
+        ['day', 'status', 'payment_method', 'count', 'amount'], rows
+    ))
+    db.session.commit()
+    return TransactionRollup.query.count()
+
+
+def client_stats_for(user_id):
+    """Ligne ClientStats du client, créée à zéro si besoin"""
+    stats = ClientStats.query.filter_by(user_id=user_id).first()
+    if not stats:
+        stats = ClientStats(user_id=user_id, total_spent=0, total_films=0, total_series=0)
+        db.session.add(stats)
+        db.session.flush()
+    return stats
+
+
+def add_to_client_stats(user_id, spent=0, films=0, series=0):
+    """Applique un delta aux compteurs d'un client (UPDATE atomique)"""
+    client_stats_for(user_id)
+    ClientStats.query.filter_by(user_id=user_id).update({
+        'total_spent': ClientStats.total_spent + spent,
+        'total_films': ClientStats.total_films + films,
+        'total_series': ClientStats.total_series + series,
+        'updated_date': datetime.utcnow()
+    }, synchronize_session=False)
+
+
+def record_purchase(access_token, purchase, price):
+    """
+    Événement « achat créé » : à appeler avec chaque nouveau TokenPurchase,
+    avant le commit. `price` est le prix du film ou de la saison, déjà chargé
+    par l'appelant.
+    """
+    access_token.stats_counted = True
+    if purchase.film_id:
+        add_to_client_stats(access_token.user_id, spent=price, films=1)
+    elif purchase.series_id and purchase.season_id:
+        add_to_client_stats(access_token.user_id, spent=price, series=1)
+
+
+def record_confirmation(transaction):
+    """Événement « transaction confirmée » : date du dernier achat"""
+    client_stats_for(transaction.user_id)
+    ClientStats.query.filter(
+        ClientStats.user_id == transaction.user_id,
+        (ClientStats.last_purchase_date == None) |
+        (ClientStats.last_purchase_date < transaction.confirmed_date)
+    ).update({'last_purchase_date': transaction.confirmed_date}, synchronize_session=False)
+
+
+def record_new_clients(totals, purchase_date):
+    """
+    Événements « achat créé » et « transaction confirmée » de clients créés
+    en masse dans la transaction courante (aucune ligne ClientStats encore) :
+    `totals` vaut {user_id: (dépense, films, saisons)}.
+    """
+    db.session.bulk_insert_mappings(ClientStats, [{
+        'user_id': user_id,
+        'total_spent': spent,
+        'total_films': films,
+        'total_series': series,
+        'last_purchase_date': purchase_date,
+        'updated_date': purchase_date
+    } for user_id, (spent, films, series) in totals.items()])
+
+
+def token_totals(token_filter):
+    """
+    Totaux (dépense, films, saisons) par client sur les tokens filtrés.
+
+    Deux requêtes groupées (films, saisons) ; retourne
+    {user_id: [dépense, films, saisons]}.
+    """
+    totals = {}
+    film_rows = db.session.query(
+        AccessToken.user_id, func.count(TokenPurchase.id), func.sum(Film.price)
+    ).join(TokenPurchase, TokenPurchase.token_id == AccessToken.id
+    ).join(Film, Film.id == TokenPurchase.film_id
+    ).filter(token_filter).group_by(AccessToken.user_id)
+
+    season_rows = db.session.query(
+        AccessToken.user_id, func.count(TokenPurchase.id), func.sum(Season.price)
+    ).join(TokenPurchase, TokenPurchase.token_id == AccessToken.id
+    ).join(Season, Season.id == TokenPurchase.season_id
+    ).filter(token_filter, TokenPurchase.film_id == None, TokenPurchase.series_id != None
+    ).group_by(AccessToken.user_id)
+
+    for user_id, count, spent in film_rows:
+        entry = totals.setdefault(user_id, [0, 0, 0])
+        entry[0] += spent or 0
+        entry[1] += count
+    for user_id, count, spent in season_rows:
+        entry = totals.setdefault(user_id, [0, 0, 0])
+        entry[0] += spent or 0
+        entry[2] += count
+    return totals
+
+
+def expire_client_stats(now=None):
+    """
+    Événement « token expiré » : retire des statistiques les achats des
+    tokens expirés depuis le dernier passage (à lancer périodiquement).
+    Retourne le nombre de tokens traités.
+    """
+    now = now or datetime.utcnow()
+    expired = and_(
+        AccessToken.stats_counted == True,
+        AccessToken.expiry_date != None,
+        AccessToken.expiry_date < now
+    )
+    for user_id, (spent, films, series) in token_totals(expired).items():
+        add_to_client_stats(user_id, spent=-spent, films=-films, series=-series)
+
+    count = AccessToken.query.filter(expired).update({'stats_counted': False}, synchronize_session=False)
+    db.session.commit()
+    return count
+
+
+def rebuild_client_stats(user_ids=None, now=None):
+    """
+    Recalcule les statistiques de tous les clients (ou de `user_ids`) avec
+    quelques requêtes groupées, au lieu d'un parcours token par token.
+    Retourne le nombre de clients mis à jour.
+    """
+    now = now or datetime.utcnow()
+    active = (AccessToken.expiry_date == None) | (AccessToken.expiry_date >= now)
+    token_scope = and_(active, AccessToken.user_id.in_(user_ids)) if user_ids is not None else active
+    totals = token_totals(token_scope)
+
+    last_purchases = db.session.query(
+        Transaction.user_id, func.max(Transaction.confirmed_date)
+    ).filter(Transaction.status == 'confirmed')
+    if user_ids is not None:
+        last_purchases = last_purchases.filter(Transaction.user_id.in_(user_ids))
+    last_purchases = dict(last_purchases.group_by(Transaction.user_id).all())
+
+    stats_query = db.session.query(ClientStats)
+    tokens_query = AccessToken.query
+    if user_ids is not None:
+        stats_query = stats_query.filter(ClientStats.user_id.in_(user_ids))
+        tokens_query = tokens_query.filter(AccessToken.user_id.in_(user_ids))
+    stats_query.delete(synchronize_session=False)
+
+    mappings = [{
+        'user_id': user_id,
+        'total_spent': totals.get(user_id, [0, 0, 0])[0],
+        'total_films': totals.get(user_id, [0, 0, 0])[1],
+        'total_series': totals.get(user_id, [0, 0, 0])[2],
+        'last_purchase_date': last_purchases.get(user_id),
+        'updated_date': now
+    } for user_id in set(totals) | set(last_purchases)]
+    db.session.bulk_insert_mappings(ClientStats, mappings)
+
+    # Les tokens actifs sont désormais comptés, les expirés non
+    tokens_query.update({'stats_counted': case((active, True), else_=False)}, synchronize_session=False)
+    db.session.commit()
+    return len(mappings)
@@ -0,0 +1,273 @@
+import os
+import re
+import uuid
+from datetime import datetime, timezone
+from flask import Response, current_app
+from werkzeug.http import http_date, parse_date
+
+
+# Types MIME des formats vidéo acceptés à l'upload
+VIDEO_MIME_TYPES = {
+    '.mp4': 'video/mp4',
+    '.avi': 'video/x-msvideo',
+    '.mkv': 'video/x-matroska',
+    '.mov': 'video/quicktime',
+    '.wmv': 'video/x-ms-wmv'
+}
+
+# Une spécification de plage : "debut-fin", "debut-" ou "-suffixe"
+RANGE_SPEC_RE = re.compile(r'^(\d*)-(\d*)$')
+
+# Nombre maximal de plages acceptées dans un même en-tête Range
+MAX_RANGES = 16
+
+
+def get_video_mime_type(filename):
+    """Retourne le type MIME d'une vidéo à partir de son extension"""
+    file_ext = os.path.splitext(filename)[1].lower()
+    return VIDEO_MIME_TYPES.get(file_ext, 'video/mp4')
+
+
+def iter_file_range(file_path, start, length, chunk_size):
+    """
+    Lecture d'une plage d'octets par blocs, utilisée pour les réponses
+    multipart et quand le serveur WSGI ne fournit pas de wsgi.file_wrapper
+    """
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        remaining = length
+        while remaining > 0:
+            data = f.read(min(chunk_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+
+def file_range_body(environ, file_path, start, length):
+    """
+    Construit le corps de réponse pour une plage d'octets.
+
+    Le fichier est ouvert et positionné sur `start` puis confié au
+    wsgi.file_wrapper du serveur : gunicorn (workers sync/gthread) transmet
+    alors les octets avec os.sendfile() à partir de la position courante et
+    s'arrête au Content-Length, sans copie en espace utilisateur.
+    """
+    file_wrapper = environ.get('wsgi.file_wrapper')
+    chunk_size = current_app.config.get('STREAM_CHUNK_SIZE', 256 * 1024)
+
+    if file_wrapper is None:
+        return iter_file_range(file_path, start, length, chunk_size)
+
+    f = open(file_path, 'rb')
+    f.seek(start)
+    return file_wrapper(f, chunk_size)
+
+
+def offload_headers(file_path):
+    """
+    En-têtes de délégation au proxy frontal (X-Sendfile pour Apache/lighttpd,
+    X-Accel-Redirect pour nginx). Retourne None si le moteur est 'sendfile'.
+    """
+    backend = current_app.config.get('STREAM_BACKEND', 'sendfile')
+
+    if backend == 'x-sendfile':
+        return {'X-Sendfile': os.path.abspath(file_path)}
+
+    if backend == 'x-accel':
+        # Chemin interne nginx correspondant au dossier d'upload
+        upload_folder = os.path.abspath(current_app.config['UPLOAD_FOLDER'])
+        relative_path = os.path.relpath(os.path.abspath(file_path), upload_folder)
+        prefix = current_app.config.get('STREAM_ACCEL_PREFIX', '/protected-media/')
+        return {'X-Accel-Redirect': prefix.rstrip('/') + '/' + relative_path.replace(os.sep, '/')}
+
+    return None
+
+
+def file_validators(file_path):
+    """Retourne (taille, ETag fort, Last-Modified) d'un fichier"""
+    stat = os.stat(file_path)
+    etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+    last_modified = datetime.fromtimestamp(int(stat.st_mtime), tz=timezone.utc)
+    return stat.st_size, etag, last_modified
+
+
+def parse_range_header(range_header, file_size):
+    """
+    Analyse un en-tête Range (RFC 7233).
+
+    Retourne None si l'en-tête est invalide ou doit être ignoré (réponse 200
+    complète), une liste vide si aucune plage n'est satisfaisable (416), sinon
+    la liste triée et fusionnée des plages (début, fin) inclusives.
+    """
+    unit, _, specs = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or not specs.strip():
+        return None
+
+    ranges = []
+    for spec in specs.split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        match = RANGE_SPEC_RE.match(spec)
+        if not match:
+            return None
+        first, last = match.group(1), match.group(2)
+
+        if first:
+            start = int(first)
+            if last:
+                end = int(last)
+                if end < start:
+                    return None
+            else:
+                end = file_size - 1
+            # Plage non satisfaisable : début au-delà de la fin du fichier
+            if start >= file_size:
+                continue
+            ranges.append((start, min(end, file_size - 1)))
+        elif last:
+            # Plage suffixe : les N derniers octets (ex. atome moov en fin de MP4)
+            suffix_length = int(last)
+            if suffix_length == 0 or file_size == 0:
+                continue
+            ranges.append((max(file_size - suffix_length, 0), file_size - 1))
+        else:
+            return None
+
+    if len(ranges) > MAX_RANGES:
+        return None
+
+    # Fusionner les plages qui se chevauchent ou se touchent
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def if_range_matches(request, etag, last_modified):
+    """Vérifie la précondition If-Range (ETag fort ou date exacte)"""
+    if_range = request.headers.get('If-Range')
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"'):
+        return if_range == etag
+    if if_range.startswith('W/'):
+        return False
+    date = parse_date(if_range)
+    return date is not None and date == last_modified
+
+
+def not_modified(request, etag, last_modified):
+    """Vérifie If-None-Match puis If-Modified-Since"""
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        if if_none_match.strip() == '*':
+            return True
+        # Comparaison faible : W/"x" correspond à "x"
+        candidates = [tag.strip() for tag in if_none_match.split(',')]
+        return etag in [tag[2:] if tag.startswith('W/') else tag for tag in candidates]
+
+    if_modified_since = parse_date(request.headers.get('If-Modified-Since'))
+    if if_modified_since is not None:
+        return last_modified <= if_modified_since
+    return False
+
+
+def multipart_body(file_path, ranges, part_headers, closing, chunk_size):
+    """Génère le corps multipart/byteranges"""
+    for (start, end), headers in zip(ranges, part_headers):
+        yield headers
+        yield from iter_file_range(file_path, start, end - start + 1, chunk_size)
+    yield closing
+
+
+def serve_video(request, file_path):
+    """
+    Sert un fichier vidéo, en entier (200), par plage(s) d'octets (206,
+    multipart/byteranges si plusieurs plages) ou avec 304/416.
+
+    Selon STREAM_BACKEND, les octets sont envoyés par le noyau (sendfile) ou
+    par le proxy frontal (x-sendfile / x-accel), qui gère alors lui-même les
+    requêtes Range et conditionnelles.
+    """
+    mime_type = get_video_mime_type(file_path)
+
+    headers = offload_headers(file_path)
+    if headers is not None:
+        headers['Content-Type'] = mime_type
+        return Response(b'', 200, headers)
+
+    file_size, etag, last_modified = file_validators(file_path)
+    base_headers = {
+        'Accept-Ranges': 'bytes',
+        'ETag': etag,
+        'Last-Modified': http_date(last_modified),
+    }
+
+    if not_modified(request, etag, last_modified):
+        return Response(status=304, headers=base_headers)
+
+    ranges = None
+    range_header = request.headers.get('Range')
+    if range_header and if_range_matches(request, etag, last_modified):
+        ranges = parse_range_header(range_header, file_size)
+
+    if ranges is None:
+        return Response(
+            file_range_body(request.environ, file_path, 0, file_size),
+            200,
+            dict(base_headers, **{
+                'Content-Type': mime_type,
+                'Content-Length': str(file_size),
+            }),
+            direct_passthrough=True
+        )
+
+    if not ranges:
+        return Response(
+            b'',
+            416,
+            dict(base_headers, **{'Content-Range': f'bytes */{file_size}'})
+        )
+
+    if len(ranges) == 1:
+        byte_start, byte_end = ranges[0]
+        length = byte_end - byte_start + 1
+        return Response(
+            file_range_body(request.environ, file_path, byte_start, length),
+            206,
+            dict(base_headers, **{
+                'Content-Type': mime_type,
+                'Content-Range': f'bytes {byte_start}-{byte_end}/{file_size}',
+                'Content-Length': str(length),
+            }),
+            direct_passthrough=True
+        )
+
+    # Plusieurs plages : réponse multipart/byteranges
+    boundary = uuid.uuid4().hex
+    part_headers = [
+        (f'\r\n--{boundary}\r\n'
+         f'Content-Type: {mime_type}\r\n'
+         f'Content-Range: bytes {start}-{end}/{file_size}\r\n\r\n').encode('ascii')
+        for start, end in ranges
+    ]
+    closing = f'\r\n--{boundary}--\r\n'.encode('ascii')
+    content_length = sum(len(h) for h in part_headers) \
+        + sum(end - start + 1 for start, end in ranges) + len(closing)
+
+    chunk_size = current_app.config.get('STREAM_CHUNK_SIZE', 256 * 1024)
+    return Response(
+        multipart_body(file_path, ranges, part_headers, closing, chunk_size),
+        206,
+        dict(base_headers, **{
+            'Content-Type': f'multipart/byteranges; boundary={boundary}',
+            'Content-Length': str(content_length),
+        }),
+        direct_passthrough=True
+    )
@@ -0,0 +1,130 @@
+import os
+import uuid
+import logging
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from models import db, Film, Episode, Rendition
+from probing import probe_media
+from media_store import media_path
+from reclaim import tombstone
+
+
+logger = logging.getLogger(__name__)
+
+# Exécuteur partagé : ffmpeg tourne dans un sous-processus, un thread suffit
+# pour le piloter sans bloquer la requête d'upload
+_executor = None
+
+
+def get_executor(app):
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=app.config.get('TRANSCODE_WORKERS', 1),
+            thread_name_prefix='transcode'
+        )
+    return _executor
+
+
+def renditions_folder(upload_folder):
+    return os.path.join(upload_folder, 'renditions')
+
+
+def transcode_rendition(source_path, output_path, height, video_bitrate, audio_bitrate, ffmpeg='ffmpeg'):
+    """
+    Encode une version H.264/AAC à la hauteur et au débit donnés.
+
+    Le fichier est écrit sous un nom temporaire puis renommé, avec l'atome
+    moov en tête (faststart) pour un démarrage rapide de la lecture.
+    """
+    tmp_path = output_path + '.part'
+    cmd = [
+        ffmpeg, '-v', 'error', '-y', '-i', source_path,
+        '-map', '0:v:0', '-map', '0:a:0?',
+        '-vf', f'scale=-2:{height}',
+        '-c:v', 'libx264', '-preset', 'veryfast', '-profile:v', 'main',
+        '-b:v', f'{video_bitrate}k', '-maxrate', f'{video_bitrate}k', '-bufsize', f'{video_bitrate * 2}k',
+        '-c:a', 'aac', '-b:a', f'{audio_bitrate}k', '-ac', '2',
+        '-movflags', '+faststart',
+        '-f', 'mp4', tmp_path
+    ]
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise RuntimeError(result.stderr.strip() or f"ffmpeg a échoué ({result.returncode})")
+    os.replace(tmp_path, output_path)
+
+
+def build_renditions(app, content_type, content_id):
+    """Génère toutes les versions de l'échelle pour un film ou un épisode"""
+    with app.app_context():
+        if content_type == 'film':
+            content = Film.query.get(content_id)
+            source_folder = 'films'
+        else:
+            content = Episode.query.get(content_id)
+            source_folder = 'episodes'
+        if not content:
+            return
+
+        source_path = media_path(app.config['UPLOAD_FOLDER'], source_folder, content.chemin)
+        if not os.path.exists(source_path):
+            return
+
+        output_folder = renditions_folder(app.config['UPLOAD_FOLDER'])
+        os.makedirs(output_folder, exist_ok=True)
+
+        # Ne pas produire de version plus haute que l'original
+        source_height = (probe_media(source_path, app.config['FFPROBE_BINARY']) or {}).get('height')
+
+        for step in app.config['RENDITION_LADDER']:
+            if source_height and step['height'] >= source_height:
+                continue
+            existing = [r for r in content.renditions if r.height == step['height']]
+            if any(r.status == 'ready' for r in existing):
+                continue
+
+            # Tâche précédente échouée ou interrompue : reprendre sa ligne (et
+            # retirer d'éventuels doublons) plutôt que d'en ajouter une
+            if existing:
+                rendition = existing[0]
+                for duplicate in existing[1:]:
+                    content.renditions.remove(duplicate)
+            else:
+                rendition = Rendition(height=step['height'])
+                content.renditions.append(rendition)
+            rendition.video_bitrate = step['video_bitrate']
+            rendition.audio_bitrate = step['audio_bitrate']
+            rendition.chemin = None
+            rendition.status = 'pending'
+            db.session.commit()
+
+            filename = f"{uuid.uuid4()}_{step['height']}p.mp4"
+            try:
+                transcode_rendition(
+                    source_path, os.path.join(output_folder, filename),
+                    step['height'], step['video_bitrate'], step['audio_bitrate'],
+                    ffmpeg=app.config['FFMPEG_BINARY']
+                )
+                rendition.chemin = filename
+                rendition.status = 'ready'
+            except Exception as e:
+                logger.error(f"Transcodage {content_type} {content_id} en {step['height']}p impossible : {e}")
+                rendition.status = 'failed'
+            db.session.commit()
+
+
+def schedule_renditions(app, content_type, content_id):
+    """Met en file la génération des versions basse résolution (après commit)"""
+    get_executor(app).submit(build_renditions, app, content_type, content_id)
+
+
+def remove_renditions(upload_folder, renditions):
+    """
+    Confie les fichiers des versions transcodées aux tombstones (les lignes
+    partent en cascade) : supprimés après le commit par schedule_reclaim,
+    jamais si la transaction est annulée.
+    """
+    tombstone(upload_folder, [os.path.join(renditions_folder(upload_folder), rendition.chemin)
+                              for rendition in renditions if rendition.chemin])
@@ -0,0 +1,261 @@
+import os
+import uuid
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from werkzeug.utils import secure_filename
+from models import db, UploadSession
+from media_store import BLOB_PREFIX, media_path, place_blob, place_file, file_extension, hash_file, acquire_media
+from reclaim import tombstone
+from database import commit_with_retry
+
+
+# Taille des blocs lus depuis le flux de la requête
+READ_BLOCK_SIZE = 1024 * 1024
+
+# Algorithmes acceptés dans l'en-tête Upload-Checksum
+CHECKSUM_ALGORITHMS = {
+    'sha256': hashlib.sha256,
+    'sha1': hashlib.sha1,
+    'md5': hashlib.md5
+}
+
+# Empreintes SHA-256 en cours par upload, mises à jour morceau par morceau
+# dans le processus qui les reçoit. L'état d'un hashlib ne se sauvegarde pas
+# en base : si un morceau arrive dans un autre processus (ou après un
+# redémarrage), le fichier est relu une fois à la fin de l'upload.
+RUNNING_DIGESTS_SIZE = 256
+_running_digests = OrderedDict()
+_running_digests_lock = threading.Lock()
+
+# Dossier de destination par type de contenu
+UPLOAD_FOLDERS = {
+    'film': 'films',
+    'episode': 'episodes'
+}
+
+
+class UploadError(Exception):
+    """Erreur d'upload, avec le code HTTP à renvoyer"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def upload_path(upload_folder, upload):
+    return media_path(upload_folder, UPLOAD_FOLDERS[upload.kind], upload.filename)
+
+
+def create_upload(upload_folder, user_id, kind, original_filename, size, max_size, allowed_extensions):
+    """
+    Ouvre une session d'upload et crée le fichier final, vide.
+
+    Les morceaux sont ensuite écrits directement dans ce fichier : pas de
+    fichier temporaire ni de copie à la fin.
+    """
+    if kind not in UPLOAD_FOLDERS:
+        raise UploadError("Type de contenu inconnu")
+    if '.' not in original_filename or original_filename.rsplit('.', 1)[1].lower() not in allowed_extensions:
+        raise UploadError("Format de fichier vidéo non supporté")
+    if not isinstance(size, int) or size <= 0:
+        raise UploadError("Taille de fichier invalide")
+    if size > max_size:
+        raise UploadError("Fichier trop volumineux", 413)
+
+    filename = f"{uuid.uuid4()}_{secure_filename(original_filename)}"
+    upload = UploadSession(
+        user_id=user_id,
+        kind=kind,
+        original_filename=original_filename,
+        filename=filename,
+        size=size,
+        received=0
+    )
+
+    path = upload_path(upload_folder, upload)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'wb').close()
+
+    db.session.add(upload)
+    db.session.commit()
+    return upload
+
+
+def take_running_digest(upload_id, offset):
+    """Empreinte en cours d'un upload si elle couvre exactement `offset` octets, sinon None"""
+    with _running_digests_lock:
+        item = _running_digests.pop(upload_id, None)
+    if offset == 0:
+        return hashlib.sha256()
+    if item is None or item[0] != offset:
+        return None
+    return item[1]
+
+
+def keep_running_digest(upload_id, offset, digest):
+    with _running_digests_lock:
+        _running_digests[upload_id] = (offset, digest)
+        while len(_running_digests) > RUNNING_DIGESTS_SIZE:
+            _running_digests.popitem(last=False)
+
+
+def parse_checksum(header):
+    """Analyse 'Upload-Checksum: <algo> <base64>' ; retourne (algo, digest) ou None"""
+    if not header:
+        return None
+    algorithm, _, encoded = header.strip().partition(' ')
+    algorithm = algorithm.lower()
+    if algorithm not in CHECKSUM_ALGORITHMS:
+        raise UploadError("Algorithme de somme de contrôle non supporté")
+    try:
+        return algorithm, base64.b64decode(encoded.strip(), validate=True)
+    except ValueError:
+        raise UploadError("Somme de contrôle mal formée")
+
+
+def write_chunk(upload_folder, upload, offset, stream, content_length, checksum_header=None):
+    """
+    Écrit un morceau à la position `offset` du fichier final.
+
+    L'offset doit correspondre aux octets déjà reçus (409 sinon). Si une somme
+    de contrôle est fournie et ne correspond pas, le fichier est tronqué à son
+    état précédent (460). Les données sont synchronisées sur disque avant que
+    le nouvel offset soit enregistré, pour qu'une reprise reparte toujours
+    d'octets réellement écrits.
+    """
+    if upload.status != 'uploading':
+        raise UploadError("Upload déjà terminé", 409)
+    if offset != upload.received:
+        raise UploadError("Upload-Offset ne correspond pas aux octets reçus", 409)
+    if content_length is None or offset + content_length > upload.size:
+        raise UploadError("Morceau hors des limites du fichier", 400)
+
+    checksum = parse_checksum(checksum_header)
+    digest = CHECKSUM_ALGORITHMS[checksum[0]]() if checksum else None
+    file_digest = take_running_digest(upload.id, offset)
+
+    path = upload_path(upload_folder, upload)
+    written = 0
+    with open(path, 'r+b') as f:
+        f.seek(offset)
+        while written < content_length:
+            data = stream.read(min(READ_BLOCK_SIZE, content_length - written))
+            if not data:
+                break
+            f.write(data)
+            if digest:
+                digest.update(data)
+            if file_digest:
+                file_digest.update(data)
+            written += len(data)
+
+        if written != content_length or (digest and digest.digest() != checksum[1]):
+            f.truncate(offset)
+            if written != content_length:
+                raise UploadError("Morceau incomplet", 400)
+            raise UploadError("Somme de contrôle invalide", 460)
+
+        f.flush()
+        os.fsync(f.fileno())
+
+    # Dernier morceau : empreinte du fichier complet, pour que claim_upload
+    # range le fichier sans le relire
+    values = {'received': offset + written, 'status': 'uploading'}
+    if offset + written == upload.size:
+        values['status'] = 'complete'
+        values['sha256'] = file_digest.hexdigest() if file_digest else hash_file(path)
+
+    # Mise à jour conditionnelle : un PATCH concurrent sur le même offset échoue
+    # (rejouée si la base est verrouillée : les octets sont déjà sur disque)
+    updated = commit_with_retry(lambda: UploadSession.query.filter_by(id=upload.id, received=offset).update(values))
+    if not updated:
+        raise UploadError("Upload modifié par une autre requête", 409)
+    if file_digest and values['status'] == 'uploading':
+        keep_running_digest(upload.id, offset + written, file_digest)
+
+    db.session.refresh(upload)
+    return upload
+
+
+def claim_upload(upload_folder, upload_id, kind, user_id):
+    """
+    Vérifie un upload terminé et range son fichier dans le stockage partagé.
+
+    Le rangement n'a lieu qu'une fois : le `chemin` obtenu remplace le nom du
+    fichier partiel, et un nouvel essai du formulaire le réutilise. Retourne
+    le `chemin` ; la référence est comptée par `consume_upload`.
+    """
+    upload = UploadSession.query.get(upload_id)
+    if not upload or upload.user_id != user_id or upload.kind != kind:
+        raise UploadError("Upload introuvable", 404)
+    if upload.status != 'complete':
+        raise UploadError("Upload incomplet", 409)
+
+    if upload.filename.startswith(BLOB_PREFIX):
+        return upload.filename
+    path = upload_path(upload_folder, upload)
+    if upload.sha256:
+        chemin = place_blob(upload_folder, path, upload.sha256, file_extension(path))
+    else:
+        # Upload terminé avant l'empreinte en fin d'upload
+        chemin = place_file(upload_folder, path)
+    commit_with_retry(lambda: UploadSession.query.filter_by(id=upload.id).update(
+        {'filename': chemin}, synchronize_session=False
+    ))
+    return chemin
+
+
+def consume_upload(upload_folder, upload_id, chemin):
+    """
+    Rattache un upload rangé par `claim_upload` à un film ou un épisode.
+
+    Écritures en base uniquement, à faire dans l'unité de travail qui crée le
+    film ou l'épisode (rejouable par commit_with_retry).
+    """
+    updated = UploadSession.query.filter_by(id=upload_id, status='complete').update(
+        {'status': 'consumed'}, synchronize_session=False
+    )
+    if not updated:
+        raise UploadError("Upload déjà utilisé", 409)
+    acquire_media(upload_folder, chemin)
+
+
+def abort_upload(upload_folder, upload):
+    """
+    Abandonne un upload non utilisé : fichier partiel, ou fichier déjà rangé
+    par `claim_upload` (conservé s'il sert aussi à un autre contenu).
+
+    La suppression est confiée aux tombstones (reclaim.schedule_reclaim).
+    """
+    if upload.status == 'consumed':
+        raise UploadError("Upload déjà utilisé", 409)
+    tombstone(upload_folder, [upload_path(upload_folder, upload)])
+    db.session.delete(upload)
+    db.session.commit()
+
+
+def expire_uploads(upload_folder, max_age, now=None):
+    """
+    Supprime les sessions d'upload abandonnées (non utilisées et sans nouveau
+    morceau depuis `max_age` secondes) avec leur fichier partiel ou rangé.
+
+    Les fichiers sont confiés aux tombstones. Retourne le nombre de sessions
+    supprimées.
+    """
+    cutoff = (now or datetime.utcnow()) - timedelta(seconds=max_age)
+    expired = UploadSession.query.filter(
+        UploadSession.status != 'consumed', UploadSession.updated_date < cutoff
+    ).all()
+    if not expired:
+        return 0
+
+    tombstone(upload_folder, [upload_path(upload_folder, upload) for upload in expired])
+    UploadSession.query.filter(UploadSession.id.in_([upload.id for upload in expired])).delete(
+        synchronize_session=False
+    )
+    db.session.commit()
+    return len(expired)